@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Compare coders of cached values (see pyTON/coders.py): encode and decode time and encoded size
+on getTransactions and getBlockTransactions results. Coders which dependencies are not installed are skipped.
+
+Generated payloads are used by default, real ones can be passed as files with JSON results
+(e.g. saved "result" field of API responses).
+
+Usage: python3 benchmarks/cache_coders.py [--payload transactions.json ...] [--rounds 200]
+"""
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyTON.coders import coders
+
+
+def b64(size):
+    return base64.b64encode(os.urandom(size)).decode()
+
+
+def sample_message(with_body=True):
+    return {
+        '@type': 'raw.message',
+        'source': 'EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N',
+        'destination': 'EQBfBWT7X2BHg9tXAxzhz2aKiNTU1tpt5NsiK0uSDW_YAJ67',
+        'value': str(random.randint(1, 10 ** 12)),
+        'fwd_fee': '666672',
+        'ihr_fee': '0',
+        'created_lt': str(random.randint(10 ** 13, 10 ** 14)),
+        'body_hash': b64(32),
+        'msg_data': {'@type': 'msg.dataRaw', 'body': b64(200) if with_body else '', 'init_state': ''},
+        'message': b64(40),
+    }
+
+
+def sample_transactions(count):
+    return [{
+        '@type': 'raw.transaction',
+        'utime': 1650000000 + i,
+        'data': b64(400),
+        'transaction_id': {'@type': 'internal.transactionId', 'lt': str(30000000000000 + i), 'hash': b64(32)},
+        'fee': '5399930',
+        'storage_fee': '1',
+        'other_fee': '5399929',
+        'in_msg': sample_message(),
+        'out_msgs': [sample_message() for _ in range(i % 3)],
+    } for i in range(count)]
+
+
+def sample_block_transactions(count):
+    return {
+        '@type': 'blocks.transactions',
+        'id': {'@type': 'ton.blockIdExt', 'workchain': 0, 'shard': '-9223372036854775808', 'seqno': 24000000,
+               'root_hash': b64(32), 'file_hash': b64(32)},
+        'req_count': count,
+        'incomplete': False,
+        'transactions': [{'@type': 'blocks.shortTxId', 'mode': 135, 'account': '0:' + os.urandom(32).hex().upper(),
+                          'lt': str(30000000000000 + i), 'hash': b64(32)} for i in range(count)],
+    }
+
+
+def measure(coder, value, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        data = coder.encode(value)
+    encode_time = (time.perf_counter() - start) / rounds
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        coder.decode(data)
+    decode_time = (time.perf_counter() - start) / rounds
+    return len(data), encode_time, decode_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--payload', action='append', default=[], help='File with JSON result, can be repeated')
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    payloads = {}
+    for path in args.payload:
+        with open(path, 'r') as f:
+            payloads[os.path.basename(path)] = json.load(f)
+    if not payloads:
+        payloads = {
+            'getTransactions(limit=10)': sample_transactions(10),
+            'getTransactions(limit=100)': sample_transactions(100),
+            'getBlockTransactions(count=40)': sample_block_transactions(40),
+            'getBlockTransactions(count=1024)': sample_block_transactions(1024),
+        }
+
+    for payload_name, value in payloads.items():
+        print(f"{payload_name}: {len(json.dumps(value))} bytes of JSON")
+        for coder_name, coder_class in coders.items():
+            try:
+                coder = coder_class()
+            except ImportError as e:
+                print(f"  {coder_name:>14}: skipped ({e})")
+                continue
+            size, encode_time, decode_time = measure(coder, value, args.rounds)
+            print(f"  {coder_name:>14}: {size:>9} bytes, encode {encode_time * 1e6:>8.1f} us, decode {decode_time * 1e6:>8.1f} us")
+
+
+if __name__ == '__main__':
+    main()
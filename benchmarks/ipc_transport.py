@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Compare transports between TonlibMultiClient and TonlibClient processes:
+
+  * queue  - aioprocessing queues with pickled task tuples and TonlibClientResult-like objects,
+             child parses tonlib's JSON (transport used before framed IPC);
+  * framed - length-prefixed frames over socketpair, tonlib's JSON bytes are passed through
+             and parsed once in the parent.
+
+The child process emulates tonlib by answering every task with the same JSON response.
+
+Usage: python3 benchmarks/ipc_transport.py [--payload response.json] [--requests 2000] [--concurrency 50]
+"""
+import os
+import sys
+import json
+import time
+import pickle
+import socket
+import asyncio
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import aioprocessing
+
+from pyTON.ipc import FramedConnection
+
+
+TASK, TASK_RESULT = 4, 1
+
+
+def sample_block_transactions(count):
+    return {
+        '@type': 'blocks.transactions',
+        'id': {'@type': 'ton.blockIdExt', 'workchain': 0, 'shard': '-9223372036854775808', 'seqno': 24000000,
+               'root_hash': 'm1UZ6GHL3tTL3LcfLHANoDmjaJU5qxeltJW8Tzc3vUw=', 'file_hash': 'Vfqpj8wv9G3gMPXvUXnK09NIB6XDXbSgy9tdzYJpYPs='},
+        'req_count': count,
+        'incomplete': False,
+        'transactions': [{'@type': 'blocks.shortTxId', 'mode': 135, 'account': 'GtaOfIgK9LdKaK5NtgRfWTldPtjX3/Xo3SIgDHy0ng0=',
+                          'lt': str(30000000000000 + i), 'hash': 'P7Mk+1W+2LRx4G4pWwTyHj8QfmjuvK9yGJ0R2JTsAL4='} for i in range(count)],
+    }
+
+
+class ResultObject:
+    def __init__(self, task_id, result, params):
+        self.task_id = task_id
+        self.result = result
+        self.params = params
+
+
+def queue_child(input_queue, output_queue, response):
+    while True:
+        task = input_queue.get()
+        if task is None:
+            return
+        task_id, timeout, method, args, kwargs = task
+        output_queue.put((TASK_RESULT, ResultObject(task_id, json.loads(response), [args, kwargs])))
+
+
+def framed_child(parent_socket, sock, response):
+    parent_socket.close()
+
+    async def serve():
+        connection = await FramedConnection.open_socket(sock)
+        while True:
+            try:
+                msg_type, task_id, payload = await connection.receive()
+            except asyncio.IncompleteReadError:
+                return
+            await connection.send(TASK_RESULT, task_id, response)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(serve())
+
+
+async def run_queue(response, requests, concurrency):
+    input_queue, output_queue = aioprocessing.AioQueue(), aioprocessing.AioQueue()
+    child = multiprocessing.Process(target=queue_child, args=(input_queue, output_queue, response))
+    child.start()
+
+    loop = asyncio.get_event_loop()
+    futures = {}
+
+    async def read_output():
+        while True:
+            msg_type, result = await output_queue.coro_get()
+            futures.pop(result.task_id).set_result(result.result)
+
+    async def request(task_id):
+        futures[task_id] = loop.create_future()
+        await input_queue.coro_put((task_id, time.time() + 10, 'raw_getBlockTransactions', [], {}))
+        return await futures[task_id]
+
+    elapsed = await run_requests(request, read_output, requests, concurrency)
+    input_queue.put(None)
+    child.join()
+    return elapsed
+
+
+async def run_framed(response, requests, concurrency):
+    parent_socket, child_socket = socket.socketpair()
+    child = multiprocessing.Process(target=framed_child, args=(parent_socket, child_socket, response))
+    child.start()
+    child_socket.close()
+
+    loop = asyncio.get_event_loop()
+    connection = await FramedConnection.open_socket(parent_socket)
+    futures = {}
+
+    async def read_output():
+        while True:
+            msg_type, task_id, payload = await connection.receive()
+            futures.pop(task_id).set_result(payload)
+
+    async def request(task_id):
+        futures[task_id] = loop.create_future()
+        await connection.send(TASK, task_id, pickle.dumps((time.time() + 10, 'raw_getBlockTransactions', [], {})))
+        return json.loads(await futures[task_id])
+
+    elapsed = await run_requests(request, read_output, requests, concurrency)
+    connection.close()
+    child.join()
+    return elapsed
+
+
+async def run_requests(request, read_output, requests, concurrency):
+    reader = asyncio.ensure_future(read_output())
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(task_id):
+        async with semaphore:
+            await request(task_id)
+
+    start = time.time()
+    await asyncio.gather(*[limited(i) for i in range(1, requests + 1)])
+    elapsed = time.time() - start
+    reader.cancel()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--payload', help='File with tonlib JSON response (e.g. saved blocks.getTransactions result)')
+    parser.add_argument('--transactions', type=int, default=1024, help='Number of transactions in generated payload')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.payload:
+        with open(args.payload, 'rb') as f:
+            response = f.read()
+    else:
+        response = json.dumps(sample_block_transactions(args.transactions)).encode('utf-8')
+
+    print(f"payload: {len(response)} bytes, requests: {args.requests}, concurrency: {args.concurrency}")
+    loop = asyncio.get_event_loop()
+    # Framed transport goes first: aioprocessing starts helper threads and forking after that may deadlock.
+    for name, runner in [('framed', run_framed), ('queue', run_queue)]:
+        elapsed = loop.run_until_complete(runner(response, args.requests, args.concurrency))
+        print(f"{name:>8}: {elapsed:.3f}s total, {args.requests / elapsed:.0f} req/s, {elapsed / args.requests * 1e6:.0f} us/req")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Compare overhead of JSON-RPC method wrappers (without running the methods):
+
+  * reflection - inspect.signature of the handler on every call (wrapper used before);
+  * compiled   - parameter spec precomputed by json_rpc decorator in pyTON/main.py.
+
+Usage: python3 benchmarks/json_rpc_dispatch.py [--method getBlockTransactions] [--calls 100000]
+"""
+import os
+import sys
+import time
+import inspect
+import argparse
+
+from functools import wraps
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fastapi.params import Body, Param
+
+from pyTON.main import json_rpc_methods
+
+
+def reflection_wrapper(func):
+    @wraps(func)
+    def f(**kwargs):
+        sig = inspect.signature(func)
+        for k, v in sig.parameters.items():
+            if k not in kwargs and v.default is not inspect._empty:
+                default_val = v.default
+                if isinstance(default_val, Param) or isinstance(default_val, Body):
+                    if default_val.default == ...:
+                        raise TypeError("Non-optional argument expected")
+                    kwargs[k] = default_val.default
+                else:
+                    kwargs[k] = default_val
+            if (v.annotation is int or v.annotation is Optional[int]) and type(kwargs[k]) is str:
+                kwargs[k] = int(kwargs[k])
+        return func(**kwargs)
+    return f
+
+
+def measure(handler, params, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        # 'request' parameter is looked up per call by the old JSON-RPC handler too
+        if 'request' in inspect.signature(handler).parameters.keys():
+            pass
+        handler(**params).close()
+    return (time.perf_counter() - start) / calls
+
+
+def measure_compiled(handler, params, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        if handler.takes_request:
+            pass
+        handler(**params).close()
+    return (time.perf_counter() - start) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--method', default='getBlockTransactions')
+    parser.add_argument('--calls', type=int, default=100000)
+    args = parser.parse_args()
+
+    params = {
+        'getBlockTransactions': {'workchain': -1, 'shard': '-9223372036854775808', 'seqno': '24000000'},
+        'getAddressBalance': {'address': 'EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N'},
+    }.get(args.method, {})
+
+    compiled = json_rpc_methods[args.method]
+    reflection = reflection_wrapper(compiled.__wrapped__)
+
+    reflection_time = measure(reflection, dict(params), args.calls)
+    compiled_time = measure_compiled(compiled, dict(params), args.calls)
+    print(f"{args.method}: reflection {reflection_time * 1e6:.2f} us/call, compiled {compiled_time * 1e6:.2f} us/call, "
+          f"{reflection_time / compiled_time:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,7 @@ LOCAL_ENV = {
 	'TON_API_ANALYTICS_ENABLED': '0',
 	'TON_API_LITE_SERVER_CONFIG': 'config/mainnet.json',
 	'TON_API_WEBSERVERS_WORKERS': '1',
+	'TON_API_SHARED_POOL_ENABLED': '0',
 	'TON_API_GET_METHODS_ENABLED': '1',
 	'TON_API_JSON_RPC_ENABLED': '1',
 	'TON_API_HTTP_PORT': '80',
@@ -31,6 +32,7 @@ TESTNET_ENV = {
 	'TON_API_ANALYTICS_ENABLED': '1',
 	'TON_API_LITE_SERVER_CONFIG': 'config/testnet.json',
 	'TON_API_WEBSERVERS_WORKERS': '1',
+	'TON_API_SHARED_POOL_ENABLED': '0',
 	'TON_API_GET_METHODS_ENABLED': '1',
 	'TON_API_JSON_RPC_ENABLED': '1',
 	'TON_API_HTTP_PORT': '80',
@@ -48,6 +50,7 @@ PROD_ENV = {
 	'TON_API_ANALYTICS_ENABLED': '1',
 	'TON_API_LITE_SERVER_CONFIG': 'config/mainnet.json',
 	'TON_API_WEBSERVERS_WORKERS': '16',
+	'TON_API_SHARED_POOL_ENABLED': '0',
 	'TON_API_GET_METHODS_ENABLED': '1',
 	'TON_API_JSON_RPC_ENABLED': '1',
 	'TON_API_HTTP_PORT': '80',
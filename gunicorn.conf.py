@@ -0,0 +1,20 @@
+from config import settings
+
+
+liteserver_pool = None
+
+
+def on_starting(server):
+    # Start the pool before workers are forked so all of them can connect to it.
+    # Pool runs under a supervisor process which restarts it if it dies.
+    if settings.pyton.shared_pool.enabled:
+        from pyTON.pool import start_liteserver_pool
+
+        global liteserver_pool
+        liteserver_pool = start_liteserver_pool()
+
+
+def on_exit(server):
+    if liteserver_pool is not None:
+        liteserver_pool.terminate()
+        liteserver_pool.join()
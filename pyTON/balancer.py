@@ -0,0 +1,166 @@
+import time
+import random
+import collections
+
+
+class ClientStats:
+    """
+    Load and latency of a single liteserver client as seen by TonlibMultiClient.
+    """
+    # weight of the last task in latency moving average
+    alpha = 0.2
+    # number of last tasks kept for latency percentiles
+    window = 100
+
+    def __init__(self):
+        self.in_flight = 0
+        self.latency = None
+        self.latencies = collections.deque(maxlen=self.window)
+
+    def task_started(self):
+        self.in_flight += 1
+
+    def task_finished(self, elapsed_time=None):
+        """
+        :param elapsed_time: task duration, None if the task was cancelled
+        """
+        self.in_flight -= 1
+        if elapsed_time is None:
+            return
+        self.latencies.append(elapsed_time)
+        if self.latency is None:
+            self.latency = elapsed_time
+        else:
+            self.latency = self.alpha * elapsed_time + (1 - self.alpha) * self.latency
+
+    def latency_percentile(self, percentile):
+        """
+        :return: latency percentile of last tasks or None if there are too few of them
+        """
+        if len(self.latencies) < 10:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+    @property
+    def expected_latency(self):
+        # Clients without measured latency get tried first.
+        latency = self.latency or 0
+        return latency * (self.in_flight + 1)
+
+
+def random_choice(clients):
+    return random.choice(clients)
+
+
+def least_outstanding(clients):
+    least = min(cl.stats.in_flight for cl in clients)
+    return random.choice([cl for cl in clients if cl.stats.in_flight == least])
+
+
+def power_of_two_choices(clients):
+    if len(clients) < 2:
+        return clients[0]
+    a, b = random.sample(clients, 2)
+    return min(a, b, key=lambda cl: (cl.stats.in_flight, cl.stats.latency or 0))
+
+
+def ewma_latency(clients):
+    return min(random.sample(clients, len(clients)), key=lambda cl: cl.stats.expected_latency)
+
+
+strategies = {
+    'random': random_choice,
+    'least_outstanding': least_outstanding,
+    'p2c': power_of_two_choices,
+    'ewma': ewma_latency,
+}
+
+
+def get_strategy(name):
+    try:
+        return strategies[name]
+    except KeyError:
+        raise ValueError(f"Unknown balancing strategy: {name}")
+
+
+class CircuitBreaker:
+    """
+    Stops traffic to a liteserver client which fails too many tasks.
+
+    Breaker opens when share of failed tasks among the last ones exceeds failure_ratio.
+    After cool_off seconds it becomes half-open and lets a few probe tasks through:
+    if all of them succeed breaker closes, otherwise it opens again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, window, min_tasks, failure_ratio, cool_off, probes):
+        self.min_tasks = min_tasks
+        self.failure_ratio = failure_ratio
+        self.cool_off = cool_off
+        self.probes = probes
+        self.outcomes = collections.deque(maxlen=window)
+        self.state = self.CLOSED
+        self.open_until = 0
+        self.probe_successes = 0
+
+    @property
+    def is_open(self):
+        if self.state == self.OPEN and time.time() >= self.open_until:
+            self.state = self.HALF_OPEN
+            self.probe_successes = 0
+        return self.state == self.OPEN
+
+    def allows_task(self, in_flight):
+        if self.is_open:
+            return False
+        if self.state == self.HALF_OPEN:
+            return in_flight < self.probes
+        return True
+
+    def record(self, success):
+        if self.state == self.OPEN:
+            # tasks sent before breaker opened
+            return
+        if self.state == self.HALF_OPEN:
+            if not success:
+                self.open()
+                return
+            self.probe_successes += 1
+            if self.probe_successes >= self.probes:
+                self.state = self.CLOSED
+                self.outcomes.clear()
+            return
+
+        self.outcomes.append(success)
+        if len(self.outcomes) >= self.min_tasks:
+            failures = self.outcomes.count(False)
+            if failures > self.failure_ratio * len(self.outcomes):
+                self.open()
+
+    def open(self):
+        self.state = self.OPEN
+        self.open_until = time.time() + self.cool_off
+
+
+class HedgingBudget:
+    """
+    Token bucket limiting hedged requests of a method: every request adds ratio of a token,
+    every hedge takes a whole one. Tokens are capped by burst, so a long healthy period
+    doesn't let an incident hedge almost every request.
+    """
+    def __init__(self, ratio, burst):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+
+    def add_request(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def take_hedge(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
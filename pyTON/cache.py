@@ -1,21 +1,489 @@
+import os
+import json
+import time
+import asyncio
+import secrets
+import inspect
+import sqlite3
+import struct
+import threading
+import functools
 import aioredis
-import ring
-from ring.func.asyncio import Aioredis2Storage
+
+from pathlib import Path
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
 from config import settings
+from pyTON.utils import TonlibRawResult
+from pyTON.coders import get_coder
+
+from loguru import logger
+
+
+def is_error_result(value):
+    if isinstance(value, TonlibRawResult):
+        return value.is_error()
+    return value.get('@type', 'error') == 'error'
+
+
+class LocalCache:
+    """
+    LRU cache in memory of the process with per entry expiration. Values are kept encoded,
+    so callers can't modify cached objects, and total size of values is limited in bytes.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expire_at, value = entry
+        if expire_at < time.time():
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, expire):
+        self.remove(key)
+        if len(value) > self.max_size:
+            return
+        self.entries[key] = (time.time() + expire, value)
+        self.size += len(value)
+        while self.size > self.max_size:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+class TonlibResultCache:
+    """
+    Two tier cache: local cache of the process in front of redis shared by all processes.
+    """
+    def __init__(self):
+        self.redis = aioredis.from_url(f"redis://{settings.cache.redis.endpoint}:{settings.cache.redis.port}")
+        self.local = LocalCache(settings.cache.local.max_size) if settings.cache.local.enabled else None
+        # per method hit and miss counters since the last report: local, redis, miss and stale values served during revalidation
+        self.stats = defaultdict(lambda: {'local': 0, 'redis': 0, 'miss': 0, 'stale': 0})
+
+    def take_stats(self):
+        """
+        :return: per method hit and miss counters since the previous call
+        """
+        stats = dict(self.stats)
+        self.stats.clear()
+        return stats
+
+    async def report_stats(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            for name, stats in self.take_stats().items():
+                logger.info(f"Cache of {name} in the last {interval}s: {stats['local']} local hits, {stats['redis']} redis hits, "
+                            f"{stats['miss']} misses, {stats['stale']} stale values")
+
+    def local_expire(self, name, expire):
+        return min(expire, settings.cache.local.methods.get(name, expire))
+
+    def get_local(self, name, key):
+        """
+        :return: encoded value from local cache or None
+        """
+        if self.local is None:
+            return None
+        value = self.local.get(key)
+        if value is not None:
+            self.stats[name]['local'] += 1
+        return value
+
+    def set_local(self, name, key, value, expire):
+        if self.local is not None:
+            self.local.set(key, value, self.local_expire(name, expire))
 
-class TonlibResultRedisStorage(Aioredis2Storage):
-    async def set(self, key, value, expire=...):
-        if value.get('@type', 'error') == 'error':
+    async def get(self, name, key, expire):
+        """
+        :return: encoded value or None
+        """
+        stats = self.stats[name]
+        value = self.get_local(name, key)
+        if value is not None:
+            return value
+
+        value = await self.redis.get(key)
+        if value is None:
+            stats['miss'] += 1
+            return None
+        stats['redis'] += 1
+        if self.local is not None:
+            # remaining redis ttl isn't known, so value can live in local cache a bit longer
+            self.local.set(key, value, self.local_expire(name, expire))
+        return value
+
+    async def set(self, name, key, value, expire, hard_expire=None):
+        """
+        :param hard_expire: seconds to keep the value in redis if it's longer than expire
+        """
+        if self.local is not None:
+            self.local.set(key, value, self.local_expire(name, expire))
+        await self.redis.set(key, value, ex=hard_expire or expire)
+
+    async def prefetch(self, name, keys, expire):
+        """
+        Load values of keys missing in local cache from redis with a single request.
+        """
+        if self.local is None:
+            return
+        keys = [key for key in keys if self.local.get(key) is None]
+        if not keys:
+            return
+        for key, value in zip(keys, await self.redis.mget(keys)):
+            if value is not None:
+                self.local.set(key, value, self.local_expire(name, expire))
+
+    async def acquire_lease(self, key):
+        """
+        Take lease on computing value of the key, so that other processes wait for it instead of
+        making the same liteserver request.
+
+        :return: lease token or None if lease is held by another process
+        """
+        if not settings.cache.lease.enabled:
+            return secrets.token_hex(8)
+        token = secrets.token_hex(8)
+        if await self.redis.set(f"lease:{key}", token, nx=True, px=int(settings.cache.lease.timeout * 1000)):
+            return token
+        return None
+
+    async def release_lease(self, key, token):
+        if not settings.cache.lease.enabled:
+            return
+        lease_key = f"lease:{key}"
+        if await self.redis.get(lease_key) == token.encode():
+            await self.redis.delete(lease_key)
+
+    async def wait_value(self, name, key, expire):
+        """
+        Wait until holder of the lease stores the value.
+
+        :return: encoded value or None if lease is released or expired without value
+        """
+        lease_key = f"lease:{key}"
+        while True:
+            await asyncio.sleep(settings.cache.lease.poll_interval)
+            value = await self.redis.get(key)
+            if value is not None:
+                if self.local is not None:
+                    self.local.set(key, value, self.local_expire(name, expire))
+                return value
+            if not await self.redis.exists(lease_key):
+                return None
+
+
+class ImmutableStore:
+    """
+    SQLite file with results which never change, shared by all processes on the host.
+    When the file grows over max_size bytes the oldest entries are removed.
+
+    Queries are made in a small pool of threads of the process, each with its own connection, so they don't
+    block the event loop. If the file is locked by another process for longer than busy_timeout seconds,
+    the store is skipped.
+    """
+    # entries removed at once when store is full
+    evict_batch = 1000
+
+    def __init__(self, path, max_size, busy_timeout, threads=4):
+        self.path = path
+        self.max_size = max_size
+        self.busy_timeout = busy_timeout
+        self.threads = threads
+        self.executor = None
+        self.local = None
+        self.pid = None
+        self.inserts = 0
+
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+            self.local.db = db
+        return db
+
+    async def run(self, func, *args):
+        # neither connections nor threads of the executor survive fork
+        if self.pid != os.getpid():
+            self.local = threading.local()
+            self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='immutable_store')
+            self.pid = os.getpid()
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def get(self, key):
+        try:
+            return await self.run(self.read, key)
+        except sqlite3.Error as e:
+            logger.warning(f"Immutable store read failed: {e}")
             return None
-        return await super().set(key, value, expire)
-
-def redis_cached(expire, check_error=True):
-    if settings.cache.enabled:
-        cache_redis = aioredis.from_url(f"redis://{settings.cache.redis.endpoint}:{settings.cache.redis.port}")
-        storage_class = TonlibResultRedisStorage if check_error else Aioredis2Storage
-        def g(func):
-            return ring.aioredis(cache_redis, coder='pickle', expire=expire, storage_class=storage_class)(func)
-    else:
-        def g(func):
-            return func
+
+    async def set(self, key, value):
+        try:
+            await self.run(self.write, key, value)
+        except sqlite3.Error as e:
+            logger.warning(f"Immutable store write failed: {e}")
+
+    def read(self, key):
+        row = self.connect().execute('SELECT value FROM objects WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def write(self, key, value):
+        db = self.connect()
+        db.execute('INSERT OR REPLACE INTO objects (key, value) VALUES (?, ?)', (key, value))
+        # counter is shared by threads, eviction is checked about every 100 inserts
+        self.inserts += 1
+        if self.inserts % 100 == 0:
+            self.evict(db)
+
+    def evict(self, db):
+        page_size = db.execute('PRAGMA page_size').fetchone()[0]
+        used_pages = db.execute('PRAGMA page_count').fetchone()[0] - db.execute('PRAGMA freelist_count').fetchone()[0]
+        if used_pages * page_size > self.max_size:
+            # rowid grows with every insert, so the smallest ones are the oldest entries
+            db.execute('DELETE FROM objects WHERE rowid IN (SELECT rowid FROM objects ORDER BY rowid LIMIT ?)', (self.evict_batch,))
+
+
+coder = get_coder(settings.cache.coder)
+cache = TonlibResultCache() if settings.cache.enabled else None
+store = ImmutableStore(settings.cache.store.path, settings.cache.store.max_size,
+                       settings.cache.store.busy_timeout, settings.cache.store.threads) if settings.cache.store.enabled else None
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share a single execution.
+    """
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, coro_func):
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(coro_func())
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self.calls.pop(key, None))
+        # cancellation of one caller must not cancel the call shared with others
+        return await asyncio.shield(future)
+
+
+in_flight = SingleFlight()
+
+
+def bind_arguments(signature, args, kwargs):
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    return bound.arguments
+
+
+def cache_key(name, arguments, block=None):
+    # Cache is shared by all TonlibMultiClient instances, so self isn't part of the key.
+    values = [v for k, v in arguments.items() if k != 'self']
+    key = f"{name}:{values!r}"
+    if block:
+        key += f"@{block}"
+    return key
+
+
+def immutable_key(name, *values):
+    return f"{coder.name}:{name}:{list(values)!r}"
+
+
+async def get_stored(name, key):
+    """
+    Get immutable value from local cache, immutable store or redis, in this order.
+
+    :return: encoded value or None
+    """
+    if cache is not None:
+        value = cache.get_local(name, key)
+        if value is not None:
+            return value
+    if store is not None:
+        value = await store.get(key)
+        if value is not None:
+            if cache is not None:
+                cache.set_local(name, key, value, settings.cache.immutable_expire)
+            return value
+    if cache is not None:
+        value = await cache.get(name, key, settings.cache.immutable_expire)
+        if value is not None and store is not None:
+            await store.set(key, value)
+        return value
+    return None
+
+
+async def get_immutable(name, key):
+    """
+    Get value which never changes stored by set_immutable.
+    """
+    value = await get_stored(name, key)
+    return coder.decode(value) if value is not None else None
+
+
+async def set_immutable(name, key, value):
+    value = coder.encode(value)
+    if store is not None:
+        await store.set(key, value)
+    if cache is not None:
+        await cache.set(name, key, value, settings.cache.immutable_expire)
+
+
+# Entries of methods with stale-while-revalidate start with time until which the value is fresh.
+ENTRY_HEADER = struct.Struct('!d')
+
+
+def pack_entry(value, expire):
+    return ENTRY_HEADER.pack(time.time() + expire) + value
+
+
+def unpack_entry(entry, stale):
+    """
+    :return: (value, is_fresh), value is None if it's stale for longer than stale seconds
+    """
+    fresh_until, = ENTRY_HEADER.unpack_from(entry)
+    now = time.time()
+    if now >= fresh_until + stale:
+        return None, False
+    return entry[ENTRY_HEADER.size:], now < fresh_until
+
+
+def log_refresh_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Background refresh of cached value failed: {task.exception()}")
+
+
+def redis_cached(expire, check_error=True, block_bound=False, immutable=None, stale=0):
+    """
+    Cache results of coroutine in local cache and redis. Concurrent calls with the same arguments
+    are coalesced: within the process always, across processes with a lease in redis.
+    With cache disabled the coroutine is called as is, only immutable results are kept in the immutable store.
+
+    :param expire: seconds to keep the result
+    :param check_error: don't cache tonlib errors
+    :param block_bound: result is valid only until the next consensus block, it's cached per block
+    :param immutable: predicate called with method arguments (including self) which tells that
+        the result never changes, such results are kept for cache.immutable_expire seconds
+    :param stale: seconds after expiration during which the cached value is still returned
+        while a single background call refreshes it, if cache.stale_while_revalidate is on.
+        With block_bound values requested at previous consensus blocks are never returned.
+    """
+    def g(func):
+        name = func.__name__
+        # values encoded by other coder can't be decoded, so they are stored under other keys
+        prefix = f"{coder.name}:{func.__module__}.{func.__qualname__}"
+        signature = inspect.signature(func)
+        # Methods with raw argument return tonlib response as is or parsed. The response is cached once
+        # and parsed for callers which need it.
+        passthrough = 'raw' in signature.parameters
+
+        def decode(entry, parse):
+            result = coder.decode(entry)
+            return json.loads(result) if parse and isinstance(result, TonlibRawResult) else result
+
+        async def fetch(key, expire, is_immutable, args, kwargs, revalidate=False, background=False):
+            # Result is shared by coalesced callers, so it's passed as stored entry and every caller decodes its own copy.
+            lease = None
+            if cache is not None:
+                lease = await cache.acquire_lease(key)
+                if lease is None:
+                    if background:
+                        # another process is refreshing the value
+                        return None
+                    entry = await cache.wait_value(name, key, expire)
+                    if entry is not None:
+                        return entry
+            try:
+                result = await func(*args, **kwargs)
+                value = coder.encode(result)
+                entry = pack_entry(value, expire) if revalidate else value
+                if not check_error or not is_error_result(result):
+                    if is_immutable and store is not None:
+                        await store.set(key, value)
+                    if cache is not None:
+                        await cache.set(name, key, entry, expire, expire + stale if revalidate else None)
+                return entry
+            finally:
+                if lease is not None:
+                    await cache.release_lease(key, lease)
+
+        def refresh(key, args, kwargs):
+            if key in in_flight.calls:
+                return
+            task = asyncio.ensure_future(in_flight.do(key, lambda: fetch(key, expire, False, args, kwargs, True, background=True)))
+            task.add_done_callback(log_refresh_error)
+
+        def resolve(arguments):
+            """
+            :return: key, its expiration, whether result is immutable and whether it's revalidated
+            """
+            block = arguments['self'].current_consensus_block if block_bound else None
+            is_immutable = bool(immutable and immutable(**arguments))
+            revalidate = bool(stale) and settings.cache.stale_while_revalidate and cache is not None and not is_immutable
+            key = cache_key(prefix, arguments, block)
+            key_expire = settings.cache.immutable_expire if is_immutable else expire
+            return key, key_expire, is_immutable, revalidate
+
+        async def prefetch(calls):
+            """
+            Load cached results of many calls into local cache with a single redis request.
+
+            :param calls: list of positional arguments of calls
+            """
+            if cache is None or not calls:
+                return
+            resolved = [resolve(bind_arguments(signature, args, {})) for args in calls]
+            await cache.prefetch(name, [key for key, *_ in resolved], resolved[0][1])
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if cache is None and (store is None or immutable is None):
+                return await func(*args, **kwargs)
+            arguments = bind_arguments(signature, args, kwargs)
+            parse = passthrough and not arguments['raw']
+            if passthrough:
+                arguments['raw'] = True
+                args, kwargs = (), arguments
+            key, key_expire, is_immutable, revalidate = resolve(arguments)
+            if is_immutable:
+                value = await get_stored(name, key)
+                if value is not None:
+                    return decode(value, parse)
+            elif cache is not None:
+                entry = await cache.get(name, key, key_expire)
+                if entry is not None and revalidate:
+                    value, is_fresh = unpack_entry(entry, stale)
+                    if value is not None:
+                        if not is_fresh:
+                            cache.stats[name]['stale'] += 1
+                            refresh(key, args, kwargs)
+                        return decode(value, parse)
+                elif entry is not None:
+                    return decode(entry, parse)
+
+            entry = await in_flight.do(key, lambda: fetch(key, key_expire, is_immutable, args, kwargs, revalidate))
+            if entry is None:
+                # joined background refresh which left the value to another process
+                entry = await fetch(key, key_expire, is_immutable, args, kwargs, revalidate)
+            if revalidate:
+                entry = entry[ENTRY_HEADER.size:]
+            return decode(entry, parse)
+        wrapper.prefetch = prefetch
+        return wrapper
     return g
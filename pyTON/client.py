@@ -1,34 +1,112 @@
 # -*- coding: utf-8 -*-
+import os
 import asyncio
 import codecs
-import struct
 import socket
-import threading
-import aioprocessing
 import multiprocessing
 import time
 import random
 import json
+import pickle
 
-from datetime import datetime, timezone
+from collections import OrderedDict, defaultdict
 from typing import Optional, Any
-from enum import Enum
+from enum import IntEnum
 
 from concurrent.futures import ThreadPoolExecutor
 from tvm_valuetypes import serialize_tvm_stack, render_tvm_stack, deserialize_boc
 
 from config import settings
-from pyTON.tonlibjson import TonLib
-from pyTON.address_utils import prepare_address, detect_address
+from pyTON.ipc import FramedConnection
+from pyTON.tonlibjson import TonLib, raw_results, task_deadline
+from pyTON.address_utils import prepare_address
 from pyTON.utils import TonLibWrongResult, b64str_to_hex, hex_to_b64str
 
 from loguru import logger
 
 
-class MsgType(Enum):
+class MsgType(IntEnum):
     TASK_RESULT = 1
     LAST_BLOCK_UPDATE = 2
     ARCHIVAL_UPDATE = 3
+    TASK = 4
+    TASK_EXCEPTION = 5
+
+
+def process_memory():
+    """
+    Resident memory of current process in bytes.
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class LoadedContracts:
+    """
+    LRU of smart contracts loaded into tonlib (smc.load) by address. Contract is loaded again when
+    last transaction of the account changes. Evicted contracts are to be released with smc.forget
+    as soon as get methods running on them are done.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # address -> (last transaction lt, contract id)
+        self.entries = OrderedDict()
+        # address -> last transaction lt of the last request of its contract
+        self.requested = OrderedDict()
+        # contract id -> number of running get methods
+        self.users = defaultdict(int)
+        # evicted contract ids which are still in use
+        self.evicted = set()
+
+    def get(self, address, last_transaction_lt):
+        entry = self.entries.get(address)
+        if entry is None or entry[0] != last_transaction_lt:
+            return None
+        self.entries.move_to_end(address)
+        return entry[1]
+
+    def is_worth_keeping(self, address, last_transaction_lt):
+        """
+        Contract is worth keeping loaded if it was requested before at the same last transaction.
+        Contracts which change between requests are loaded every time anyway.
+        """
+        requested = self.requested.pop(address, None)
+        self.requested[address] = last_transaction_lt
+        while len(self.requested) > self.max_size:
+            self.requested.popitem(last=False)
+        return requested == last_transaction_lt
+
+    def add(self, address, last_transaction_lt, contract_id):
+        """
+        :return: evicted contract ids which can be forgotten now
+        """
+        evicted = []
+        entry = self.entries.pop(address, None)
+        if entry is not None:
+            evicted.append(entry[1])
+        self.entries[address] = (last_transaction_lt, contract_id)
+        while len(self.entries) > self.max_size:
+            _, (_, evicted_id) = self.entries.popitem(last=False)
+            evicted.append(evicted_id)
+        self.evicted.update(evicted)
+        return [i for i in evicted if self.release(i, acquired=False)]
+
+    def acquire(self, contract_id):
+        self.users[contract_id] += 1
+
+    def release(self, contract_id, acquired=True):
+        """
+        :return: True if contract is evicted and not used anymore, so it can be forgotten
+        """
+        if acquired:
+            self.users[contract_id] -= 1
+        if self.users[contract_id] > 0:
+            return False
+        del self.users[contract_id]
+        if contract_id in self.evicted:
+            self.evicted.discard(contract_id)
+            return True
+        return False
 
 
 class TonlibClientResult:
@@ -53,10 +131,25 @@ class TonlibClientResult:
 
 
 class TonlibClient(multiprocessing.Process):
-    def __init__(self, input_queue, output_queue, config, keystore, cdll_path=None):
+    # Methods returning tonlib response as is. Their results are forwarded
+    # to the parent process as tonlib's JSON bytes without parsing.
+    passthrough_methods = {
+        'raw_get_transactions',
+        'raw_get_account_state',
+        'generic_get_account_state',
+        'raw_send_message',
+        'raw_create_and_send_message',
+        'lookupBlock',
+        'getShards',
+        'raw_getBlockTransactions',
+        'getBlockHeader',
+    }
+
+    def __init__(self, config, keystore, cdll_path=None):
         super(TonlibClient, self).__init__()
-        self.input_queue = input_queue
-        self.output_queue = output_queue
+        # Frames are sent through socketpair: parent_socket is used by TonlibMultiClient,
+        # child_socket by this process.
+        self.parent_socket, self.child_socket = socket.socketpair()
         self.config = config
         self.keystore = keystore
         self.cdll_path = cdll_path
@@ -64,16 +157,21 @@ class TonlibClient(multiprocessing.Process):
         self.last_block = 0
         self.number = 0
         self.archival = False
+        self.reconnecting = False
         self.max_parallel_requests = config['liteservers'][0].get("max_parallel_requests", 
                                                                   settings.pyton.parallel_requests_per_liteserver)
 
     def run(self):
-        self.semaphore = asyncio.Semaphore(self.max_parallel_requests)
+        self.parent_socket.close()
         policy = asyncio.get_event_loop_policy()
         policy.set_event_loop(policy.new_event_loop())
         loop = asyncio.get_event_loop()
         self.loop = loop
+        self.semaphore = asyncio.Semaphore(self.max_parallel_requests)
+        self.connection = loop.run_until_complete(FramedConnection.open_socket(self.child_socket))
         loop.run_until_complete(self.init_tonlib(self.cdll_path))
+        self.initial_memory = process_memory()
+        self.check_health_task = asyncio.ensure_future(self.check_health(), loop=self.loop)
         self.report_last_block_task = asyncio.ensure_future(self.report_last_block(), loop=self.loop)
         self.report_archival_task = asyncio.ensure_future(self.report_archival(), loop=self.loop)
         loop.run_until_complete(self.read_tasks())
@@ -90,40 +188,44 @@ class TonlibClient(multiprocessing.Process):
 
     async def read_tasks(self):
         while True:
-            async with self.semaphore:
-                task_id, timeout, method, args, kwargs = await self.input_queue.coro_get()
- 
-                result = None
-                exception = None
-
-                start_time = datetime.now()
-                if time.time() < timeout:
-                    try:
-                        result = await self.__getattribute__(method)(*args, **kwargs)
-                    except asyncio.CancelledError:
-                        exception = Exception("Liteserver timeout")
-                        logger.warning(f"Client #{self.number:03d} did not get response from liteserver before timeout")
-                    except Exception as e:
-                        exception = e
-                        logger.warning(f"Client #{self.number:03d} raised exception {e} while executing task")
-                    else:
-                        logger.info(f"Client #{self.number:03d} got result {method}")
-                else:
-                    logger.warning(f"Client #{self.number:03d} received task after timeout")
+            msg_type, task_id, payload = await self.connection.receive()
+            if msg_type == MsgType.TASK:
+                await self.semaphore.acquire()
+                asyncio.ensure_future(self.run_task(task_id, payload), loop=self.loop)
+
+    async def run_task(self, task_id, payload):
+        try:
+            timeout, method, args, kwargs = pickle.loads(payload)
+            raw_results.set(method in self.passthrough_methods)
+            task_deadline.set(timeout)
+
+            result = None
+            exception = None
+            if time.time() < timeout:
+                try:
+                    result = await self.__getattribute__(method)(*args, **kwargs)
+                except asyncio.CancelledError:
                     exception = asyncio.TimeoutError()
+                    logger.warning(f"Client #{self.number:03d} did not get response from liteserver before timeout")
+                except Exception as e:
+                    exception = e
+                    logger.warning(f"Client #{self.number:03d} raised exception {e} while executing task")
+                else:
+                    logger.info(f"Client #{self.number:03d} got result {method}")
+            else:
+                logger.warning(f"Client #{self.number:03d} received task after timeout")
+                exception = asyncio.TimeoutError()
 
-                end_time = datetime.now()
-                elapsed_time = (end_time - start_time).total_seconds()
-
-                # result
-                tonlib_task_result = TonlibClientResult(task_id,
-                                                      method,
-                                                      elapsed_time=elapsed_time,
-                                                      params=[args, kwargs],
-                                                      result=result,
-                                                      exception=exception,
-                                                      liteserver_info=self.info)
-                await self.output_queue.coro_put((MsgType.TASK_RESULT, tonlib_task_result))
+            if exception is not None:
+                await self.connection.send(MsgType.TASK_EXCEPTION, task_id, pickle.dumps(exception))
+            elif isinstance(result, bytes):
+                await self.connection.send(MsgType.TASK_RESULT, task_id, result)
+            else:
+                await self.connection.send(MsgType.TASK_RESULT, task_id, json.dumps(result).encode('utf-8'))
+        except Exception as e:
+            logger.error(f"Client #{self.number:03d} failed to send task result: {e}")
+        finally:
+            self.semaphore.release()
 
     async def report_last_block(self):
         while True:
@@ -134,7 +236,7 @@ class TonlibClient(multiprocessing.Process):
                 self.last_block = last_block
             except Exception as e:
                 logger.error(f"Client #{self.number:03d} report_last_block exception {e}")
-            await self.output_queue.coro_put((MsgType.LAST_BLOCK_UPDATE, last_block))
+            await self.connection.send(MsgType.LAST_BLOCK_UPDATE, 0, json.dumps(last_block).encode('utf-8'))
             await asyncio.sleep(1)
 
     async def report_archival(self):
@@ -143,17 +245,53 @@ class TonlibClient(multiprocessing.Process):
                 block_transactions = await self.getBlockTransactions(-1, -9223372036854775808, random.randint(2, 2000000))
                 is_archival = block_transactions.get("@type", "") == "blocks.transactions"
                 self.is_archival = is_archival
-                await self.output_queue.coro_put((MsgType.ARCHIVAL_UPDATE, is_archival))
+                await self.connection.send(MsgType.ARCHIVAL_UPDATE, 0, json.dumps(is_archival).encode('utf-8'))
             except Exception as e:
                 logger.error(f"Client #{self.number:03d} report_archival exception {e}")
             await asyncio.sleep(600)
 
+    async def check_health(self):
+        """
+        Restart tonlib if it uses too much memory, returns too many errors or got stuck.
+        """
+        restart_settings = settings.pyton.tonlib_restart
+        last_restart = time.time()
+        while True:
+            await asyncio.sleep(restart_settings.check_interval)
+            requests, errors = self.tonlib_wrapper.take_stats()
+            if time.time() - last_restart < restart_settings.min_interval:
+                continue
+
+            reason = None
+            memory_growth = (process_memory() - self.initial_memory) / 2 ** 20
+            if memory_growth > restart_settings.max_memory_growth:
+                reason = f"memory grew by {memory_growth:.0f} MB"
+            elif requests >= restart_settings.min_requests and errors / requests > restart_settings.max_error_rate:
+                reason = f"{errors} errors of {requests} requests"
+            elif self.tonlib_wrapper.is_stuck(restart_settings.stuck_timeout):
+                reason = f"no results for {restart_settings.stuck_timeout}s"
+
+            if reason is not None:
+                logger.warning(f'Client #{self.number:03d} restarting tonlib: {reason}')
+                last_restart = time.time()
+                await self.reconnect()
+
     async def reconnect(self):
-        if not self.tonlib_wrapper.shutdown_state:
+        if self.reconnecting:
+            return
+        self.reconnecting = True
+        try:
             logger.info(f'Client #{self.number:03d} reconnecting')
-            self.tonlib_wrapper.shutdown_state = "started"
+            old_wrapper = self.tonlib_wrapper
+            # Old tonlib keeps serving requests until the new one is inited,
+            # then it's shut down as soon as requests in flight are done.
             await self.init_tonlib()
+            old_wrapper.shutdown_state = "started"
+            # memory freed by the old tonlib isn't necessarily returned to the system, so growth is counted from now
+            self.initial_memory = process_memory()
             logger.info(f'Client #{self.number:03d} reconnected')
+        finally:
+            self.reconnecting = False
 
     async def init_tonlib(self, cdll_path=None):
         """
@@ -191,8 +329,10 @@ class TonlibClient(multiprocessing.Process):
         }
 
         await wrapper.execute(request)
-        wrapper.set_restart_hook(hook=self.reconnect, max_requests=500)
+        wrapper.set_restart_hook(hook=self.reconnect)
         self.tonlib_wrapper = wrapper
+        # contract ids are valid only in tonlib instance which loaded them
+        self.loaded_contracts = LoadedContracts(settings.pyton.loaded_contracts_limit)
         await self.set_verbosity_level(0)
         logger.info(F"TonLib inited successfully")
 
@@ -359,7 +499,7 @@ class TonlibClient(multiprocessing.Process):
         }
         return await self.tonlib_wrapper.execute(request)
 
-    async def _load_contract(self, address):
+    async def _load_contract(self, address, wrapper):
         account_address = prepare_address(address)  # TODO: understand why this is not used
         request = {
             '@type': 'smc.load',
@@ -367,15 +507,30 @@ class TonlibClient(multiprocessing.Process):
                 'account_address': address
             }
         }
-        result = await self.tonlib_wrapper.execute(request)
+        result = await wrapper.execute(request)
         if result.get('@type', 'error') == 'error':
             raise TonLibWrongResult("smc.load failed", result)
         self.loaded_contracts_num += 1
         return result["id"]
 
-    async def raw_run_method(self, address, method, stack_data, output_layout=None):
+    async def _forget_contract(self, contract_id, wrapper):
+        request = {
+            '@type': 'smc.forget',
+            'id': contract_id
+        }
+        try:
+            result = await wrapper.execute(request)
+        except Exception as e:
+            result = {'@type': 'error', 'message': str(e)}
+        if result.get('@type', 'error') == 'error':
+            logger.warning(f"Client #{self.number:03d} smc.forget failed: {result}")
+            return
+        self.loaded_contracts_num -= 1
+
+    async def raw_run_method(self, address, method, stack_data, output_layout=None, last_transaction_lt=None):
         """
-          For numeric data only
+          For numeric data only.
+          Contract loaded at the same last_transaction_lt of the account is reused, without it contract is loaded every time.
           TL Spec:
             smc.runGetMethod id:int53 method:smc.MethodId stack:vector<tvm.StackEntry> = smc.RunResult;
 
@@ -397,19 +552,84 @@ class TonlibClient(multiprocessing.Process):
 
           smc.runResult gas_used:int53 stack:vector<tvm.StackEntry> exit_code:int32 = smc.RunResult;
         """
+        wrapper, contracts = self.tonlib_wrapper, self.loaded_contracts
+        contract_id, kept = await self._acquire_contract(address, last_transaction_lt, wrapper, contracts)
+        try:
+            return await self._run_get_method(contract_id, method, stack_data, wrapper)
+        finally:
+            await self._release_contract(contract_id, kept, wrapper, contracts)
+
+    async def raw_run_methods(self, address, calls, last_transaction_lt=None):
+        """
+        Run several get methods of one contract loading it once.
+
+        :param calls: list of (method, stack_data)
+        :return: list of results, failed calls get error results
+        """
+        wrapper, contracts = self.tonlib_wrapper, self.loaded_contracts
+        contract_id, kept = await self._acquire_contract(address, last_transaction_lt, wrapper, contracts)
+        try:
+            results = await asyncio.gather(*[self._run_get_method(contract_id, method, stack_data, wrapper) for method, stack_data in calls],
+                                           return_exceptions=True)
+        finally:
+            await self._release_contract(contract_id, kept, wrapper, contracts)
+        return [{'@type': 'error', 'code': 500, 'message': str(r)} if isinstance(r, Exception) else r for r in results]
+
+    async def _acquire_contract(self, address, last_transaction_lt, wrapper, contracts):
+        """
+        :return: tuple (contract id, whether it's kept loaded for last_transaction_lt)
+        """
+        contract_id = None
+        evicted = []
+        if last_transaction_lt is not None:
+            contract_id = contracts.get(address, last_transaction_lt)
+            if contract_id is not None:
+                contracts.acquire(contract_id)
+                return contract_id, True
+        # smc.load loads the current state of the account while last_transaction_lt may come from cached state,
+        # so the contract is kept only if the account has this last transaction both before and after loading.
+        # The check isn't made for contracts which aren't requested again at the same last transaction.
+        keep = last_transaction_lt is not None and contracts.is_worth_keeping(address, last_transaction_lt)
+        keep = keep and await self._current_transaction_lt(address, wrapper) == last_transaction_lt
+        contract_id = await self._load_contract(address, wrapper)
+        keep = keep and await self._current_transaction_lt(address, wrapper) == last_transaction_lt
+        if keep:
+            evicted = contracts.add(address, last_transaction_lt, contract_id)
+        contracts.acquire(contract_id)
+        for evicted_id in evicted:
+            await self._forget_contract(evicted_id, wrapper)
+        return contract_id, keep
+
+    async def _release_contract(self, contract_id, kept, wrapper, contracts):
+        if contracts.release(contract_id) or not kept:
+            await self._forget_contract(contract_id, wrapper)
+
+    async def _current_transaction_lt(self, address, wrapper):
+        request = {
+            '@type': 'raw.getAccountState',
+            'account_address': {
+                'account_address': address
+            }
+        }
+        try:
+            result = await wrapper.execute(request)
+            return int(result['last_transaction_id']['lt'])
+        except Exception:
+            return None
+
+    async def _run_get_method(self, contract_id, method, stack_data, wrapper):
         stack_data = render_tvm_stack(stack_data)
         if isinstance(method, int):
             method = {'@type': 'smc.methodIdNumber', 'number': method}
         else:
             method = {'@type': 'smc.methodIdName', 'name': str(method)}
-        contract_id = await self._load_contract(address)
         request = {
             '@type': 'smc.runGetMethod',
             'id': contract_id,
             'method': method,
             'stack': stack_data
         }
-        r = await self.tonlib_wrapper.execute(request)
+        r = await wrapper.execute(request)
         if 'stack' in r:
             r['stack'] = serialize_tvm_stack(r['stack'])
         if '@type' in r and r['@type'] == 'smc.runResult':
@@ -466,7 +686,7 @@ class TonlibClient(multiprocessing.Process):
 
     async def raw_create_and_send_query(self, destination, body, init_code=b'', init_data=b''):
         query_info = await self._raw_create_query(destination, body, init_code, init_data)
-        return self._raw_send_query(query_info)
+        return await self._raw_send_query(query_info)
 
     async def raw_create_and_send_message(self, destination, body, initial_account_state=b''):
         # Very close to raw_create_and_send_query, but StateInit should be generated outside
@@ -532,6 +752,9 @@ class TonlibClient(multiprocessing.Process):
         assert master_seqno or lt or unixtime, "Seqno, LT or unixtime should be defined"
         wc, shard = -1, -9223372036854775808
         fullblock = await self.lookupBlock(wc, shard, master_seqno, lt, unixtime)
+        # lookupBlock isn't parsed inside passthrough method
+        if isinstance(fullblock, bytes):
+            fullblock = json.loads(fullblock)
         request = {
             '@type': 'blocks.getShards',
             'id': fullblock
@@ -602,6 +825,8 @@ class TonlibClient(multiprocessing.Process):
             }
         else:
             fullblock = await self.lookupBlock(workchain, shard, seqno)
+            if isinstance(fullblock, bytes):
+                fullblock = json.loads(fullblock)
             if fullblock.get('@type', 'error') == 'error':
                 return fullblock
         request = {
@@ -609,63 +834,3 @@ class TonlibClient(multiprocessing.Process):
             'id': fullblock
         }
         return await self.tonlib_wrapper.execute(request)
-
-    async def tryLocateTxByIncomingMessage(self, source, destination, creation_lt):
-        src = detect_address(source)
-        dest = detect_address(destination)
-        workchain = dest["raw_form"].split(":")[0]
-        shards = await self.getShards(lt=int(creation_lt))
-
-        for shard_data in shards['shards']:
-            shardchain = shard_data['shard']
-            for b in range(3):
-                block = await self.lookupBlock(workchain, shardchain, lt=int(creation_lt) + b*1000000)
-                txs = await self.getBlockTransactions(workchain, shardchain, block["seqno"], root_hash=block["root_hash"], file_hash=block["file_hash"])
-                candidate = None
-                count = 0
-                for tx in txs["transactions"]:
-                    if tx["account"] == dest["raw_form"]:
-                        count += 1
-                        if not candidate or candidate[1] < int(tx["lt"]):
-                            candidate = tx["hash"], int(tx["lt"])
-                if candidate:
-                    txses = await self.get_transactions(destination, from_transaction_lt=candidate[1], from_transaction_hash=b64str_to_hex(candidate[0]), limit=max(count, 10))
-                    for tx in txses:
-                        try:
-                            in_msg = tx["in_msg"]
-                            tx_source = in_msg["source"]
-                            if len(tx_source) and detect_address(tx_source)["raw_form"] == src["raw_form"]:
-                                if int(in_msg["created_lt"]) == int(creation_lt):
-                                    return tx
-                        except KeyError:
-                            pass
-        raise Exception("Tx not found")
-
-    async def tryLocateTxByOutcomingMessage(self, source, destination, creation_lt):
-        src = detect_address(source)
-        dest = detect_address(destination)
-        workchain = src["raw_form"].split(":")[0]
-        shards = await self.getShards(lt=int(creation_lt))
-
-        for shard_data in shards['shards']:
-            shardchain = shard_data['shard']
-            block = await self.lookupBlock(workchain, shardchain, lt=int(creation_lt))
-            txses = await self.getBlockTransactions(workchain, shardchain, block["seqno"], root_hash=block["root_hash"], file_hash=block["file_hash"])
-            candidate = None
-            count = 0
-            for tx in txses["transactions"]:
-                if tx["account"] == src["raw_form"]:
-                    count += 1
-                    if not candidate or candidate[1] < int(tx["lt"]):
-                        candidate = tx["hash"], int(tx["lt"])
-            if candidate:
-                txses = await self.get_transactions(source, from_transaction_lt=candidate[1], from_transaction_hash=b64str_to_hex(candidate[0]), limit=max(count, 10))
-                for tx in txses:
-                    try:
-                        for msg in tx["out_msgs"]:
-                            if detect_address(msg["destination"])["raw_form"] == dest["raw_form"]:
-                                if int(msg["created_lt"]) == int(creation_lt):
-                                    return tx
-                    except KeyError:
-                        pass
-        raise Exception("Tx not found")
@@ -0,0 +1,127 @@
+import abc
+import json
+import pickle
+
+from pyTON.utils import TonlibRawResult
+
+
+# First byte of encoded value tells whether it's tonlib's JSON stored as is or an encoded object.
+RAW_TAG = b'r'
+OBJECT_TAG = b'o'
+
+
+class Coder(abc.ABC):
+    """
+    Encodes cached values to bytes. Tonlib responses kept as JSON bytes (TonlibRawResult)
+    are stored as is, other values are encoded by subclass.
+    """
+    name = None
+
+    def encode(self, value):
+        if isinstance(value, TonlibRawResult):
+            return RAW_TAG + value
+        return OBJECT_TAG + self.dumps(value)
+
+    def decode(self, data):
+        if data[:1] == RAW_TAG:
+            return TonlibRawResult(data[1:])
+        return self.loads(memoryview(data)[1:])
+
+    @abc.abstractmethod
+    def dumps(self, value):
+        """
+        :return: bytes of encoded object
+        """
+
+    @abc.abstractmethod
+    def loads(self, data):
+        """
+        :param data: memoryview of bytes returned by dumps
+        """
+
+
+class PickleCoder(Coder):
+    name = 'pickle'
+
+    def dumps(self, value):
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JsonCoder(Coder):
+    """
+    Uses orjson if it's installed.
+    """
+    name = 'json'
+
+    def __init__(self):
+        try:
+            import orjson
+            self.dumps = orjson.dumps
+            self.loads = orjson.loads
+        except ImportError:
+            pass
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(bytes(data))
+
+
+class MsgpackCoder(Coder):
+    name = 'msgpack'
+
+    def __init__(self):
+        import msgpack
+        self.packb = msgpack.packb
+        self.unpackb = msgpack.unpackb
+
+    def dumps(self, value):
+        return self.packb(value)
+
+    def loads(self, data):
+        return self.unpackb(data, strict_map_key=False)
+
+
+class ZstdMsgpackCoder(MsgpackCoder):
+    """
+    msgpack compressed with zstd if encoded value is larger than threshold bytes.
+    """
+    name = 'zstd_msgpack'
+    COMPRESSED_TAG = b'z'
+
+    def __init__(self, threshold=4096, level=3):
+        super(ZstdMsgpackCoder, self).__init__()
+        import zstandard
+        self.threshold = threshold
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def encode(self, value):
+        data = super(ZstdMsgpackCoder, self).encode(value)
+        if len(data) > self.threshold:
+            return self.COMPRESSED_TAG + self.compressor.compress(data)
+        return data
+
+    def decode(self, data):
+        if data[:1] == self.COMPRESSED_TAG:
+            data = self.decompressor.decompress(memoryview(data)[1:])
+        return super(ZstdMsgpackCoder, self).decode(data)
+
+
+coders = {
+    'pickle': PickleCoder,
+    'json': JsonCoder,
+    'msgpack': MsgpackCoder,
+    'zstd_msgpack': ZstdMsgpackCoder,
+}
+
+
+def get_coder(name):
+    try:
+        return coders[name]()
+    except KeyError:
+        raise ValueError(f"Unknown cache coder: {name}")
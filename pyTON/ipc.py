@@ -0,0 +1,57 @@
+import struct
+import asyncio
+
+
+# Every frame starts with a fixed header: payload length, message type and message id.
+# Payload encoding is up to the sender and is identified by message type.
+FRAME_HEADER = struct.Struct('!IBQ')
+# Stream buffer size. Large buffer lets big responses be read with fewer wakeups.
+STREAM_LIMIT = 2 ** 22
+
+
+class FramedConnection:
+    """
+    Length-prefixed frames over asyncio stream (unix socket or socketpair).
+    """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        # Older asyncio doesn't allow concurrent drain() calls on the same writer.
+        self._drain_lock = asyncio.Lock()
+
+    @classmethod
+    async def open_unix(cls, path):
+        reader, writer = await asyncio.open_unix_connection(path, limit=STREAM_LIMIT)
+        return cls(reader, writer)
+
+    @classmethod
+    async def open_socket(cls, sock):
+        reader, writer = await asyncio.open_unix_connection(sock=sock, limit=STREAM_LIMIT)
+        return cls(reader, writer)
+
+    async def receive(self):
+        """
+        Read single frame.
+
+        :return: tuple (msg_type, msg_id, payload)
+        """
+        header = await self.reader.readexactly(FRAME_HEADER.size)
+        length, msg_type, msg_id = FRAME_HEADER.unpack(header)
+        payload = await self.reader.readexactly(length) if length else b''
+        return msg_type, msg_id, payload
+
+    async def send(self, msg_type: int, msg_id: int, payload: bytes=b''):
+        """
+        Write single frame. Payload is passed to the transport as is, without copying it into the header.
+        """
+        self.writer.write(FRAME_HEADER.pack(len(payload), msg_type, msg_id))
+        if payload:
+            self.writer.write(payload)
+        async with self._drain_lock:
+            await self.writer.drain()
+
+    def is_closing(self):
+        return self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
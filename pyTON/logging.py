@@ -2,7 +2,6 @@ from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from fastapi import Request, status
 from fastapi.responses import JSONResponse
-from starlette.responses import Response, StreamingResponse
 from starlette.types import Message
 
 from pymongo import MongoClient
@@ -56,44 +55,60 @@ def generic_http_exception_handler(exc):
     return JSONResponse(res.dict(exclude_none=True), status_code=res.code)
 
 class LoggerAndRateLimitMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, endpoints, temp_disable_ratelimit=False):
+    def __init__(self, app, endpoints, batch_endpoints=None, temp_disable_ratelimit=False):
+        """
+        :param batch_endpoints: endpoints charged for every item of the batch, endpoint -> name of parameter with items
+        """
         super().__init__(app)
 
         self.temp_disable_ratelimit = temp_disable_ratelimit
 
         if settings.ratelimit.enabled:
             self.endpoints = endpoints
+            self.batch_endpoints = batch_endpoints or {}
             self.rate_limit_storage = RedisStorage(f"redis://{settings.ratelimit.redis.endpoint}:{settings.ratelimit.redis.port}")
             self.fixed_window = FixedWindowRateLimiter(self.rate_limit_storage)
 
     # Workaround for https://github.com/tiangolo/fastapi/issues/394#issuecomment-927272627
     async def set_body(self, request: Request):
-        receive_ = await request._receive()
-
+        body = b''
+        more_body = True
+        while more_body:
+            message = await request._receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        request._body = body
+        # Newer starlette gives the body read by middleware to the app by itself
+        if hasattr(request, 'wrapped_receive'):
+            return
+        original_receive = request._receive
+        body_received = False
+
+        # Body is given to the app once, then it gets messages of the connection,
+        # e.g. StreamingResponse waits for disconnect.
         async def receive() -> Message:
-            return receive_
+            nonlocal body_received
+            if body_received:
+                return await original_receive()
+            body_received = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
 
         request._receive = receive
 
-    async def rate_limit_and_call(self, request: Request, call_next):
-        if not settings.ratelimit.enabled or self.temp_disable_ratelimit:
-            return await call_next(request)
-
-        path_comps = list(filter(None, request.url.path.split('/')))
-        if len(path_comps) == 0:
-            return await call_next(request)
-        endpoint = path_comps[-1]
-        if endpoint == 'jsonRPC':
-            body = await request.json()
-            endpoint = body.get('method')
-
-        if endpoint not in self.endpoints:
-            return await call_next(request)
-
-        keys = api_key_from_request(request)
-        if not isinstance(keys, list):
-            keys = [keys]
-
+    def request_cost(self, endpoint, params):
+        """
+        :return: number of rate limit hits taken by the request
+        """
+        param = self.batch_endpoints.get(endpoint)
+        if param is None or not isinstance(params, dict):
+            return 1
+        items = params.get(param)
+        return max(1, len(items)) if isinstance(items, list) else 1
+
+    async def hit_limits(self, endpoint, keys, cost=1):
+        """
+        :return: limit which is exceeded or None
+        """
         failed_limit = None
         for key in keys:
             # Per method limits
@@ -105,7 +120,7 @@ class LoggerAndRateLimitMiddleware(BaseHTTPMiddleware):
 
             for limit in per_method_limits_:
                 identifiers = [endpoint, key]
-                if not await self.fixed_window.hit(limit, *identifiers):
+                if not await self.fixed_window.hit(limit, *identifiers, cost=cost):
                     failed_limit = limit
                     break
             if failed_limit:
@@ -120,12 +135,55 @@ class LoggerAndRateLimitMiddleware(BaseHTTPMiddleware):
 
             for limit in total_limits_:
                 identifiers = [key]
-                if not await self.fixed_window.hit(limit, *identifiers):
+                if not await self.fixed_window.hit(limit, *identifiers, cost=cost):
                     failed_limit = limit
                     break
             if failed_limit:
                 break
+        return failed_limit
+
+    async def rate_limit_and_call(self, request: Request, call_next):
+        if not settings.ratelimit.enabled or self.temp_disable_ratelimit:
+            return await call_next(request)
 
+        path_comps = list(filter(None, request.url.path.split('/')))
+        if len(path_comps) == 0:
+            return await call_next(request)
+        endpoint = path_comps[-1]
+
+        def request_keys():
+            keys = api_key_from_request(request)
+            return keys if isinstance(keys, list) else [keys]
+
+        params = None
+        if endpoint == 'jsonRPC':
+            body = await request.json()
+            if isinstance(body, list):
+                # Every call of a batch is limited on its own, calls over the limit get errors in the batch response.
+                rate_limited = {}
+                keys = None
+                for i, call in enumerate(body):
+                    method = call.get('method') if isinstance(call, dict) else None
+                    if method in self.endpoints:
+                        keys = keys or request_keys()
+                        failed_limit = await self.hit_limits(method, keys, self.request_cost(method, call.get('params')))
+                        if failed_limit:
+                            rate_limited[i] = f"Rate limit exceeded: {failed_limit}"
+                request.state.rate_limited = rate_limited
+                return await call_next(request)
+            endpoint = body.get('method')
+            params = body.get('params')
+        elif endpoint in self.batch_endpoints:
+            try:
+                params = await request.json()
+            except ValueError:
+                # invalid body is rejected by the endpoint
+                pass
+
+        if endpoint not in self.endpoints:
+            return await call_next(request)
+
+        failed_limit = await self.hit_limits(endpoint, request_keys(), self.request_cost(endpoint, params))
         if failed_limit:
             res = TonResponse(ok=False, error=f"Rate limit exceeded: {failed_limit}", code=429)
             return JSONResponse(res.dict(exclude_none=True), status_code=res.code)
@@ -140,25 +198,42 @@ class LoggerAndRateLimitMiddleware(BaseHTTPMiddleware):
 
         response = await call_next(request)
 
-        if isinstance(response, StreamingResponse):
-            response_headers = dict(response.headers.items())
-            response_body = b''
-            async for chunk in response.body_iterator:
-                response_body += chunk
-            response = Response(
-                content=response_body,
-                status_code=response.status_code,
-                headers=dict(response.headers),
-                media_type=response.media_type
-            )
+        request_body = await request.body()
 
-        end = datetime.utcnow()
-        elapsed = (end - start).total_seconds()
+        if not hasattr(response, 'body_iterator'):
+            # response made by middleware itself, e.g. rate limit error
+            self.log_request(request, request_body, response, start, len(response.body), response.body)
+            return response
 
-        # Log only error response body
-        response_body = response.body if response.status_code != 200 else None
+        # Body is passed on as it's produced, so streaming responses aren't buffered.
+        # Only body of error response is kept for the log.
+        body_iterator = response.body_iterator
 
-        request_body = await request.body()
+        async def logged_body_iterator():
+            size = 0
+            error_body = b'' if response.status_code != status.HTTP_200_OK else None
+            try:
+                async for chunk in body_iterator:
+                    size += len(chunk)
+                    if error_body is not None:
+                        error_body += chunk
+                    yield chunk
+            finally:
+                # response is already being sent, failed logging can't change it
+                try:
+                    self.log_request(request, request_body, response, start, size, error_body)
+                except Exception as e:
+                    logger.error(f"Failed to log request: {e}")
+
+        response.body_iterator = logged_body_iterator()
+        return response
+
+    def log_request(self, request, request_body, response, start, response_size, response_body):
+        """
+        :param response_body: body of error response, None for successful one
+        """
+        end = datetime.utcnow()
+        elapsed = (end - start).total_seconds()
 
         # full record in case of error
         if settings.logs.successful_requests or response.status_code != status.HTTP_200_OK:
@@ -176,6 +251,7 @@ class LoggerAndRateLimitMiddleware(BaseHTTPMiddleware):
                 'response': {
                     'status_code': response.status_code,
                     'headers': response.headers,
+                    'size': response_size,
                     'body': response_body
                 }
             }
@@ -187,7 +263,10 @@ class LoggerAndRateLimitMiddleware(BaseHTTPMiddleware):
         if url.endswith('jsonRPC'):
             try:
                 body_dict = loads(request_body)
-                url += f'?method={body_dict["method"]}'
+                if isinstance(body_dict, list):
+                    url += '?method=batch'
+                else:
+                    url += f'?method={body_dict["method"]}'
             except Exception as ee:
                 logger.critical(ee)
         stat_record = {
@@ -203,8 +282,6 @@ class LoggerAndRateLimitMiddleware(BaseHTTPMiddleware):
 
         mongo_client[mongo_db].request_stats.insert_one(stat_record)
 
-        return response
-
     async def dispatch(self, request: Request, call_next):
         await self.set_body(request)
         body = await request.body()
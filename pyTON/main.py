@@ -21,7 +21,7 @@ from fastapi import FastAPI, APIRouter, Depends, Security, Response, Request
 from fastapi.params import Body, Query, Param
 from fastapi.exceptions import HTTPException, RequestValidationError
 from starlette.exceptions import HTTPException as StarletteHTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi import status
 from datetime import datetime, timedelta
 from bson import ObjectId
@@ -29,13 +29,15 @@ from pymongo import MongoClient
 
 from tvm_valuetypes.cell import deserialize_cell_from_object
 
-from pyTON.models import TonResponse, TonResponseJsonRPC, TonRequestJsonRPC
+from pyTON.models import TonResponse, TonResponseJsonRPC, TonRequestJsonRPC, TonRawResponse, RunGetMethodCall
 from config import settings
 from pyTON.logging import LoggerAndRateLimitMiddleware, generic_exception_handler, generic_http_exception_handler
 from pyTON.multiclient import TonlibMultiClient as TonlibClient
+from pyTON.pool import TonlibPoolClient
+from pyTON.cache import cache
 from pyTON.address_utils import detect_address as __detect_address, prepare_address as _prepare_address
 from pyTON.wallet_utils import wallets as known_wallets, sha256
-from pyTON.utils import TonLibWrongResult
+from pyTON.utils import TonLibWrongResult, TonlibRawResult
 from pyTON.api_key_manager import api_key_manager, check_api_key
 
 from loguru import logger
@@ -107,25 +109,32 @@ def startup():
 
     loop = asyncio.get_event_loop()
 
-    try:
-        with open(settings.pyton.liteserver_config, "r") as f:
-            lite_server_config = json.loads(f.read())
-    except Exception as e:
-        logger.error(f"Can't read provided lite_server_config: {str(e)}")
-        raise
-
-    keystore = settings.pyton.keystore
-    if not os.path.exists(keystore):
-        os.makedirs(keystore)
-
-    # setup tonlib multiclient
     global tonlib
-    tonlib = TonlibClient(loop, 
-                          lite_server_config, 
-                          keystore=keystore, 
-                          cdll_path=settings.pyton.cdll)
+    if settings.pyton.shared_pool.enabled:
+        # liteserver clients are run by the pool started in gunicorn master (see gunicorn.conf.py)
+        tonlib = TonlibPoolClient(loop, settings.pyton.shared_pool.socket)
+    else:
+        try:
+            with open(settings.pyton.liteserver_config, "r") as f:
+                lite_server_config = json.loads(f.read())
+        except Exception as e:
+            logger.error(f"Can't read provided lite_server_config: {str(e)}")
+            raise
+
+        keystore = settings.pyton.keystore
+        if not os.path.exists(keystore):
+            os.makedirs(keystore)
+
+        # setup tonlib multiclient
+        tonlib = TonlibClient(loop, 
+                              lite_server_config, 
+                              keystore=keystore, 
+                              cdll_path=settings.pyton.cdll)
     tonlib.init_tonlib()
 
+    if cache is not None:
+        asyncio.ensure_future(cache.report_stats(), loop=loop)
+
     # setup mongo_database
     if settings.logs.enabled == True:
         with open(settings.logs.mongodb['password_file'], 'r') as f:
@@ -182,10 +191,32 @@ def address_state(account_info):
             return "frozen"
     return "active"
 
+def address_information(account_info):
+    account_info["state"] = address_state(account_info)
+    if "balance" in account_info and int(account_info["balance"]) < 0:
+        account_info["balance"] = 0
+    return account_info
+
+def error_response(exc):
+    """
+    Response with the same error as exception handlers of the app give, for results of batches.
+    """
+    if isinstance(exc, StarletteHTTPException):
+        error, code = str(exc.detail), exc.status_code
+    elif isinstance(exc, asyncio.TimeoutError):
+        error, code = "Liteserver timeout", status.HTTP_504_GATEWAY_TIMEOUT
+    elif isinstance(exc, TonLibWrongResult):
+        error, code = str(exc), status.HTTP_500_INTERNAL_SERVER_ERROR
+    else:
+        error, code = str(exc), status.HTTP_503_SERVICE_UNAVAILABLE
+    return TonResponse(ok=False, error=error, code=code)
+
 def wrap_result(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
         result = await asyncio.wait_for(func(*args, **kwargs), settings.pyton.request_timeout)
+        if isinstance(result, TonlibRawResult):
+            return TonRawResponse(result)
         return TonResponse(ok=True, result=result)
     return wrapper
 
@@ -193,24 +224,35 @@ json_rpc_methods = {}
 
 def json_rpc(method):
     def g(func):
+        # Parameters are inspected once, calls only fill defaults and coerce values.
+        defaults = {}
+        required = set()
+        int_params = []
+        for k, v in inspect.signature(func).parameters.items():
+            if v.default is not inspect._empty:
+                default_val = v.default
+
+                if isinstance(default_val, Param) or isinstance(default_val, Body):
+                    if default_val.default == ...:
+                        required.add(k)
+                    else:
+                        defaults[k] = default_val.default
+                else:
+                    defaults[k] = default_val
+
+            # Some values (e.g. lt, shard) don't fit in json int and can be sent as str.
+            if v.annotation is int or v.annotation is Optional[int]:
+                int_params.append(k)
+
         @wraps(func)
         def f(**kwargs):
-            sig = inspect.signature(func)
-            for k, v in sig.parameters.items():
-                # Add function's default value parameters to kwargs.
-                if k not in kwargs and v.default is not inspect._empty:
-                    default_val = v.default
-                    
-                    if isinstance(default_val, Param) or isinstance(default_val, Body):
-                        if default_val.default == ...:
-                            raise TypeError("Non-optional argument expected")
-                        kwargs[k] = default_val.default
-                    else:
-                        kwargs[k] = default_val
+            if not required <= kwargs.keys():
+                raise TypeError("Non-optional argument expected")
+            kwargs = {**defaults, **kwargs}
 
-                # Some values (e.g. lt, shard) don't fit in json int and can be sent as str.
-                # Coerce such str to int.
-                if (v.annotation is int or v.annotation is Optional[int]) and type(kwargs[k]) is str:
+            # Coerce such str to int.
+            for k in int_params:
+                if type(kwargs.get(k)) is str:
                     try:
                         kwargs[k] = int(kwargs[k])
                     except ValueError:
@@ -218,6 +260,7 @@ def json_rpc(method):
 
             return func(**kwargs)
 
+        f.takes_request = 'request' in inspect.signature(func).parameters
         json_rpc_methods[method] = f
         return func
     return g
@@ -236,10 +279,35 @@ async def get_address_information(
     """
     address = prepare_address(address)
     result = await tonlib.raw_get_account_state(address)
-    result["state"] = address_state(result)
-    if "balance" in result and int(result["balance"]) < 0:
-        result["balance"] = 0
-    return result
+    return address_information(result)
+
+@app.post('/getAddressInformationBatch', response_model=TonResponse, response_model_exclude_none=True, tags=['accounts'])
+@json_rpc('getAddressInformationBatch')
+@wrap_result
+async def get_address_information_batch(
+    addresses: List[str] = Body(..., embed=True, description="Identifiers of target TON accounts in any form.")
+    ):
+    """
+    Get basic information about several addresses like *getAddressInformation*. Result maps every given address to a response with either *result* or *error*.
+    """
+    if len(addresses) > settings.pyton.account_states_batch.max_size:
+        raise HTTPException(status_code=400, detail=f"At most {settings.pyton.account_states_batch.max_size} addresses are allowed")
+
+    responses = {}
+    prepared = {}
+    for address in addresses:
+        try:
+            prepared[address] = prepare_address(address)
+        except HTTPException as e:
+            responses[address] = error_response(e)
+    states = await tonlib.raw_get_account_states(list(set(prepared.values())))
+    for address, prepared_address in prepared.items():
+        state = states[prepared_address]
+        if isinstance(state, Exception):
+            responses[address] = error_response(state)
+        else:
+            responses[address] = TonResponse(ok=True, result=address_information(dict(state)))
+    return {address: response.dict(exclude_none=True) for address, response in responses.items()}
 
 @app.get('/getExtendedAddressInformation', response_model=TonResponse, response_model_exclude_none=True, tags=['accounts'])
 @json_rpc('getExtendedAddressInformation')
@@ -251,8 +319,7 @@ async def get_extended_address_information(
     Similar to previous one but tries to parse additional information for known contract types. This method is based on tonlib's function *getAccountState*. For detecting wallets we recommend to use *getWalletInformation*.
     """
     address = prepare_address(address)
-    result = await tonlib.generic_get_account_state(address)
-    return result
+    return await tonlib.generic_get_account_state(address, raw=True)
 
 @app.get('/getWalletInformation', response_model=TonResponse, response_model_exclude_none=True, tags=['accounts'])
 @json_rpc('getWalletInformation')
@@ -376,7 +443,7 @@ async def lookup_block(
     """
     Look up block by either *seqno*, *lt* or *unixtime*.
     """
-    return await tonlib.lookupBlock(workchain, shard, seqno, lt, unixtime)
+    return await tonlib.lookupBlock(workchain, shard, seqno, lt, unixtime, raw=True)
 
 @app.get('/shards', response_model=TonResponse, response_model_exclude_none=True, tags=['blocks'])
 @json_rpc('shards')
@@ -387,7 +454,7 @@ async def shards(
     """
     Get shards information.
     """
-    return await tonlib.getShards(seqno)
+    return await tonlib.getShards(seqno, raw=True)
 
 @app.get('/getBlockTransactions', response_model=TonResponse, response_model_exclude_none=True, tags=['blocks','transactions'])
 @json_rpc('getBlockTransactions')
@@ -407,6 +474,50 @@ async def get_block_transactions(
     """
     return await tonlib.getBlockTransactions(workchain, shard, seqno, count, root_hash, file_hash, after_lt, after_hash)
 
+@app.get('/getBlockTransactionsStream', response_model=TonResponse, response_model_exclude_none=True, tags=['blocks','transactions'])
+async def get_block_transactions_stream(
+    workchain: int, 
+    shard: int, 
+    seqno: int, 
+    root_hash: Optional[str] = None, 
+    file_hash: Optional[str] = None, 
+    after_lt: Optional[int] = None, 
+    after_hash: Optional[str] = None, 
+    count: int = 40
+    ):
+    """
+    Get transactions of the given block like *getBlockTransactions*, but send them in chunks as they are received from liteservers.
+    """
+    fullblock = await asyncio.wait_for(tonlib.get_full_block_id(workchain, shard, seqno, root_hash, file_hash), settings.pyton.request_timeout)
+    if fullblock.get('@type', 'error') == 'error':
+        raise TonLibWrongResult('Can\'t lookup block', fullblock)
+    pages = tonlib.iter_block_transactions(fullblock, count, after_lt, after_hash)
+    # errors of the first page are returned with the status code, later ones can only break the response
+    try:
+        first_page = await asyncio.wait_for(pages.__anext__(), settings.pyton.request_timeout)
+    except BaseException:
+        await pages.aclose()
+        raise
+
+    async def content():
+        try:
+            header = {k: v for k, v in first_page.items() if k not in ('transactions', 'incomplete')}
+            yield json.dumps({"ok": True, "result": header})[:-2] + ',"transactions":['
+            yield json.dumps(first_page["transactions"])[1:-1]
+            has_transactions = bool(first_page["transactions"])
+            async for page in pages:
+                if page["transactions"]:
+                    yield (',' if has_transactions else '') + json.dumps(page["transactions"])[1:-1]
+                    has_transactions = True
+            yield '],"incomplete":false}}'
+        except Exception as e:
+            logger.warning(f"getBlockTransactionsStream failed after response started: {e}")
+            raise
+        finally:
+            await pages.aclose()
+
+    return StreamingResponse(content(), media_type='application/json')
+
 @app.get('/getBlockHeader', response_model=TonResponse, response_model_exclude_none=True, tags=['blocks'])
 @json_rpc('getBlockHeader')
 @wrap_result
@@ -420,7 +531,7 @@ async def get_block_header(
     """
     Get metadata of a given block.
     """
-    return await tonlib.getBlockHeader(workchain, shard, seqno, root_hash, file_hash)
+    return await tonlib.getBlockHeader(workchain, shard, seqno, root_hash, file_hash, raw=True)
 
 @app.get('/tryLocateTx', response_model=TonResponse, response_model_exclude_none=True, tags=['transactions'])
 @json_rpc('tryLocateTx')
@@ -602,36 +713,140 @@ if settings.pyton.get_methods:
         address = prepare_address(address)
         return await tonlib.raw_run_method(address, method, stack)
 
+    @app.post('/runGetMethodBatch', response_model=TonResponse, response_model_exclude_none=True, tags=["run method"])
+    @json_rpc('runGetMethodBatch')
+    @wrap_result
+    async def run_get_method_batch(
+        calls: List[RunGetMethodCall] = Body(..., embed=True, description="Array of get method calls: `[{'address': ..., 'method': ..., 'stack': [...]}]`")
+        ):
+        """
+        Run several get methods, possibly of different smart contracts. Result is an array of responses in the order of calls, every one either with *result* or with *error*.
+        """
+        try:
+            calls = [RunGetMethodCall.parse_obj(c) if isinstance(c, dict) else c for c in calls]
+        except ValidationError as e:
+            raise TypeError(f"Can't parse calls: {e}")
+        if len(calls) > settings.pyton.run_methods_batch.max_calls:
+            raise HTTPException(status_code=400, detail=f"At most {settings.pyton.run_methods_batch.max_calls} calls are allowed")
+
+        responses = [None] * len(calls)
+        valid = []
+        for i, call in enumerate(calls):
+            try:
+                valid.append((i, (prepare_address(call.address), call.method, call.stack)))
+            except HTTPException as e:
+                responses[i] = TonResponse(ok=False, error=e.detail, code=e.status_code)
+        results = await tonlib.raw_run_methods([call for _, call in valid])
+        for (i, _), result in zip(valid, results):
+            if result.get('@type') == 'error':
+                responses[i] = TonResponse(ok=False, error=result.get('message'), code=result.get('code'))
+            else:
+                responses[i] = TonResponse(ok=True, result=result)
+        return [r.dict(exclude_none=True) for r in responses]
+
 
 if settings.pyton.json_rpc:
-    @app.post('/jsonRPC', response_model=TonResponseJsonRPC, response_model_exclude_none=True, tags=['json rpc'])
-    async def jsonrpc_handler(json_rpc: TonRequestJsonRPC, request: Request, response: Response):
+    async def call_json_rpc(json_rpc: TonRequestJsonRPC, request: Request):
         """
-        All methods in the API are available through JSON-RPC protocol ([spec](https://www.jsonrpc.org/specification)). 
+        :return: response and its status code
         """
         params = json_rpc.params
         method = json_rpc.method
         _id = json_rpc.id
 
         if not method in json_rpc_methods:
-            response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
-            return TonResponseJsonRPC(ok=False, error='Unknown method', id=_id)
+            return TonResponseJsonRPC(ok=False, error='Unknown method', id=_id), status.HTTP_422_UNPROCESSABLE_ENTITY
         handler = json_rpc_methods[method]
 
         try:
-            if 'request' in inspect.signature(handler).parameters.keys():
+            if handler.takes_request:
                 result = await handler(request=request, **params)
             else:
                 result = await handler(**params)
 
         except TypeError as e:
-            response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
-            return TonResponseJsonRPC(ok=False, error=f'TypeError: {e}', id=_id)
-        
-        return TonResponseJsonRPC(ok=result.ok, result=result.result, error=result.error, code=result.code, id=_id)
+            return TonResponseJsonRPC(ok=False, error=f'TypeError: {e}', id=_id), status.HTTP_422_UNPROCESSABLE_ENTITY
+
+        if isinstance(result, TonRawResponse):
+            return TonRawResponse(result.result, jsonrpc="2.0", id=_id), status.HTTP_200_OK
+        return TonResponseJsonRPC(ok=result.ok, result=result.result, error=result.error, code=result.code, id=_id), status.HTTP_200_OK
+
+    def parse_json_rpc(call):
+        """
+        :return: parsed call or error response to invalid one
+        """
+        try:
+            return TonRequestJsonRPC.parse_obj(call)
+        except ValidationError as e:
+            _id = call.get('id') if isinstance(call, dict) else None
+            if not isinstance(_id, (int, str)) or isinstance(_id, bool):
+                _id = None
+            return TonResponseJsonRPC(ok=False, error=f'Invalid Request: {e}', code=-32600, id=_id)
+
+    async def jsonrpc_batch(calls: List[Any], request: Request):
+        batch_settings = settings.pyton.json_rpc_batch
+        if not calls or len(calls) > batch_settings.max_size:
+            res = TonResponseJsonRPC(ok=False, error=f'Batch should have from 1 to {batch_settings.max_size} calls', code=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            return JSONResponse(res.dict(exclude_none=True), status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        # calls are validated one by one, invalid call gets an error in the batch response
+        calls = [parse_json_rpc(call) for call in calls]
+        # calls over rate limit are marked by LoggerAndRateLimitMiddleware
+        rate_limited = getattr(request.state, 'rate_limited', {})
+        semaphore = asyncio.Semaphore(batch_settings.concurrency)
+
+        async def call(json_rpc):
+            async with semaphore:
+                try:
+                    result, _ = await call_json_rpc(json_rpc, request)
+                    return result
+                except Exception as e:
+                    res = error_response(e)
+                    return TonResponseJsonRPC(ok=False, error=res.error, code=res.code, id=json_rpc.id)
+
+        def call_key(json_rpc):
+            return json_rpc.method, json.dumps(json_rpc.params, sort_keys=True, default=str)
+
+        # identical calls are made once
+        tasks = {}
+        for i, json_rpc in enumerate(calls):
+            if isinstance(json_rpc, TonResponseJsonRPC):
+                continue
+            key = call_key(json_rpc)
+            if i not in rate_limited and key not in tasks:
+                tasks[key] = asyncio.ensure_future(call(json_rpc))
+        await asyncio.gather(*tasks.values())
+
+        items = []
+        for i, json_rpc in enumerate(calls):
+            _id = json_rpc.id
+            if isinstance(json_rpc, TonResponseJsonRPC):
+                item = json_rpc
+            elif i in rate_limited:
+                item = TonResponseJsonRPC(ok=False, error=rate_limited[i], code=status.HTTP_429_TOO_MANY_REQUESTS, id=_id)
+            else:
+                item = tasks[call_key(json_rpc)].result()
+            if isinstance(item, TonRawResponse):
+                items.append(TonRawResponse(item.result, jsonrpc="2.0", id=_id).body)
+            else:
+                items.append(item.copy(update={'id': _id}).json(exclude_none=True).encode('utf-8'))
+        return Response(b'[' + b','.join(items) + b']', media_type='application/json')
+
+    @app.post('/jsonRPC', response_model=TonResponseJsonRPC, response_model_exclude_none=True, tags=['json rpc'])
+    async def jsonrpc_handler(json_rpc: Union[TonRequestJsonRPC, List[Any]], request: Request, response: Response):
+        """
+        All methods in the API are available through JSON-RPC protocol ([spec](https://www.jsonrpc.org/specification)). 
+        Batch of calls can be sent as an array, calls are made concurrently and responses are returned in the same order.
+        """
+        if isinstance(json_rpc, list):
+            return await jsonrpc_batch(json_rpc, request)
+        result, status_code = await call_json_rpc(json_rpc, request)
+        response.status_code = status_code
+        return result
 
 
 app.add_middleware(
     LoggerAndRateLimitMiddleware,
-    endpoints=json_rpc_methods.keys()
+    endpoints=json_rpc_methods.keys(),
+    batch_endpoints={'runGetMethodBatch': 'calls', 'getAddressInformationBatch': 'addresses'}
 )
\ No newline at end of file
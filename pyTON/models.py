@@ -1,5 +1,8 @@
+import json
+
 from typing import Optional, Union, Dict, Any, List
-from pydantic import BaseModel
+from pydantic import BaseModel, StrictInt, StrictStr
+from starlette.responses import Response
 
 
 class TonResponse(BaseModel):
@@ -9,13 +12,39 @@ class TonResponse(BaseModel):
     code: Optional[int] = None
 
 
+# JSON-RPC id is echoed back as is, strict types keep it from being converted
+JsonRPCId = Union[StrictInt, StrictStr, None]
+
+
 class TonResponseJsonRPC(TonResponse):
     jsonrpc: str = "2.0"
-    id: Optional[str] = None
+    id: JsonRPCId = None
+
+
+class RunGetMethodCall(BaseModel):
+    address: str
+    method: Union[str, int]
+    stack: List[List[Any]] = []
 
 
 class TonRequestJsonRPC(BaseModel):
     method: str
     params: dict = {}
-    id: Optional[str] = None
+    id: JsonRPCId = None
     jsonrpc: Optional[str] = None
+
+
+class TonRawResponse(Response):
+    """
+    Successful TonResponse with tonlib's JSON spliced into result as is.
+    Extra fields (e.g. JSON-RPC id) are appended unless they are None.
+    """
+    media_type = "application/json"
+
+    def __init__(self, result: bytes, **fields):
+        self.result = result
+        content = b'{"ok":true,"result":' + result
+        for name, value in fields.items():
+            if value is not None:
+                content += b',' + json.dumps(name).encode('utf-8') + b':' + json.dumps(value).encode('utf-8')
+        super().__init__(content + b'}')
@@ -4,18 +4,23 @@ import asyncio
 import copy
 import time
 import codecs
+import json
+import pickle
 import traceback
 
 from datetime import datetime
+from collections import defaultdict
 from pathlib import Path
 
-import aioprocessing
-
 from config import settings
-from pyTON.utils import TonLibWrongResult, b64str_to_hex, hash_to_hex
+from pyTON.utils import TonLibWrongResult, TonlibRawResult, ExpiringFutures, b64str_to_hex, b64str_to_bytes, hash_to_hex, \
+    tonlib_error, is_retryable_error, is_retryable_exception, is_error_response, response_type
 from pyTON.logging import to_mongodb
-from pyTON.cache import redis_cached
+from pyTON.cache import redis_cached, immutable_key, get_immutable, set_immutable
 from pyTON.client import TonlibClient, TonlibClientResult, MsgType
+from pyTON.ipc import FramedConnection
+from pyTON.address_utils import detect_address
+from pyTON.balancer import ClientStats, CircuitBreaker, HedgingBudget, get_strategy
 from tvm_valuetypes import deserialize_boc
 
 from loguru import logger
@@ -26,11 +31,18 @@ def current_function_name():
 
 @to_mongodb('liteserver_tasks')
 def log_liteserver_task(task_result: TonlibClientResult):
-    res_type = task_result.result.get('@type', 'unknown') if task_result.result else 'error'
+    result = task_result.result
+    if isinstance(result, bytes):
+        # tonlib response is parsed only if it goes to details
+        res_type = response_type(result)
+        if res_type == 'error' or res_type == 'unknown':
+            result = json.loads(result)
+    else:
+        res_type = result.get('@type', 'unknown') if result else 'error'
     details = {}
     if res_type == 'error' or res_type == 'unknown':
         details['params'] = task_result.params
-        details['result'] = task_result.result
+        details['result'] = result
         details['exception'] = str(task_result.exception)
     
     return {
@@ -44,11 +56,118 @@ def log_liteserver_task(task_result: TonlibClientResult):
     }
 
 
+def is_final_block(self, workchain, seqno, root_hash=None, file_hash=None, **kwargs):
+    """
+    Block is identified by its hashes or it's a masterchain block not newer than consensus block.
+    """
+    return bool(root_hash and file_hash) or (workchain == -1 and seqno <= self.current_consensus_block)
+
+
+def format_transaction_messages(t):
+    try:
+        if "in_msg" in t:
+            if "source" in t["in_msg"]:
+                t["in_msg"]["source"] = t["in_msg"]["source"]["account_address"]
+            if "destination" in t["in_msg"]:
+                t["in_msg"]["destination"] = t["in_msg"]["destination"]["account_address"]
+            try:
+                if "msg_data" in t["in_msg"]:
+                    dcd = ""
+                    if t["in_msg"]["msg_data"]["@type"] == "msg.dataRaw":
+                        msg_cell_boc = codecs.decode(codecs.encode(t["in_msg"]["msg_data"]["body"], 'utf8'), 'base64')
+                        message_cell = deserialize_boc(msg_cell_boc)
+                        dcd = message_cell.data.data.tobytes()
+                        t["in_msg"]["message"] = codecs.decode(codecs.encode(dcd, 'base64'), "utf8")
+                    elif t["in_msg"]["msg_data"]["@type"] == "msg.dataText":
+                        dcd = codecs.encode(t["in_msg"]["msg_data"]["text"], 'utf8')
+                        t["in_msg"]["message"] = codecs.decode(codecs.decode(dcd, 'base64'), "utf8")
+            except Exception as e:
+                t["in_msg"]["message"] = ""
+                print(e)
+        if "out_msgs" in t:
+            for o in t["out_msgs"]:
+                if "source" in o:
+                    o["source"] = o["source"]["account_address"]
+                if "destination" in o:
+                    o["destination"] = o["destination"]["account_address"]
+                try:
+                    if "msg_data" in o:
+                        dcd = ""
+                        if o["msg_data"]["@type"] == "msg.dataRaw":
+                            msg_cell_boc = codecs.decode(codecs.encode(o["msg_data"]["body"], 'utf8'), 'base64')
+                            message_cell = deserialize_boc(msg_cell_boc)
+                            dcd = message_cell.data.data.tobytes()
+                            o["message"] = codecs.decode(codecs.encode(dcd, 'base64'), "utf8")
+                        elif o["msg_data"]["@type"] == "msg.dataText":
+                            dcd = codecs.encode(o["msg_data"]["text"], 'utf8')
+                            o["message"] = codecs.decode(codecs.decode(dcd, 'base64'), "utf8")
+                except Exception as e:
+                    o["message"] = ""
+    except Exception as e:
+        print("getTransaction exception", e)
+
+
+async def prefetched(pages, prefetch):
+    """
+    Iterate async generator of pages fetching up to prefetch pages ahead in background.
+    """
+    if not prefetch:
+        async for page in pages:
+            yield page
+        return
+
+    queue = asyncio.Queue(maxsize=prefetch)
+
+    async def fetch_pages():
+        try:
+            async for page in pages:
+                await queue.put(page)
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+
+    task = asyncio.ensure_future(fetch_pages())
+    try:
+        while True:
+            page = await queue.get()
+            if page is None:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        task.cancel()
+
+
+def convert_block_accounts(workchain, transactions):
+    """
+    Convert accounts of block transactions from base64 to raw form, decoding all of them in one pass.
+    """
+    try:
+        accounts = b''.join([b64str_to_bytes(tx["account"]) for tx in transactions]).hex()
+    except Exception:
+        accounts = None
+    if accounts is None or len(accounts) != 64 * len(transactions):
+        for tx in transactions:
+            try:
+                tx["account"] = "%d:%s" % (workchain, b64str_to_hex(tx["account"]))
+            except:
+                pass
+        return
+    for i, tx in enumerate(transactions):
+        tx["account"] = "%d:%s" % (workchain, accounts[64 * i:64 * (i + 1)])
+
+
 class TonlibMultiClient:
     def __init__(self, loop, config, keystore, cdll_path=None):
         self.loop = loop
         self.config = config
-        self.futures = {}
+        self.futures = ExpiringFutures(loop)
+        self.choose_client = get_strategy(settings.pyton.balancing_strategy)
+        hedging = settings.pyton.hedging
+        self.hedging_budgets = {method: HedgingBudget(ratio, hedging.burst) for method, ratio in hedging.methods.items()}
+        # per method counters of hedged requests since the last report
+        self.hedging_stats = defaultdict(lambda: {'requests': 0, 'hedged': 0, 'hedge_won': 0})
         self.keystore = keystore
         self.cdll_path = cdll_path
         self.current_consensus_block = 0
@@ -60,58 +179,63 @@ class TonlibMultiClient:
         '''
         self.all_clients = []
         self.read_output_tasks = []
-        for i, ls in enumerate(self.config["liteservers"]):
-            c = copy.deepcopy(self.config)
-            c["liteservers"] = [ls]
-            keystore = self.keystore + str(i)
-
-            Path(keystore).mkdir(parents=True, exist_ok=True)
-
-            client = TonlibClient(aioprocessing.AioQueue(), aioprocessing.AioQueue(), c, keystore=keystore, cdll_path=self.cdll_path)
-
-            client.number = i
-            client.is_working = False
-            client.is_archival = False
-
-            client.start()
-
+        for i in range(len(self.config["liteservers"])):
+            client = self.start_client(i)
             self.all_clients.append(client)
             self.read_output_tasks.append(asyncio.ensure_future(self.read_output(client), loop=self.loop))
 
         self.check_working_task = asyncio.ensure_future(self.check_working(), loop=self.loop)
         self.check_children_alive_task = asyncio.ensure_future(self.check_children_alive(), loop=self.loop)
+        self.expire_futures_task = asyncio.ensure_future(self.expire_futures(), loop=self.loop)
+        if settings.pyton.hedging.enabled:
+            self.report_hedging_stats_task = asyncio.ensure_future(self.report_hedging_stats(), loop=self.loop)
+
+    def start_client(self, i):
+        c = copy.deepcopy(self.config)
+        c["liteservers"] = [self.config["liteservers"][i]]
+        keystore = self.keystore + str(i)
+
+        Path(keystore).mkdir(parents=True, exist_ok=True)
+
+        client = TonlibClient(c, keystore=keystore, cdll_path=self.cdll_path)
 
-    # Used by ring library. Since we need shared cache across
-    # multiple TonlibMultiClient instances this function must
-    # return some static value.
-    def __ring_key__(self):
-        return "static"
+        # lite server info
+        client.number = i
+        client.is_working = False
+        client.is_archival = False
+        client.connection = None
+        client.stats = ClientStats()
+        client.breaker = CircuitBreaker(**settings.pyton.circuit_breaker)
+
+        client.start()
+        client.child_socket.close()
+        return client
 
     async def read_output(self, client):
+        client.connection = await FramedConnection.open_socket(client.parent_socket)
         while True:
             try:
-                msg_type, msg_content = await client.output_queue.coro_get()
-                if msg_type == MsgType.TASK_RESULT:
-                    task_id = msg_content.task_id
-                    result = msg_content.result
-                    exception = msg_content.exception
-                    if task_id in self.futures and not self.futures[task_id].done():
-                        if exception is not None:
-                            self.futures[task_id].set_exception(exception)
-                        if result is not None:    
-                            self.futures[task_id].set_result(result)
-                        logger.debug(f"Client #{client.number:03d}, task '{task_id}' result: {result}, exception: {exception}")
-                        
-                        # log liteserver task
-                        log_liteserver_task(msg_content)
+                msg_type, msg_id, payload = await client.connection.receive()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logger.error(f"Client #{client.number:03d} connection closed")
+                break
+
+            try:
+                if msg_type == MsgType.TASK_RESULT or msg_type == MsgType.TASK_EXCEPTION:
+                    future = self.futures.get(msg_id)
+                    if future is not None and not future.done():
+                        if msg_type == MsgType.TASK_EXCEPTION:
+                            future.set_exception(pickle.loads(payload))
+                        else:
+                            future.set_result(payload)
                     else:
-                        logger.warning(f"Client #{client.number:03d}, task '{task_id}' doesn't exist or is done.")
+                        logger.warning(f"Client #{client.number:03d}, task '{msg_id}' doesn't exist or is done.")
 
                 if msg_type == MsgType.LAST_BLOCK_UPDATE:
-                    client.last_block = msg_content
+                    client.last_block = json.loads(payload)
 
                 if msg_type == MsgType.ARCHIVAL_UPDATE:
-                    client.is_archival = msg_content
+                    client.is_archival = json.loads(payload)
             except Exception as e:
                 logger.error(f"read_output exception {traceback.format_exc()}")
 
@@ -137,7 +261,7 @@ class TonlibMultiClient:
                 self.current_consensus_block = consensus_block
                 self.current_consensus_block_timestamp = datetime.utcnow().timestamp()
             for i in range(len(self.all_clients)):
-                self.all_clients[i].is_working = last_blocks[i] >= self.current_consensus_block
+                self.all_clients[i].is_working = last_blocks[i] >= self.current_consensus_block and not self.all_clients[i].breaker.is_open
 
             await asyncio.sleep(1)
 
@@ -148,57 +272,223 @@ class TonlibMultiClient:
                     logger.error(f"Client #{i:03d} dead!!! Exit code: {client.exitcode}")
 
                     self.read_output_tasks[i].cancel()
+                    if client.connection is not None:
+                        client.connection.close()
                     client.close()
 
-                    c = copy.deepcopy(self.config)
-                    c["liteservers"] = [self.config["liteservers"][i]]
-                    keystore = self.keystore + str(i)
-                    new_client = TonlibClient(aioprocessing.AioQueue(), aioprocessing.AioQueue(), c, keystore=keystore, cdll_path=self.cdll_path)
-                    
-                    # lite server info
-                    new_client.number = i
-                    new_client.is_working = False
-                    new_client.is_archival = False
-                    new_client.start()
+                    new_client = self.start_client(i)
                     self.all_clients[i] = new_client
 
                     self.read_output_tasks[i] = asyncio.ensure_future(self.read_output(new_client), loop=self.loop)
 
             await asyncio.sleep(1)
 
-    async def _dispatch_request_to_liteserver(self, method, client, *args, **kwargs):
-        task_id = "{}:{}".format(time.time(), random.random())
-        timeout = time.time() + settings.pyton.request_timeout
-        await client.input_queue.coro_put((task_id, timeout, method, args, kwargs))
+    async def expire_futures(self):
+        while True:
+            for future in self.futures.expire():
+                future.set_exception(asyncio.TimeoutError())
+            await asyncio.sleep(1)
 
+    async def _dispatch_request_to_liteserver(self, method, client, *args, deadline=None, raw=False, **kwargs):
+        """
+        Send task to the client and wait for its result. Result is returned
+        as TonlibRawResult if raw is set, otherwise it's parsed.
+        """
+        timeout = deadline or time.time() + settings.pyton.request_timeout
+        # Client reports tonlib timeout itself, extra second is given for that
+        task_id, future = self.futures.create(timeout - time.time() + 1)
+
+        start_time = time.time()
+        result = None
+        exception = None
+        client.stats.task_started()
         try:
-            self.futures[task_id] = self.loop.create_future()
-            await self.futures[task_id]
-            return self.futures[task_id].result()
+            await client.connection.send(MsgType.TASK, task_id, pickle.dumps((timeout, method, args, kwargs)))
+            result = await future
+        except Exception as e:
+            exception = e
+            raise
         finally:
             self.futures.pop(task_id)
+            elapsed_time = time.time() - start_time
+            completed = result is not None or exception is not None
+            client.stats.task_finished(elapsed_time if completed else None)
+            if completed:
+                client.breaker.record(self._task_succeeded(result, exception))
+            if settings.logs.enabled and completed:
+                log_liteserver_task(TonlibClientResult(task_id,
+                                                       method,
+                                                       elapsed_time=elapsed_time,
+                                                       params=[args, kwargs],
+                                                       result=result,
+                                                       exception=exception,
+                                                       liteserver_info=client.info))
+        return TonlibRawResult(result) if raw else json.loads(result)
+
+    @staticmethod
+    def _task_succeeded(result, exception):
+        """
+        Task failed if it got liteserver or network error. Errors caused by request itself don't count.
+        """
+        if exception is not None:
+            return not is_retryable_exception(exception)
+        if isinstance(result, bytes):
+            error = json.loads(result) if is_error_response(result) else None
+        else:
+            error = tonlib_error(result)
+        return error is None or not is_retryable_error(error)
+
+    def _available_clients(self, clients):
+        """
+        Filter out clients which don't accept tasks because of circuit breaker.
+        """
+        available = [cl for cl in clients if cl.breaker.allows_task(cl.stats.in_flight)]
+        return available or clients
+
+    async def _first_result(self, tasks):
+        """
+        Wait for the first successful task and cancel the rest.
+        If all tasks fail the result of the last one is returned or its exception is raised.
+        """
+        pending = tasks
+        try:
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    exception = task.exception()
+                    if self._task_succeeded(None if exception else task.result(), exception):
+                        return task.result()
+                if not pending:
+                    return task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _dispatch_with_retry(self, method, clients, *args, **kwargs):
+        """
+        Dispatch task to one of clients. Task failed with retryable error is sent to another client
+        while retry budget of the method allows it and there is enough time left before the deadline.
+        Time left is split between the remaining attempts, so a timed out attempt leaves time to retry.
+        """
+        retry = settings.pyton.retry
+        attempts = retry.methods.get(method, retry.attempts)
+        hedged = settings.pyton.hedging.enabled and method in settings.pyton.hedging.methods
+        deadline = time.time() + settings.pyton.request_timeout
+        failed = []
+        for attempt in range(1, attempts + 1):
+            candidates = self._available_clients([cl for cl in clients if cl not in failed] or clients)
+            client = self.choose_client(candidates)
+            now = time.time()
+            attempt_deadline = now + (deadline - now) / (attempts - attempt + 1)
+            try:
+                if hedged:
+                    result = await self._dispatch_hedged_request(method, client, candidates, *args, deadline=attempt_deadline, **kwargs)
+                else:
+                    result = await self._dispatch_request_to_liteserver(method, client, *args, deadline=attempt_deadline, **kwargs)
+            except Exception as e:
+                last_attempt = attempt == attempts or deadline - time.time() < retry.min_time_left
+                if last_attempt or not is_retryable_exception(e):
+                    raise
+                logger.warning(f"Client #{client.number:03d} failed {method} with {type(e).__name__}, retrying")
+            else:
+                last_attempt = attempt == attempts or deadline - time.time() < retry.min_time_left
+                error = tonlib_error(result)
+                if error is None or last_attempt or not is_retryable_error(error):
+                    return result
+                logger.warning(f"Client #{client.number:03d} failed {method} with error {error.get('code')}, retrying")
+            failed.append(client)
 
     async def dispatch_request(self, method, *args, **kwargs):
-        client = random.choice([cl for cl in self.all_clients if cl.is_working])
-        result = await self._dispatch_request_to_liteserver(method, client, *args, **kwargs)
+        working = [cl for cl in self.all_clients if cl.is_working]
+        return await self._dispatch_with_retry(method, working, *args, **kwargs)
+
+    async def _dispatch_hedged_request(self, method, client, working, *args, **kwargs):
+        """
+        Send task to the client and, if it doesn't answer within usual time, to another one.
+        Number of hedged requests is limited by per method budget.
+        """
+        hedging = settings.pyton.hedging
+        budget = self.hedging_budgets[method]
+        budget.add_request()
+        stats = self.hedging_stats[method]
+        stats['requests'] += 1
+
+        first = asyncio.ensure_future(self._dispatch_request_to_liteserver(method, client, *args, **kwargs), loop=self.loop)
+        delay = client.stats.latency_percentile(hedging.latency_percentile)
+        others = [cl for cl in working if cl is not client]
+        if delay is None or not others:
+            return await first
+
+        try:
+            done, _ = await asyncio.wait([first], timeout=max(delay, hedging.min_delay))
+        except asyncio.CancelledError:
+            first.cancel()
+            raise
+        if done or not budget.take_hedge():
+            return await first
+
+        stats['hedged'] += 1
+        second = asyncio.ensure_future(self._dispatch_request_to_liteserver(method, self.choose_client(others), *args, **kwargs), loop=self.loop)
+        result = await self._first_result([first, second])
+        if second.done() and not second.cancelled() and second.exception() is None and second.result() is result:
+            stats['hedge_won'] += 1
         return result
 
+    def take_hedging_stats(self):
+        """
+        :return: per method counters of requests, hedged requests and hedges answered first since the previous call
+        """
+        stats = dict(self.hedging_stats)
+        self.hedging_stats.clear()
+        return stats
+
+    async def report_hedging_stats(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            for method, stats in self.take_hedging_stats().items():
+                logger.info(f"Hedging of {method} in the last {interval}s: {stats['requests']} requests, "
+                            f"{stats['hedged']} hedged, {stats['hedge_won']} won by hedge")
+
     async def dispatch_archive_request(self, method, *args, **kwargs):
         clnts = [cl for cl in self.all_clients if cl.is_working and cl.is_archival]
         if not len(clnts):
             clnts = [cl for cl in self.all_clients if cl.is_working]
-        client = random.choice(clnts)
-        result = await self._dispatch_request_to_liteserver(method, client, *args, **kwargs)
-        return result
+        return await self._dispatch_with_retry(method, clnts, *args, **kwargs)
 
-    @redis_cached(expire=5)
+    @redis_cached(expire=5, immutable=lambda **kwargs: True)
     async def raw_get_transactions(self, account_address: str, from_transaction_lt: str, from_transaction_hash: str, archival: bool):
         if archival:
             return await self.dispatch_archive_request(current_function_name(), account_address, from_transaction_lt, from_transaction_hash)
         else:
             return await self.dispatch_request(current_function_name(), account_address, from_transaction_lt, from_transaction_hash)
 
-    @redis_cached(expire=15, check_error=False)
+    async def get_transactions_page(self, account_address, lt, hash, archival):
+        """
+        Transactions of the account starting from transaction (lt, hash) and the id of the transaction before them.
+
+        Transactions are immutable, so every transaction of a fetched page is indexed with the start of the page
+        and its position in it. Requests starting inside a known page are served from it instead of liteserver.
+        """
+        key = immutable_key('transaction_index', account_address, int(lt), hash)
+        index = await get_immutable('get_transactions_page', key)
+        if index is not None:
+            page_lt, page_hash, page_archival, offset = index
+            page = await self.raw_get_transactions(account_address, page_lt, page_hash, page_archival)
+            if page['@type'] != 'error' and len(page['transactions']) > offset:
+                page['transactions'] = page['transactions'][offset:]
+                return page
+
+        page = await self.raw_get_transactions(account_address, lt, hash, archival)
+        if page['@type'] == 'error' or len(page['transactions']) < 2:
+            return page
+        keys = [immutable_key('transaction_index', account_address, int(t['transaction_id']['lt']), b64str_to_hex(t['transaction_id']['hash']))
+                for t in page['transactions']]
+        # page could come from cache, then it's already indexed unless the index is evicted
+        if await get_immutable('get_transactions_page', keys[-1]) is None:
+            await asyncio.gather(*[set_immutable('get_transactions_page', keys[i], [lt, hash, archival, i]) for i in range(1, len(keys))])
+        return page
+
+    @redis_cached(expire=15, check_error=False, block_bound=True)
     async def get_transactions(self, account_address, from_transaction_lt=None, from_transaction_hash=None, to_transaction_lt=0, limit=10, archival=False):
         """
          Return all transactions between from_transaction_lt and to_transaction_lt
@@ -213,117 +503,142 @@ class TonlibMultiClient:
                 from_transaction_lt, from_transaction_hash = int(addr["last_transaction_id"]["lt"]), b64str_to_hex(addr["last_transaction_id"]["hash"])
             except KeyError:
                 raise TonLibWrongResult("Can't get last_transaction_id data", addr)
+        prefetch = settings.pyton.transactions_prefetch.pages if limit >= settings.pyton.transactions_prefetch.min_limit else 0
+        pages = self.iter_transaction_pages(account_address, from_transaction_lt, from_transaction_hash, to_transaction_lt, limit, archival, prefetch)
         reach_lt = False
         all_transactions = []
-        current_lt, curret_hash = from_transaction_lt, from_transaction_hash
-        while (not reach_lt) and (len(all_transactions) < limit):
-            raw_transactions = await self.raw_get_transactions(account_address, current_lt, curret_hash, archival)
-            if(raw_transactions['@type']) == 'error':
-                break
-                # TODO probably we should chenge get_transactions API
-                # if 'message' in raw_transactions['message']:
-                #  raise Exception(raw_transactions['message'])
-                # else:
-                #  raise Exception("Can't get transactions")
-            transactions, next = raw_transactions['transactions'], raw_transactions.get("previous_transaction_id", None)
-            for t in transactions:
-                tlt = int(t['transaction_id']['lt'])
-                if tlt <= to_transaction_lt:
-                    reach_lt = True
+        try:
+            async for raw_transactions in pages:
+                if(raw_transactions['@type']) == 'error':
                     break
-                all_transactions.append(copy.deepcopy(t))
-            if next:
-                current_lt, curret_hash = int(next["lt"]), b64str_to_hex(next["hash"])
-            else:
+                    # TODO probably we should chenge get_transactions API
+                    # if 'message' in raw_transactions['message']:
+                    #  raise Exception(raw_transactions['message'])
+                    # else:
+                    #  raise Exception("Can't get transactions")
+                for t in raw_transactions['transactions']:
+                    tlt = int(t['transaction_id']['lt'])
+                    if tlt <= to_transaction_lt or len(all_transactions) >= limit:
+                        reach_lt = True
+                        break
+                    # with prefetch the next pages are being fetched meanwhile
+                    format_transaction_messages(t)
+                    all_transactions.append(t)
+                if reach_lt:
+                    break
+        finally:
+            await pages.aclose()
+        return all_transactions
+
+    async def walk_transaction_pages(self, account_address, lt, hash, to_transaction_lt, limit, archival):
+        count = 0
+        while count < limit:
+            page = await self.get_transactions_page(account_address, lt, hash, archival)
+            yield page
+            if page['@type'] == 'error' or not page['transactions']:
                 break
-            if current_lt == 0:
+            count += len(page['transactions'])
+            next = page.get("previous_transaction_id", None)
+            if not next or int(page['transactions'][-1]['transaction_id']['lt']) <= to_transaction_lt:
+                break
+            lt, hash = int(next["lt"]), b64str_to_hex(next["hash"])
+            if lt == 0:
                 break
-        for t in all_transactions:
-            try:
-                if "in_msg" in t:
-                    if "source" in t["in_msg"]:
-                        t["in_msg"]["source"] = t["in_msg"]["source"]["account_address"]
-                    if "destination" in t["in_msg"]:
-                        t["in_msg"]["destination"] = t["in_msg"]["destination"]["account_address"]
-                    try:
-                        if "msg_data" in t["in_msg"]:
-                            dcd = ""
-                            if t["in_msg"]["msg_data"]["@type"] == "msg.dataRaw":
-                                msg_cell_boc = codecs.decode(codecs.encode(t["in_msg"]["msg_data"]["body"], 'utf8'), 'base64')
-                                message_cell = deserialize_boc(msg_cell_boc)
-                                dcd = message_cell.data.data.tobytes()
-                                t["in_msg"]["message"] = codecs.decode(codecs.encode(dcd, 'base64'), "utf8")
-                            elif t["in_msg"]["msg_data"]["@type"] == "msg.dataText":
-                                dcd = codecs.encode(t["in_msg"]["msg_data"]["text"], 'utf8')
-                                t["in_msg"]["message"] = codecs.decode(codecs.decode(dcd, 'base64'), "utf8")
-                    except Exception as e:
-                        t["in_msg"]["message"] = ""
-                        print(e)
-                if "out_msgs" in t:
-                    for o in t["out_msgs"]:
-                        if "source" in o:
-                            o["source"] = o["source"]["account_address"]
-                        if "destination" in o:
-                            o["destination"] = o["destination"]["account_address"]
-                        try:
-                            if "msg_data" in o:
-                                dcd = ""
-                                if o["msg_data"]["@type"] == "msg.dataRaw":
-                                    msg_cell_boc = codecs.decode(codecs.encode(o["msg_data"]["body"], 'utf8'), 'base64')
-                                    message_cell = deserialize_boc(msg_cell_boc)
-                                    dcd = message_cell.data.data.tobytes()
-                                    o["message"] = codecs.decode(codecs.encode(dcd, 'base64'), "utf8")
-                                elif o["msg_data"]["@type"] == "msg.dataText":
-                                    dcd = codecs.encode(o["msg_data"]["text"], 'utf8')
-                                    o["message"] = codecs.decode(codecs.decode(dcd, 'base64'), "utf8")
-                        except Exception as e:
-                            o["message"] = ""
-            except Exception as e:
-                print("getTransaction exception", e)
-        return all_transactions[:limit]
 
-    @redis_cached(expire=5)
+    async def iter_transaction_pages(self, account_address, lt, hash, to_transaction_lt, limit, archival, prefetch=0):
+        """
+        Pages of account transactions starting from transaction (lt, hash) until limit transactions
+        or to_transaction_lt are reached.
+
+        Every page starts at previous_transaction_id of the one before, so pages can't be requested at once,
+        but with prefetch > 0 the next ones are fetched while the caller handles previous ones.
+        """
+        pages = self.walk_transaction_pages(account_address, lt, hash, to_transaction_lt, limit, archival)
+        async for page in prefetched(pages, prefetch):
+            yield page
+
+    @redis_cached(expire=5, block_bound=True, stale=5)
     async def raw_get_account_state(self, address: str):
         addr = await self.dispatch_request(current_function_name(), address)
-        # FIXME: refactor this code
-        if addr.get('@type','error') == 'error':
-            addr = await self.dispatch_request(current_function_name(), address)
         if addr.get('@type','error') == 'error':
             raise TonLibWrongResult("raw.getAccountState failed", addr)
         return addr
 
-    @redis_cached(expire=5)
-    async def generic_get_account_state(self, address: str):
-        return await self.dispatch_request(current_function_name(), address)
+    async def raw_get_account_states(self, addresses):
+        """
+        Account states of several addresses. Cached ones are loaded from redis at once, others are requested
+        from liteservers with at most pyton.account_states_batch.concurrency requests at a time.
 
-    @redis_cached(expire=5)
-    async def raw_run_method(self, address, method, stack_data, output_layout=None):
-        return await self.dispatch_request(current_function_name(), address, method, stack_data, output_layout)
+        :return: dict address -> account state or exception
+        """
+        await self.raw_get_account_state.prefetch([(self, address) for address in addresses])
+        semaphore = asyncio.Semaphore(settings.pyton.account_states_batch.concurrency)
 
-    async def raw_send_message(self, serialized_boc):
-        working = [cl for cl in self.all_clients if cl.is_working]
-        if len(working) == 0:
-            raise Exception("No working liteservers")
+        async def get(address):
+            async with semaphore:
+                try:
+                    return await self.raw_get_account_state(address)
+                except Exception as e:
+                    return e
 
-        task_ids = []
+        return dict(zip(addresses, await asyncio.gather(*[get(address) for address in addresses])))
 
-        result = None
+    @redis_cached(expire=5, block_bound=True, stale=5)
+    async def generic_get_account_state(self, address: str, raw=False):
+        return await self.dispatch_request(current_function_name(), address, raw=raw)
+
+    @redis_cached(expire=5, block_bound=True)
+    async def raw_run_method(self, address, method, stack_data, output_layout=None):
+        last_transaction_lt = await self._last_transaction_lt(address)
+        return await self.dispatch_request(current_function_name(), address, method, stack_data, output_layout, last_transaction_lt)
+
+    async def _last_transaction_lt(self, address):
+        # liteserver client reuses contract loaded for the same last transaction of the account
         try:
-            for cl in random.sample(working, min(4, len(working))):
-                task_id = "{}:{}".format(time.time(), random.random())
-                timeout = time.time() + settings.pyton.request_timeout
-                await cl.input_queue.coro_put((task_id, timeout, current_function_name(), [serialized_boc], {}))
+            state = await self.raw_get_account_state(address)
+            return int(state["last_transaction_id"]["lt"])
+        except Exception:
+            return None
 
-                self.futures[task_id] = self.loop.create_future()
-                task_ids.append(task_id)
+    async def raw_run_methods(self, calls):
+        """
+        Run get methods of several contracts. All calls of one contract are sent to one liteserver client
+        which loads the contract once, up to pyton.run_methods_batch.concurrency contracts are run at a time.
 
-            done, pending = await asyncio.wait([self.futures[task_id] for task_id in task_ids], return_when=asyncio.FIRST_COMPLETED)
-            result = list(done)[0].result()
-        finally:
-            for task_id in task_ids:
-                self.futures.pop(task_id)
+        :param calls: list of (address, method, stack_data)
+        :return: results in order of calls, failed calls get error results
+        """
+        groups = defaultdict(list)
+        for i, (address, _, _) in enumerate(calls):
+            groups[address].append(i)
+        results = [None] * len(calls)
+        semaphore = asyncio.Semaphore(settings.pyton.run_methods_batch.concurrency)
+        method = current_function_name()
+
+        async def run_group(address, indexes):
+            async with semaphore:
+                try:
+                    last_transaction_lt = await self._last_transaction_lt(address)
+                    group_results = await self.dispatch_request(method, address, [calls[i][1:] for i in indexes],
+                                                                last_transaction_lt)
+                except Exception as e:
+                    group_results = [{'@type': 'error', 'code': 500, 'message': str(e)}] * len(indexes)
+                for i, result in zip(indexes, group_results):
+                    results[i] = result
+
+        await asyncio.gather(*[run_group(address, indexes) for address, indexes in groups.items()])
+        return results
+
+    async def raw_send_message(self, serialized_boc, raw=False):
+        working = [cl for cl in self.all_clients if cl.is_working]
+        if len(working) == 0:
+            raise Exception("No working liteservers")
 
-        return result
+        working = self._available_clients(working)
+        method = current_function_name()
+        tasks = [asyncio.ensure_future(self._dispatch_request_to_liteserver(method, cl, serialized_boc, raw=raw), loop=self.loop)
+                 for cl in random.sample(working, min(4, len(working)))]
+        return await self._first_result(tasks)
 
     async def _raw_create_query(self, destination, body, init_code=b'', init_data=b''):
         return await self.dispatch_request(current_function_name(), destination, body, init_code, init_data)
@@ -337,11 +652,11 @@ class TonlibMultiClient:
     async def raw_create_and_send_message(self, destination, body, initial_account_state=b''):
         return await self.dispatch_request(current_function_name(), destination, body, initial_account_state)
 
-    @redis_cached(expire=5)
+    @redis_cached(expire=5, block_bound=True)
     async def raw_estimate_fees(self, destination, body, init_code=b'', init_data=b'', ignore_chksig=True):
         return await self.dispatch_request(current_function_name(), destination, body, init_code, init_data, ignore_chksig)
 
-    @redis_cached(expire=1)
+    @redis_cached(expire=1, stale=2)
     async def getMasterchainInfo(self):
         return await self.dispatch_request(current_function_name())
 
@@ -351,29 +666,27 @@ class TonlibMultiClient:
             "timestamp": self.current_consensus_block_timestamp
         }
 
-    @redis_cached(expire=600)
-    async def lookupBlock(self, workchain, shard, seqno=None, lt=None, unixtime=None):
+    @redis_cached(expire=600, immutable=lambda seqno=None, **kwargs: seqno is not None)
+    async def lookupBlock(self, workchain, shard, seqno=None, lt=None, unixtime=None, raw=False):
         if workchain == -1 and seqno and self.current_consensus_block - seqno < 2000:
-            return await self.dispatch_request(current_function_name(), workchain, shard, seqno, lt, unixtime)
+            return await self.dispatch_request(current_function_name(), workchain, shard, seqno, lt, unixtime, raw=raw)
         else:
-            return await self.dispatch_archive_request(current_function_name(), workchain, shard, seqno, lt, unixtime)
+            return await self.dispatch_archive_request(current_function_name(), workchain, shard, seqno, lt, unixtime, raw=raw)
 
-    @redis_cached(expire=600)
-    async def getShards(self, master_seqno=None, lt=None, unixtime=None):
+    @redis_cached(expire=600, immutable=lambda master_seqno=None, **kwargs: master_seqno is not None)
+    async def getShards(self, master_seqno=None, lt=None, unixtime=None, raw=False):
         if master_seqno and self.current_consensus_block - master_seqno < 2000:
-            return await self.dispatch_request(current_function_name(), master_seqno)
+            return await self.dispatch_request(current_function_name(), master_seqno, lt, unixtime, raw=raw)
         else:
-            return await self.dispatch_archive_request(current_function_name(), master_seqno)
+            return await self.dispatch_archive_request(current_function_name(), master_seqno, lt, unixtime, raw=raw)
 
-    @redis_cached(expire=600)
+    @redis_cached(expire=600, immutable=lambda **kwargs: True)
     async def raw_getBlockTransactions(self, fullblock, count, after_tx):
         return await self.dispatch_archive_request(current_function_name(), fullblock, count, after_tx)
 
-    @redis_cached(expire=600)
-    async def getBlockTransactions(self, workchain, shard, seqno, count, root_hash=None, file_hash=None, after_lt=None, after_hash=None):
-        fullblock = {}
+    async def get_full_block_id(self, workchain, shard, seqno, root_hash=None, file_hash=None):
         if root_hash and file_hash:
-            fullblock = {
+            return {
                 '@type': 'ton.blockIdExt',
                 'workchain': workchain,
                 'shard': shard,
@@ -381,51 +694,145 @@ class TonlibMultiClient:
                 'root_hash': root_hash,
                 'file_hash': file_hash
             }
-        else:
-            fullblock = await self.lookupBlock(workchain, shard, seqno)
-            if fullblock.get('@type', 'error') == 'error':
-                return fullblock
+        return await self.lookupBlock(workchain, shard, seqno)
+
+    async def walk_block_transactions(self, fullblock, count, after_lt=None, after_hash=None):
+        incomplete = True
         after_tx = {
             '@type': 'blocks.accountTransactionId',
             'account': after_hash if after_hash else 'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA=',
             'lt': after_lt if after_lt else 0
         }
-        total_result = None
-        incomplete = True
         while incomplete:
             result = await self.raw_getBlockTransactions(fullblock, count, after_tx)
-            if(result['@type']) == 'error':
-                result = await self.raw_getBlockTransactions(fullblock, count, after_tx)
             if(result['@type']) == 'error':
                 raise TonLibWrongResult('Can\'t get blockTransactions', result)
+            incomplete = result.get("incomplete", False)
+            if incomplete:
+                # taken before the page is handed over, its accounts get converted
+                after_tx = dict(after_tx, account=result["transactions"][-1]["account"], lt=result["transactions"][-1]["lt"])
+            yield result
+
+    async def iter_block_transactions(self, fullblock, count, after_lt=None, after_hash=None, prefetch=None):
+        """
+        Pages of transactions of the block with accounts in raw form until the end of the block.
+
+        Every page starts after the last transaction of the one before, so pages can't be requested at once,
+        but the next ones are fetched while the caller handles previous ones.
+        """
+        if prefetch is None:
+            prefetch = settings.pyton.block_transactions_prefetch
+        pages = self.walk_block_transactions(fullblock, count, after_lt, after_hash)
+        async for result in prefetched(pages, prefetch):
+            convert_block_accounts(result["id"]["workchain"], result["transactions"])
+            yield result
+
+    @redis_cached(expire=600, immutable=is_final_block)
+    async def getBlockTransactions(self, workchain, shard, seqno, count, root_hash=None, file_hash=None, after_lt=None, after_hash=None):
+        fullblock = await self.get_full_block_id(workchain, shard, seqno, root_hash, file_hash)
+        if fullblock.get('@type', 'error') == 'error':
+            return fullblock
+        total_result = None
+        async for result in self.iter_block_transactions(fullblock, count, after_lt, after_hash):
             if not total_result:
                 total_result = result
             else:
                 total_result["transactions"] += result["transactions"]
                 total_result["incomplete"] = result.get("incomplete", False)
-            incomplete = result.get("incomplete", False)
-            if incomplete:
-                after_tx['account'] = result["transactions"][-1]["account"]
-                after_tx['lt'] = result["transactions"][-1]["lt"]
-        # TODO automatically check incompleteness and download all txes
-        for tx in total_result["transactions"]:
-            try:
-                tx["account"] = "%d:%s" % (result["id"]["workchain"], b64str_to_hex(tx["account"]))
-            except:
-                pass
         return total_result
 
-    @redis_cached(expire=600)
-    async def getBlockHeader(self, workchain, shard, seqno, root_hash=None, file_hash=None):
+    @redis_cached(expire=600, immutable=is_final_block)
+    async def getBlockHeader(self, workchain, shard, seqno, root_hash=None, file_hash=None, raw=False):
         if workchain == -1 and seqno and self.current_consensus_block - seqno < 2000:
-            return await self.dispatch_request(current_function_name(), workchain, shard, seqno, root_hash, file_hash)
+            return await self.dispatch_request(current_function_name(), workchain, shard, seqno, root_hash, file_hash, raw=raw)
         else:
-            return await self.dispatch_archive_request(current_function_name(), workchain, shard, seqno, root_hash, file_hash)
+            return await self.dispatch_archive_request(current_function_name(), workchain, shard, seqno, root_hash, file_hash, raw=raw)
+
+    async def search_tx_in_block(self, account, workchain, shard, lt, match):
+        """
+        Look for transaction of the account matching predicate starting from its last transaction
+        in the shard block containing lt.
+        """
+        block = await self.lookupBlock(workchain, shard, lt=lt)
+        if block.get('@type', 'error') == 'error':
+            raise TonLibWrongResult("Can't lookup block", block)
+        txs = await self.getBlockTransactions(workchain, shard, block["seqno"], 40, root_hash=block["root_hash"], file_hash=block["file_hash"])
+        if txs.get('@type', 'error') == 'error':
+            raise TonLibWrongResult("Can't get block transactions", txs)
+        candidate = None
+        count = 0
+        for tx in txs["transactions"]:
+            if tx["account"] == account["raw_form"]:
+                count += 1
+                if not candidate or candidate[1] < int(tx["lt"]):
+                    candidate = tx["hash"], int(tx["lt"])
+        if not candidate:
+            return None
+        txses = await self.get_transactions(account["raw_form"], from_transaction_lt=candidate[1], from_transaction_hash=b64str_to_hex(candidate[0]), limit=max(count, 10), archival=True)
+        for tx in txses:
+            try:
+                if match(tx):
+                    return tx
+            except Exception:
+                pass
+        return None
+
+    async def locate_tx(self, account, creation_lt, blocks, match):
+        """
+        Search transaction in all shards of the account's workchain, in blocks starting from the one containing
+        creation_lt and then next 1000000 lt apart. Up to pyton.locate_tx_concurrency blocks are searched at a time,
+        nearer ones first, searches stop at the first match.
+        """
+        workchain = int(account["raw_form"].split(":")[0])
+        shards = await self.getShards(lt=creation_lt)
+        if shards.get('@type', 'error') == 'error':
+            raise TonLibWrongResult("Can't get shards", shards)
+        semaphore = asyncio.Semaphore(settings.pyton.locate_tx_concurrency)
+
+        async def search(shard, lt):
+            async with semaphore:
+                return await self.search_tx_in_block(account, workchain, shard, lt, match)
+
+        tasks = [asyncio.ensure_future(search(shard_data['shard'], creation_lt + b * 1000000))
+                 for b in range(blocks) for shard_data in shards['shards']]
+        error = None
+        try:
+            for future in asyncio.as_completed(tasks):
+                try:
+                    tx = await future
+                except Exception as e:
+                    error = error or e
+                    continue
+                if tx is not None:
+                    return tx
+        finally:
+            for task in tasks:
+                # errors of finished searches which weren't awaited are retrieved to avoid warnings
+                if not task.cancel() and not task.cancelled():
+                    task.exception()
+        if error is not None:
+            raise error
+        raise Exception("Tx not found")
 
     @redis_cached(expire=600, check_error=False)
     async def tryLocateTxByOutcomingMessage(self, source, destination, creation_lt):
-        return await self.dispatch_archive_request(current_function_name(),  source, destination, creation_lt)
+        src = detect_address(source)
+        dest = detect_address(destination)
+
+        def match(tx):
+            for msg in tx["out_msgs"]:
+                if detect_address(msg["destination"])["raw_form"] == dest["raw_form"] and int(msg["created_lt"]) == int(creation_lt):
+                    return True
+            return False
+        return await self.locate_tx(src, int(creation_lt), 1, match)
 
     @redis_cached(expire=600, check_error=False)
     async def tryLocateTxByIncomingMessage(self, source, destination, creation_lt):
-        return await self.dispatch_archive_request(current_function_name(),  source, destination, creation_lt)
+        src = detect_address(source)
+        dest = detect_address(destination)
+
+        def match(tx):
+            in_msg = tx["in_msg"]
+            tx_source = in_msg["source"]
+            return bool(len(tx_source) and detect_address(tx_source)["raw_form"] == src["raw_form"] and int(in_msg["created_lt"]) == int(creation_lt))
+        return await self.locate_tx(dest, int(creation_lt), 3, match)
@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import signal
+import asyncio
+import msgpack
+import multiprocessing
+
+from enum import IntEnum
+
+from config import settings
+from pyTON.ipc import FramedConnection, STREAM_LIMIT
+from pyTON.multiclient import TonlibMultiClient
+from pyTON.utils import TonlibRawResult, TonLibWrongResult
+
+from loguru import logger
+
+
+class PoolMsgType(IntEnum):
+    REQUEST = 1
+    RESULT = 2
+    EXCEPTION = 3
+    CONSENSUS_UPDATE = 4
+    RAW_RESULT = 5
+
+
+# Pool socket can be connected to by any local user, so payloads are msgpack, not pickle.
+def dump_payload(value):
+    return msgpack.packb(value)
+
+
+def load_payload(payload):
+    return msgpack.unpackb(payload)
+
+
+def dump_exception(exc):
+    """
+    Exception is sent as its kind and arguments, so workers raise the same exceptions TonlibMultiClient does.
+    """
+    if isinstance(exc, asyncio.TimeoutError):
+        value = ['timeout']
+    elif isinstance(exc, TonLibWrongResult):
+        result = json.loads(exc.result) if isinstance(exc.result, bytes) else exc.result
+        value = ['wrong_result', exc.description, result]
+    else:
+        value = ['error', str(exc)]
+    try:
+        return dump_payload(value)
+    except Exception:
+        return dump_payload(['error', str(exc)])
+
+
+def load_exception(payload):
+    kind, *args = load_payload(payload)
+    if kind == 'timeout':
+        return asyncio.TimeoutError()
+    if kind == 'wrong_result':
+        return TonLibWrongResult(*args)
+    return Exception(*args)
+
+
+class LiteserverPool(multiprocessing.Process):
+    """
+    Single set of TonlibClient processes (one per liteserver) shared by all webserver
+    workers. Workers connect to the pool with TonlibPoolClient through a unix socket.
+    """
+    # Methods of TonlibMultiClient which workers are allowed to call.
+    operations = ('dispatch_request', 'dispatch_archive_request', 'raw_send_message')
+
+    def __init__(self, config, keystore, socket_path, cdll_path=None):
+        super(LiteserverPool, self).__init__()
+        self.config = config
+        self.keystore = keystore
+        self.socket_path = socket_path
+        self.cdll_path = cdll_path
+
+    def run(self):
+        policy = asyncio.get_event_loop_policy()
+        policy.set_event_loop(policy.new_event_loop())
+        loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.workers = set()
+
+        self.tonlib = TonlibMultiClient(loop, self.config, keystore=self.keystore, cdll_path=self.cdll_path)
+        self.tonlib.init_tonlib()
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        loop.run_until_complete(asyncio.start_unix_server(self.serve_worker, path=self.socket_path, limit=STREAM_LIMIT))
+        self.report_consensus_block_task = asyncio.ensure_future(self.report_consensus_block(), loop=loop)
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        logger.info(f"Liteserver pool is listening on {self.socket_path}")
+
+        try:
+            loop.run_forever()
+        finally:
+            for client in self.tonlib.all_clients:
+                client.terminate()
+            os.unlink(self.socket_path)
+
+    async def serve_worker(self, reader, writer):
+        connection = FramedConnection(reader, writer)
+        self.workers.add(connection)
+        try:
+            await self.send_consensus_block(connection)
+            while True:
+                msg_type, msg_id, payload = await connection.receive()
+                if msg_type == PoolMsgType.REQUEST:
+                    asyncio.ensure_future(self.process_request(connection, msg_id, payload), loop=self.loop)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info("Worker disconnected from liteserver pool")
+        finally:
+            self.workers.discard(connection)
+            connection.close()
+
+    async def process_request(self, connection, msg_id, payload):
+        try:
+            operation, args, kwargs = load_payload(payload)
+            if operation not in self.operations:
+                raise ValueError(f"Unknown liteserver pool operation: {operation}")
+            # Tonlib responses are forwarded to the worker as is and parsed there.
+            result = await getattr(self.tonlib, operation)(*args, raw=True, **kwargs)
+            if isinstance(result, TonlibRawResult):
+                msg_type, payload = PoolMsgType.RAW_RESULT, result
+            else:
+                msg_type, payload = PoolMsgType.RESULT, dump_payload(result)
+        except Exception as e:
+            msg_type, payload = PoolMsgType.EXCEPTION, dump_exception(e)
+
+        if connection.is_closing():
+            return
+        try:
+            await connection.send(msg_type, msg_id, payload)
+        except ConnectionError:
+            pass
+
+    async def send_consensus_block(self, connection):
+        payload = json.dumps([self.tonlib.current_consensus_block, self.tonlib.current_consensus_block_timestamp]).encode('utf-8')
+        await connection.send(PoolMsgType.CONSENSUS_UPDATE, 0, payload)
+
+    async def report_consensus_block(self):
+        last_reported = None
+        while True:
+            if self.tonlib.current_consensus_block != last_reported:
+                last_reported = self.tonlib.current_consensus_block
+                for connection in list(self.workers):
+                    try:
+                        await self.send_consensus_block(connection)
+                    except ConnectionError:
+                        pass
+            await asyncio.sleep(1)
+
+
+class LiteserverPoolSupervisor(multiprocessing.Process):
+    """
+    Runs LiteserverPool and starts it again if it dies. Workers reconnect to the new pool
+    by themselves, without supervision they would wait for the dead one until request timeout.
+    """
+    pool_class = LiteserverPool
+
+    def __init__(self, *args, restart_delay=1, **kwargs):
+        super(LiteserverPoolSupervisor, self).__init__()
+        self.pool_args = args
+        self.pool_kwargs = kwargs
+        self.restart_delay = restart_delay
+
+    def run(self):
+        def stop(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, stop)
+
+        pool = None
+        try:
+            while True:
+                pool = self.pool_class(*self.pool_args, **self.pool_kwargs)
+                pool.start()
+                pool.join()
+                logger.error(f"Liteserver pool died with exit code {pool.exitcode}, restarting")
+                time.sleep(self.restart_delay)
+        finally:
+            if pool is not None and pool.is_alive():
+                pool.terminate()
+                pool.join()
+
+
+def start_liteserver_pool():
+    try:
+        with open(settings.pyton.liteserver_config, "r") as f:
+            lite_server_config = json.loads(f.read())
+    except Exception as e:
+        logger.error(f"Can't read provided lite_server_config: {str(e)}")
+        raise
+
+    supervisor = LiteserverPoolSupervisor(lite_server_config,
+                                          keystore=settings.pyton.keystore,
+                                          socket_path=settings.pyton.shared_pool.socket,
+                                          cdll_path=settings.pyton.cdll)
+    supervisor.start()
+    return supervisor
+
+
+class TonlibPoolClient(TonlibMultiClient):
+    """
+    TonlibMultiClient which doesn't run its own TonlibClient processes and forwards
+    all liteserver requests to LiteserverPool instead.
+    """
+    def __init__(self, loop, socket_path):
+        super(TonlibPoolClient, self).__init__(loop, config=None, keystore=None)
+        self.socket_path = socket_path
+        self.connection = None
+        self.connected = asyncio.Event()
+
+    def init_tonlib(self):
+        self.all_clients = []
+        self.read_pool_task = asyncio.ensure_future(self.read_pool(), loop=self.loop)
+        self.expire_futures_task = asyncio.ensure_future(self.expire_futures(), loop=self.loop)
+
+    async def connect(self):
+        while True:
+            try:
+                return await FramedConnection.open_unix(self.socket_path)
+            except (FileNotFoundError, ConnectionError) as e:
+                logger.warning(f"Liteserver pool is not available: {e}")
+                await asyncio.sleep(1)
+
+    async def read_pool(self):
+        while True:
+            self.connection = await self.connect()
+            self.connected.set()
+            try:
+                while True:
+                    msg_type, msg_id, payload = await self.connection.receive()
+                    if msg_type == PoolMsgType.CONSENSUS_UPDATE:
+                        self.current_consensus_block, self.current_consensus_block_timestamp = json.loads(payload)
+                        continue
+
+                    future = self.futures.get(msg_id)
+                    if future is None or future.done():
+                        continue
+                    if msg_type == PoolMsgType.RAW_RESULT:
+                        future.set_result(TonlibRawResult(payload))
+                    elif msg_type == PoolMsgType.RESULT:
+                        future.set_result(load_payload(payload))
+                    elif msg_type == PoolMsgType.EXCEPTION:
+                        future.set_exception(load_exception(payload))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logger.error("Connection to liteserver pool lost")
+            finally:
+                self.connected.clear()
+                self.connection.close()
+                for future in self.futures.values():
+                    if not future.done():
+                        future.set_exception(Exception("Connection to liteserver pool lost"))
+
+    async def _pool_request(self, operation, *args, **kwargs):
+        await self.connected.wait()
+        # Pool waits for liteserver client result up to its own deadline
+        request_id, future = self.futures.create(settings.pyton.request_timeout + 2)
+        try:
+            await self.connection.send(PoolMsgType.REQUEST, request_id, dump_payload([operation, args, kwargs]))
+            return await future
+        finally:
+            self.futures.pop(request_id)
+
+    async def dispatch_request(self, method, *args, raw=False, **kwargs):
+        result = await self._pool_request('dispatch_request', method, *args, **kwargs)
+        return result if raw else json.loads(result)
+
+    async def dispatch_archive_request(self, method, *args, raw=False, **kwargs):
+        result = await self._pool_request('dispatch_archive_request', method, *args, **kwargs)
+        return result if raw else json.loads(result)
+
+    async def raw_send_message(self, serialized_boc, raw=False):
+        result = await self._pool_request('raw_send_message', serialized_boc)
+        return result if raw else json.loads(result)
@@ -1,15 +1,15 @@
 import json
 import platform
 import pkg_resources
-import random
 import asyncio
+import threading
 import time
-import functools
 
+from contextvars import ContextVar
 from config import settings
 from ctypes import *
 from loguru import logger
-from pyTON.utils import TonLibWrongResult
+from pyTON.utils import ExpiringFutures, is_error_response, is_retryable_error
 
 
 def get_tonlib_path():
@@ -22,6 +22,23 @@ def get_tonlib_path():
                                            'distlib/'+arch_name+'/'+lib_name)
 
 
+# While set, TonLib.execute returns tonlib response as JSON bytes without parsing it.
+raw_results = ContextVar('raw_results', default=False)
+# Deadline of the task being executed, TonLib.execute waits for tonlib response until it.
+task_deadline = ContextVar('task_deadline', default=None)
+
+
+def split_extra(response):
+    """
+    Split tonlib response into @extra and response without @extra. Tonlib appends
+    @extra as the last field of the object, so there is no need to parse the whole response.
+    """
+    pos = response.rfind(b',"@extra":')
+    if pos == -1:
+        return None, response
+    return json.loads(response[pos + 10:-1]), response[:pos] + b'}'
+
+
 class TonLib:
     def __init__(self, loop, ls_index, cdll_path=None):
         cdll_path = get_tonlib_path() if not cdll_path else cdll_path
@@ -55,14 +72,17 @@ class TonLib:
         tonlib_json_client_destroy.argtypes = [c_void_p]
         self._tonlib_json_client_destroy = tonlib_json_client_destroy
 
-        self.futures = {}
+        self.futures = ExpiringFutures(loop)
         self.loop = loop
         self.ls_index = ls_index
-        self.read_results_task = asyncio.ensure_future(self.read_results(), loop=self.loop)
-        self.del_expired_futures_task = asyncio.ensure_future(self.del_expired_futures(), loop=self.loop)
         self.shutdown_state = False  # False, "started", "finished"
+        # health stats, see TonlibClient.check_health
         self.request_num = 0
-        self.max_requests = None
+        self.error_num = 0
+        self.last_result_time = time.time()
+        self.receive_thread = threading.Thread(target=self.receive_results, name=f'tonlib-receive-{ls_index}', daemon=True)
+        self.receive_thread.start()
+        self.del_expired_futures_task = asyncio.ensure_future(self.del_expired_futures(), loop=self.loop)
 
     def __del__(self):
         try:
@@ -78,70 +98,87 @@ class TonLib:
             asyncio.ensure_future(self.restart_hook(), loop=self.loop)
 
     def receive(self, timeout=10):
+        """
+        Blocking receive, should be called from receive thread only.
+        """
         result = None
         try:
             result = self._tonlib_json_client_receive(self._client, timeout)
         except Exception:
-            asyncio.ensure_future(self.restart_hook(), loop=self.loop)
-        if result:
-            result = json.loads(result.decode('utf-8'))
+            asyncio.run_coroutine_threadsafe(self.restart_hook(), self.loop)
         return result
 
-    def set_restart_hook(self, hook, max_requests):
-        self.max_requests = max_requests
+    def set_restart_hook(self, hook):
         self.restart_hook = hook
 
-    def execute(self, query, timeout=settings.pyton.request_timeout):
-        extra_id = "%s:%s:%s" % (time.time()+timeout, self.ls_index, random.random())
+    def take_stats(self):
+        """
+        :return: tuple (requests, liteserver and network errors including timeouts) since the previous call
+        """
+        stats = self.request_num, self.error_num
+        self.request_num, self.error_num = 0, 0
+        return stats
+
+    def is_stuck(self, timeout):
+        """
+        Tonlib is stuck if there are requests in flight and no results for timeout seconds.
+        """
+        return len(self.futures) > 0 and time.time() - self.last_result_time > timeout
+
+    async def execute(self, query, timeout=None):
+        if timeout is None:
+            deadline = task_deadline.get()
+            timeout = settings.pyton.request_timeout if deadline is None else deadline - time.time()
+        if not len(self.futures):
+            # waiting for results starts now
+            self.last_result_time = time.time()
+        extra_id, future_result = self.futures.create(timeout)
         query["@extra"] = extra_id
-        self.loop.run_in_executor(None, lambda: self.send(query))
-        future_result = self.loop.create_future()
-        self.futures[extra_id] = future_result
+        # tonlib_client_json_send only enqueues the query, so it doesn't block the loop
+        self.send(query)
         self.request_num += 1
-        if self.max_requests and self.max_requests < self.request_num:
-            asyncio.ensure_future(self.restart_hook(), loop=self.loop)
-        return future_result
-
-    async def read_results(self):
-        while True:
-            result = None
+        response = await future_result
+        return response if raw_results.get() else json.loads(response)
+
+    def receive_results(self, timeout=1.0, max_batch=64):
+        """
+        Body of receive thread. Waits for tonlib results and hands them to the event loop,
+        everything already available is drained and passed in a single callback.
+        """
+        while self.shutdown_state != "finished":
+            results = []
+            result = self.receive(timeout)
+            while result:
+                results.append(result)
+                if len(results) >= max_batch:
+                    break
+                result = self.receive(0)
+            # Empty batch is also passed to let the loop finish shutdown while idle.
+            self.loop.call_soon_threadsafe(self.set_results, results)
+
+    def set_results(self, results):
+        if results:
+            self.last_result_time = time.time()
+        for result in results:
             try:
-                timeout = 3
-                delta = 0.5
-                f = functools.partial(self.receive, timeout)
-                result = await asyncio.wait_for(self.loop.run_in_executor(None, f), timeout=timeout + delta)
-            except asyncio.TimeoutError:
-                logger.warning("Tonlib Stuck!")
-                asyncio.ensure_future(self.restart_hook(), loop=self.loop)
+                extra, response = split_extra(result)
+                # errors caused by request itself (e.g. invalid address) don't tell anything about tonlib health
+                if is_error_response(response) and is_retryable_error(json.loads(response)):
+                    self.error_num += 1
+                future = self.futures.pop(extra)
+                if future is not None and not future.done():
+                    future.set_result(response)
             except Exception as e:
-                logger.warning("Tonlib crashed!")
-                asyncio.ensure_future(self.restart_hook(), loop=self.loop)
-            if result and isinstance(result, dict) and ("@extra" in result) and (result["@extra"] in self.futures):
-                try:
-                    if not self.futures[result["@extra"]].done():
-                        self.futures[result["@extra"]].set_result(result)
-                        self.futures.pop(result["@extra"])
-                except Exception as e:
-                    logger.error(f'Tonlib receiving result exception: {e}')
+                logger.error(f'Tonlib receiving result exception: {e}')
 
-            if (not len(self.futures)) and (self.shutdown_state in ["started", "finished"]):
-                break
-        self.shutdown_state = "finished"
+        if (not len(self.futures)) and (self.shutdown_state == "started"):
+            self.shutdown_state = "finished"
 
     async def del_expired_futures(self):
         while True:
-            now = time.time()
-            to_del = []
-            for i in self.futures:
-                if float(i.split(":")[0]) > now:
-                    break
-                if self.futures[i].done():
-                    to_del.append(i)
-                    continue
-                to_del.append(i)
-                self.futures[i].cancel()
-            for i in to_del:
-                self.futures.pop(i)
+            for future in self.futures.expire():
+                future.cancel()
+                self.error_num += 1
 
             if (not len(self.futures)) and (self.shutdown_state in ["started", "finished"]):
                 break
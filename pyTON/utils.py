@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import functools
+import itertools
+import heapq
+import time
 import base64
 import asyncio
 import struct
@@ -17,6 +20,106 @@ class TonLibWrongResult(Exception):
     def __str__(self):
         return f"{self.description} - unexpected lite server response:\n\t{json.dumps(self.result)}"
 
+class TonlibRawResult(bytes):
+    """
+    Tonlib response kept as JSON bytes, so it can be passed along without parsing.
+    """
+    def is_error(self):
+        return is_error_response(self)
+
+
+def is_error_response(response: bytes):
+    # tonlib always serializes @type as the first field
+    return response.startswith(b'{"@type":"error"')
+
+
+def response_type(response: bytes):
+    """
+    @type of tonlib response without parsing it.
+    """
+    prefix = b'{"@type":"'
+    end = response.find(b'"', len(prefix))
+    if not response.startswith(prefix) or end == -1:
+        return 'unknown'
+    return response[len(prefix):end].decode('utf-8')
+
+
+def tonlib_error(result):
+    """
+    :return: tonlib error object if result is an error, otherwise None
+    """
+    if isinstance(result, TonlibRawResult):
+        return json.loads(result) if result.is_error() else None
+    if isinstance(result, dict) and result.get('@type') == 'error':
+        return result
+    return None
+
+def is_retryable_error(error):
+    """
+    4xx codes mean that request itself is wrong (e.g. invalid address), so other liteserver won't help.
+    Liteserver and network errors have other codes.
+    """
+    code = error.get('code', 0)
+    return code == 429 or not 400 <= code < 500
+
+def is_retryable_exception(exception):
+    if isinstance(exception, asyncio.TimeoutError):
+        return True
+    if isinstance(exception, TonLibWrongResult):
+        error = tonlib_error(exception.result)
+        return error is not None and is_retryable_error(error)
+    return False
+
+
+class ExpiringFutures:
+    """
+    Futures of requests in flight indexed by integer request id. Deadlines are kept in a heap,
+    so adding a request is O(log n) and finished requests are just removed from the index.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.futures = {}
+        self.deadlines = []
+        self.ids = itertools.count(1)
+
+    def create(self, timeout):
+        """
+        :return: tuple (request_id, future)
+        """
+        request_id = next(self.ids)
+        future = self.loop.create_future()
+        self.futures[request_id] = future
+        heapq.heappush(self.deadlines, (time.time() + timeout, request_id))
+        return request_id, future
+
+    def get(self, request_id):
+        return self.futures.get(request_id)
+
+    def pop(self, request_id):
+        return self.futures.pop(request_id, None)
+
+    def values(self):
+        return self.futures.values()
+
+    def __len__(self):
+        return len(self.futures)
+
+    def expire(self):
+        """
+        Remove requests with passed deadline from the index.
+
+        :return: list of their futures which are not done yet
+        """
+        now = time.time()
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, request_id = heapq.heappop(self.deadlines)
+            future = self.futures.pop(request_id, None)
+            if future is not None and not future.done():
+                expired.append(future)
+        return expired
+
+
 def b64str_to_bytes(b64str):
     b64bytes = codecs.encode(b64str, "utf8")
     return codecs.decode(b64bytes, "base64")
@@ -0,0 +1,25 @@
+import os
+import sys
+
+# settings.yaml is read with environment variables substituted when config is imported
+os.environ.setdefault('TON_API_CACHE_ENABLED', 'false')
+os.environ.setdefault('TON_API_LOGS_ENABLED', 'false')
+os.environ.setdefault('TON_API_RATE_LIMIT_ENABLED', 'false')
+os.environ.setdefault('TON_API_GET_METHODS_ENABLED', 'true')
+os.environ.setdefault('TON_API_JSON_RPC_ENABLED', 'true')
+os.environ.setdefault('TON_API_SHARED_POOL_ENABLED', 'false')
+os.environ.setdefault('TON_API_WEBSERVERS_WORKERS', '1')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    """
+    Tests run without redis and immutable store unless they set them up.
+    """
+    import pyTON.cache
+    monkeypatch.setattr(pyTON.cache, 'cache', None)
+    monkeypatch.setattr(pyTON.cache, 'store', None)
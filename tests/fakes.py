@@ -0,0 +1,52 @@
+import inspect
+
+from pyTON.multiclient import TonlibMultiClient
+
+
+class FakeMultiClient(TonlibMultiClient):
+    """
+    TonlibMultiClient without liteserver clients: requests are recorded and answered by handler(method, *args, **kwargs),
+    which can be a coroutine function.
+    """
+    def __init__(self, handler):
+        # clients aren't started, so event loop isn't needed
+        super().__init__(None, {'liteservers': []}, './ton_keystore/')
+        self.all_clients = []
+        self.handler = handler
+        self.requests = []
+
+    async def dispatch_request(self, method, *args, **kwargs):
+        self.requests.append((method, args, kwargs))
+        result = self.handler(method, *args, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def dispatch_archive_request(self, method, *args, **kwargs):
+        return await self.dispatch_request(method, *args, **kwargs)
+
+
+class FakeRedis:
+    """
+    Commands of redis used by TonlibResultCache, values never expire.
+    """
+    def __init__(self):
+        self.values = {}
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def set(self, key, value, ex=None, px=None, nx=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value if isinstance(value, bytes) else str(value).encode()
+        return True
+
+    async def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    async def exists(self, key):
+        return int(key in self.values)
+
+    async def delete(self, key):
+        return int(self.values.pop(key, None) is not None)
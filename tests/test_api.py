@@ -0,0 +1,303 @@
+import json
+import asyncio
+
+from types import SimpleNamespace
+from collections import defaultdict
+
+import pytest
+
+# test client of fastapi needs requests or httpx depending on the version
+TestClient = pytest.importorskip('fastapi.testclient').TestClient
+
+import pyTON.main
+import pyTON.logging
+from pyTON.utils import TonLibWrongResult
+
+from fakes import FakeMultiClient
+
+FULLBLOCK = {'@type': 'ton.blockIdExt', 'workchain': -1, 'shard': '-9223372036854775808', 'seqno': 1,
+             'root_hash': 'cm9vdA==', 'file_hash': 'ZmlsZQ=='}
+
+
+@pytest.fixture
+def tonlib(monkeypatch):
+    """
+    Liteserver requests of the app are answered by tonlib.handler.
+    """
+    client = FakeMultiClient(lambda method, *args, **kwargs: {'@type': 'error', 'code': 500, 'message': method})
+    monkeypatch.setattr(pyTON.main, 'tonlib', client)
+    return client
+
+
+@pytest.fixture
+def api(tonlib):
+    # startup isn't run, tonlib is set by the fixture
+    return TestClient(pyTON.main.app, raise_server_exceptions=False)
+
+
+def block_pages(tonlib, pages, closed):
+    async def get_full_block_id(*args):
+        return FULLBLOCK
+
+    async def iter_block_transactions(fullblock, count, after_lt=None, after_hash=None):
+        try:
+            for page in pages:
+                if isinstance(page, Exception):
+                    raise page
+                yield {'@type': 'blocks.transactions', 'id': fullblock, 'req_count': count, 'incomplete': True,
+                       'transactions': [{'account': a, 'lt': '1', 'hash': ''} for a in page]}
+        finally:
+            closed.append(True)
+
+    tonlib.get_full_block_id = get_full_block_id
+    tonlib.iter_block_transactions = iter_block_transactions
+
+
+def test_block_transactions_stream(api, tonlib):
+    closed = []
+    block_pages(tonlib, [['a', 'b'], [], ['c']], closed)
+
+    response = api.get('/getBlockTransactionsStream', params={'workchain': -1, 'shard': -9223372036854775808, 'seqno': 1})
+
+    assert response.status_code == 200
+    result = response.json()['result']
+    assert [t['account'] for t in result['transactions']] == ['a', 'b', 'c']
+    assert result['incomplete'] is False and result['id'] == FULLBLOCK
+    assert closed == [True]
+
+
+def test_block_transactions_stream_first_page_error(api, tonlib):
+    closed = []
+    block_pages(tonlib, [TonLibWrongResult('failed', {'@type': 'error', 'code': 500})], closed)
+
+    response = api.get('/getBlockTransactionsStream', params={'workchain': -1, 'shard': -9223372036854775808, 'seqno': 1})
+
+    assert response.status_code == 500
+    assert response.json()['ok'] is False
+    assert closed == [True]
+
+
+
+class FakeMongo:
+    def __init__(self):
+        self.records = defaultdict(list)
+
+    def __getitem__(self, name):
+        return self
+
+    def __getattr__(self, collection):
+        return SimpleNamespace(insert_one=self.records[collection].append)
+
+
+@pytest.fixture
+def logs(monkeypatch):
+    mongo = FakeMongo()
+    monkeypatch.setitem(pyTON.main.settings['logs'], 'enabled', True)
+    monkeypatch.setattr(pyTON.logging, 'mongo_client', mongo)
+    monkeypatch.setattr(pyTON.logging, 'mongo_db', 'pyton', raising=False)
+    return mongo
+
+
+def test_stream_is_not_buffered_with_logs(tonlib, logs):
+    first_chunk_sent = asyncio.Event()
+
+    async def get_full_block_id(*args):
+        return FULLBLOCK
+
+    async def iter_block_transactions(fullblock, count, after_lt=None, after_hash=None):
+        for page in [['a', 'b'], ['c']]:
+            yield {'@type': 'blocks.transactions', 'id': fullblock, 'req_count': count, 'incomplete': True,
+                   'transactions': [{'account': a, 'lt': '1', 'hash': ''} for a in page]}
+            # the next page is made only after the client got the first one
+            await asyncio.wait_for(first_chunk_sent.wait(), 5)
+
+    tonlib.get_full_block_id = get_full_block_id
+    tonlib.iter_block_transactions = iter_block_transactions
+
+    async def scenario():
+        disconnected = asyncio.Event()
+        messages = []
+        requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+            if message['type'] == 'http.response.body' and message.get('body'):
+                first_chunk_sent.set()
+
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+                 'path': '/getBlockTransactionsStream', 'raw_path': b'/getBlockTransactionsStream', 'root_path': '',
+                 'query_string': b'workchain=-1&shard=-9223372036854775808&seqno=1', 'headers': [],
+                 'client': ('127.0.0.1', 1), 'server': ('testserver', 80)}
+        await pyTON.main.app(scope, receive, send)
+        disconnected.set()
+        return messages
+
+    messages = asyncio.run(scenario())
+
+    assert messages[0]['status'] == 200
+    body = b''.join(m.get('body', b'') for m in messages[1:])
+    assert [t['account'] for t in json.loads(body)['result']['transactions']] == ['a', 'b', 'c']
+    stats, = logs.records['request_stats']
+    assert stats['status_code'] == 200 and stats['url'].endswith('/getBlockTransactionsStream')
+
+
+WALLET = 'EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N'
+OTHER_WALLET = 'EQBfBWT7X2BHg9tXAxzhz2aKiNTU1tpt5NsiK0uSDW_YAJ67'
+
+
+def account_state(address):
+    return {'@type': 'raw.fullAccountState', 'balance': str(len(address)), 'code': '', 'data': '', 'frozen_hash': '',
+            'last_transaction_id': {'@type': 'internal.transactionId', 'lt': '10', 'hash': 'aGFzaA=='}}
+
+
+def test_run_get_method_batch(api, tonlib):
+    def handler(method, *args, **kwargs):
+        if method == 'raw_get_account_state':
+            return account_state(args[0])
+        assert method == 'raw_run_methods'
+        address, calls, last_transaction_lt = args
+        return [{'@type': 'error', 'code': 500, 'message': 'failed'} if name == 'fail' else
+                {'gas_used': 0, 'stack': [['num', hex(len(stack))]], 'exit_code': 0, 'address': address, 'method': name}
+                for name, stack in calls]
+    tonlib.handler = handler
+
+    response = api.post('/runGetMethodBatch', json={'calls': [
+        {'address': WALLET, 'method': 'seqno', 'stack': []},
+        {'address': OTHER_WALLET, 'method': 'fail', 'stack': []},
+        {'address': 'invalid', 'method': 'seqno', 'stack': []},
+        {'address': WALLET, 'method': 'get_public_key', 'stack': [['num', 1]]},
+    ]})
+
+    assert response.status_code == 200
+    results = response.json()['result']
+    assert [r['ok'] for r in results] == [True, False, False, True]
+    assert results[0]['result']['method'] == 'seqno' and results[3]['result']['stack'] == [['num', '0x1']]
+    assert results[1] == {'ok': False, 'error': 'failed', 'code': 500}
+    assert results[2]['code'] == 416
+    # calls of a contract are made with one request
+    assert sorted(len(args[1]) for method, args, _ in tonlib.requests if method == 'raw_run_methods') == [1, 2]
+
+
+def test_run_get_method_batch_limit(api, tonlib):
+    calls = [{'address': WALLET, 'method': 'seqno', 'stack': []}] * (pyTON.main.settings.pyton.run_methods_batch.max_calls + 1)
+
+    response = api.post('/runGetMethodBatch', json={'calls': calls})
+
+    assert response.status_code == 400
+    assert tonlib.requests == []
+
+
+def test_get_address_information_batch(api, tonlib):
+    def handler(method, address):
+        if address == WALLET:
+            return account_state(address)
+        return {'@type': 'error', 'code': 500, 'message': 'LITE_SERVER_NETWORK'}
+    tonlib.handler = handler
+
+    response = api.post('/getAddressInformationBatch', json={'addresses': [WALLET, OTHER_WALLET, 'invalid', WALLET]})
+
+    assert response.status_code == 200
+    result = response.json()['result']
+    assert set(result) == {WALLET, OTHER_WALLET, 'invalid'}
+    assert result[WALLET]['ok'] and result[WALLET]['result']['balance'] == str(len(WALLET))
+    assert not result[OTHER_WALLET]['ok'] and result[OTHER_WALLET]['code'] == 500
+    assert not result['invalid']['ok'] and result['invalid']['code'] == 416
+    # every account state is requested once
+    assert len(tonlib.requests) == 2
+
+
+def test_json_rpc_batch(api, tonlib):
+    tonlib.handler = lambda method, *args, **kwargs: {'@type': 'blocks.masterchainInfo', 'last': {'seqno': len(tonlib.requests)}}
+
+    response = api.post('/jsonRPC', json=[
+        {'jsonrpc': '2.0', 'id': 1, 'method': 'getMasterchainInfo', 'params': {}},
+        {'jsonrpc': '2.0', 'id': 'two', 'method': 'getMasterchainInfo'},
+        {'jsonrpc': '2.0', 'id': 3, 'method': 'unknownMethod', 'params': {}},
+        {'jsonrpc': '2.0', 'id': 4, 'method': 'getAddressBalance', 'params': {'address': 'invalid'}},
+    ])
+
+    assert response.status_code == 200
+    results = response.json()
+    # ids are returned as they are
+    assert [r['id'] for r in results] == [1, 'two', 3, 4]
+    assert results[0]['ok'] and results[0]['result'] == results[1]['result']
+    assert results[2] == {'ok': False, 'error': 'Unknown method', 'jsonrpc': '2.0', 'id': 3}
+    assert not results[3]['ok'] and results[3]['code'] == 416
+    # identical calls are made once
+    assert len(tonlib.requests) == 1
+
+
+def test_json_rpc_batch_limit(api, tonlib):
+    calls = [{'jsonrpc': '2.0', 'id': i, 'method': 'getMasterchainInfo'} for i in range(pyTON.main.settings.pyton.json_rpc_batch.max_size + 1)]
+
+    assert api.post('/jsonRPC', json=calls).status_code == 422
+    assert api.post('/jsonRPC', json=[]).status_code == 422
+    assert tonlib.requests == []
+
+
+def test_json_rpc_batch_invalid_call(api, tonlib):
+    tonlib.handler = lambda method, *args, **kwargs: {'@type': 'blocks.masterchainInfo', 'last': {'seqno': 1}}
+
+    response = api.post('/jsonRPC', json=[
+        {'jsonrpc': '2.0', 'id': 1, 'method': 'getMasterchainInfo'},
+        {'jsonrpc': '2.0', 'id': 2, 'params': {}},
+        {'jsonrpc': '2.0', 'id': [3], 'method': 'getMasterchainInfo'},
+        5,
+    ])
+
+    assert response.status_code == 200
+    results = response.json()
+    assert results[0]['ok'] and results[0]['id'] == 1
+    assert [r['code'] for r in results[1:]] == [-32600] * 3
+    assert [r.get('id') for r in results[1:]] == [2, None, None]
+    assert len(tonlib.requests) == 1
+
+
+def test_json_rpc_body_in_chunks(tonlib, logs):
+    tonlib.handler = lambda method, *args, **kwargs: {'@type': 'blocks.masterchainInfo', 'last': {'seqno': 1}}
+    body = json.dumps([{'jsonrpc': '2.0', 'id': i, 'method': 'getMasterchainInfo'} for i in range(3)]).encode()
+
+    async def scenario():
+        messages = []
+        requests = [{'type': 'http.request', 'body': body[:10], 'more_body': True},
+                    {'type': 'http.request', 'body': body[10:], 'more_body': False}]
+
+        async def receive():
+            if requests:
+                return requests.pop(0)
+            await asyncio.sleep(10)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST', 'scheme': 'http',
+                 'path': '/jsonRPC', 'raw_path': b'/jsonRPC', 'root_path': '', 'query_string': b'',
+                 'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+                 'client': ('127.0.0.1', 1), 'server': ('testserver', 80)}
+        await pyTON.main.app(scope, receive, send)
+        return messages
+
+    messages = asyncio.run(scenario())
+
+    assert messages[0]['status'] == 200
+    results = json.loads(b''.join(m.get('body', b'') for m in messages[1:]))
+    assert [r['id'] for r in results] == [0, 1, 2]
+    # middleware got the whole body too
+    stats, = logs.records['request_stats']
+    assert stats['url'].endswith('/jsonRPC?method=batch')
+
+
+def test_json_rpc_id_is_returned_as_is(api, tonlib):
+    tonlib.handler = lambda method, *args, **kwargs: {'@type': 'blocks.masterchainInfo', 'last': {'seqno': 1}}
+
+    for _id in [3, '3', 'three']:
+        response = api.post('/jsonRPC', json={'jsonrpc': '2.0', 'id': _id, 'method': 'getMasterchainInfo'})
+        assert response.json()['id'] == _id
+    assert 'id' not in api.post('/jsonRPC', json={'jsonrpc': '2.0', 'method': 'getMasterchainInfo'}).json()
@@ -0,0 +1,142 @@
+import time
+
+import pytest
+
+from pyTON.balancer import ClientStats, CircuitBreaker, HedgingBudget, get_strategy, least_outstanding, power_of_two_choices, ewma_latency
+
+
+class Client:
+    def __init__(self, number, in_flight=0, latency=None):
+        self.number = number
+        self.stats = ClientStats()
+        self.stats.in_flight = in_flight
+        self.stats.latency = latency
+
+    def __repr__(self):
+        return f"Client({self.number})"
+
+
+def test_least_outstanding():
+    clients = [Client(0, 3), Client(1, 1), Client(2, 2)]
+    assert {least_outstanding(clients).number for _ in range(20)} == {1}
+
+
+def test_power_of_two_choices():
+    assert power_of_two_choices([Client(0, 5)]).number == 0
+    clients = [Client(0, 3), Client(1, 1, latency=0.5), Client(2, 1, latency=0.1)]
+    # the most loaded client loses every pair
+    assert {power_of_two_choices(clients).number for _ in range(200)} == {1, 2}
+    assert power_of_two_choices(clients[1:]).number == 2
+
+
+def test_ewma_latency():
+    slow, loaded, fast = Client(0, 0, latency=1.0), Client(1, 10, latency=0.2), Client(2, 1, latency=0.2)
+    assert ewma_latency([slow, loaded, fast]) is fast
+    # clients without measured latency are tried first
+    new = Client(3)
+    assert ewma_latency([slow, fast, new]) is new
+
+
+def test_get_strategy():
+    assert get_strategy('p2c') is power_of_two_choices
+    with pytest.raises(ValueError):
+        get_strategy('round_robin')
+
+
+def test_client_stats():
+    stats = ClientStats()
+    stats.task_started()
+    stats.task_started()
+    stats.task_finished(1.0)
+    stats.task_finished(None)
+    assert stats.in_flight == 0
+    assert stats.latency == 1.0
+    stats.task_started()
+    stats.task_finished(2.0)
+    assert stats.latency == 0.2 * 2.0 + 0.8 * 1.0
+
+
+def test_latency_percentile():
+    stats = ClientStats()
+    for i in range(9):
+        stats.task_started()
+        stats.task_finished(i / 100)
+    assert stats.latency_percentile(95) is None
+    for i in range(9, 101):
+        stats.task_started()
+        stats.task_finished(i / 100)
+    # only the last window tasks are taken
+    assert stats.latency_percentile(0) == 0.01
+    assert stats.latency_percentile(50) == 0.51
+    assert stats.latency_percentile(100) == 1.0
+
+
+def test_hedging_budget():
+    budget = HedgingBudget(ratio=0.25, burst=3)
+    for _ in range(3):
+        budget.add_request()
+    assert not budget.take_hedge()
+    budget.add_request()
+    assert budget.take_hedge() and not budget.take_hedge()
+
+    # long healthy period doesn't let more than burst hedges in a row
+    for _ in range(1000):
+        budget.add_request()
+    hedges = 0
+    for _ in range(100):
+        budget.add_request()
+        hedges += budget.take_hedge()
+    assert 25 <= hedges <= 3 + 25
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+
+def test_circuit_breaker_transitions(clock):
+    breaker = CircuitBreaker(window=10, min_tasks=4, failure_ratio=0.5, cool_off=30, probes=2)
+
+    # not enough tasks to judge
+    for _ in range(3):
+        breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allows_task(0)
+
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allows_task(0)
+
+    # cool off is over: limited number of probes is let through
+    clock[0] += 30
+    assert breaker.allows_task(1)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allows_task(2)
+
+    # failed probe opens breaker again
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allows_task(0)
+
+    clock[0] += 30
+    assert breaker.allows_task(0)
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allows_task(100)
+
+    # failures before opening are forgotten
+    for _ in range(3):
+        breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_circuit_breaker_tolerates_failure_ratio(clock):
+    breaker = CircuitBreaker(window=10, min_tasks=4, failure_ratio=0.5, cool_off=30, probes=2)
+    for success in [True, False] * 10:
+        breaker.record(success)
+    assert breaker.state == CircuitBreaker.CLOSED
+    # results of tasks sent before breaker opened don't close it
+    breaker.open()
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.OPEN
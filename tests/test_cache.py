@@ -0,0 +1,127 @@
+import json
+import asyncio
+
+import pytest
+
+import pyTON.cache
+from pyTON.cache import TonlibResultCache
+from pyTON.utils import TonlibRawResult
+
+from fakes import FakeMultiClient, FakeRedis
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(pyTON.cache.aioredis, 'from_url', lambda url: FakeRedis())
+    cache = TonlibResultCache()
+    monkeypatch.setattr(pyTON.cache, 'cache', cache)
+    return cache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(pyTON.cache.time, 'time', lambda: now[0])
+    return now
+
+
+def account_states():
+    states = []
+
+    def handler(method, address):
+        states.append(address)
+        return {'@type': 'raw.fullAccountState', 'balance': str(len(states)), 'last_transaction_id': {'lt': '1', 'hash': ''}}
+
+    return states, handler
+
+
+def test_results_are_cached_per_block(cache):
+    states, handler = account_states()
+    client = FakeMultiClient(handler)
+    client.current_consensus_block = 1
+
+    async def scenario():
+        first = await client.raw_get_account_state('A')
+        second = await client.raw_get_account_state('A')
+        client.current_consensus_block = 2
+        third = await client.raw_get_account_state('A')
+        return [r['balance'] for r in (first, second, third)]
+
+    assert asyncio.run(scenario()) == ['1', '1', '2']
+    assert len(states) == 2
+    assert cache.take_stats() == {'raw_get_account_state': {'local': 1, 'redis': 0, 'miss': 2, 'stale': 0}}
+    assert cache.take_stats() == {}
+
+
+def test_stale_value_is_returned_only_within_block(cache, clock):
+    states, handler = account_states()
+    client = FakeMultiClient(handler)
+    client.current_consensus_block = 1
+
+    async def scenario():
+        results = [await client.raw_get_account_state('A')]
+        # expired, but stale value is returned while it's refreshed in background
+        clock[0] += 6
+        results.append(await client.raw_get_account_state('A'))
+        await asyncio.sleep(0.01)
+        results.append(await client.raw_get_account_state('A'))
+        # value of the previous block is never returned
+        clock[0] += 6
+        client.current_consensus_block = 2
+        results.append(await client.raw_get_account_state('A'))
+        return [r['balance'] for r in results]
+
+    assert asyncio.run(scenario()) == ['1', '1', '2', '3']
+    assert cache.stats['raw_get_account_state']['stale'] == 1
+
+
+def test_concurrent_calls_are_coalesced(cache):
+    calls = []
+
+    async def handler(method, *args):
+        calls.append(args)
+        await asyncio.sleep(0.01)
+        return {'@type': 'blocks.masterchainInfo', 'last': {'seqno': 1}}
+
+    client = FakeMultiClient(handler)
+
+    async def scenario():
+        return await asyncio.gather(*[client.getMasterchainInfo() for _ in range(10)])
+
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert all(r == results[0] for r in results)
+
+
+def test_disabled_cache_calls_method_as_is():
+    calls = []
+
+    async def handler(method, *args):
+        calls.append(args)
+        seqno = len(calls)
+        await asyncio.sleep(0.01)
+        return {'@type': 'blocks.masterchainInfo', 'last': {'seqno': seqno}}
+
+    client = FakeMultiClient(handler)
+
+    async def scenario():
+        return await asyncio.gather(*[client.getMasterchainInfo() for _ in range(3)])
+
+    results = asyncio.run(scenario())
+    assert [r['last']['seqno'] for r in results] == [1, 2, 3]
+
+
+def test_raw_and_parsed_results_share_cached_response(cache):
+    def handler(method, *args, raw=False):
+        result = TonlibRawResult(b'{"@type":"ton.blockIdExt","workchain":-1,"seqno":5}')
+        return result if raw else json.loads(result)
+
+    client = FakeMultiClient(handler)
+
+    async def scenario():
+        return await client.lookupBlock(-1, -9223372036854775808, lt=100), await client.lookupBlock(-1, -9223372036854775808, lt=100, raw=True)
+
+    parsed, raw = asyncio.run(scenario())
+    assert parsed == {'@type': 'ton.blockIdExt', 'workchain': -1, 'seqno': 5}
+    assert isinstance(raw, TonlibRawResult) and json.loads(raw) == parsed
+    assert [kwargs for _, _, kwargs in client.requests] == [{'raw': True}]
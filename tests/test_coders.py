@@ -0,0 +1,54 @@
+import pytest
+
+from pyTON.coders import Coder, ZstdMsgpackCoder, coders, get_coder, RAW_TAG
+from pyTON.utils import TonlibRawResult
+
+VALUES = [
+    {'@type': 'raw.fullAccountState', 'balance': '1000', 'code': '', 'last_transaction_id': {'lt': '1', 'hash': 'aGFzaA=='}},
+    [{'account': '0:' + '11' * 32, 'lt': '100', 'hash': ''}] * 3,
+    {'ok': True, 'values': [1, -1, 2 ** 62, 1.5, None, False, 'строка']},
+    [],
+]
+
+
+def make_coder(name):
+    try:
+        return get_coder(name)
+    except ImportError as e:
+        pytest.skip(f"{name} coder isn't available: {e}")
+
+
+@pytest.mark.parametrize('name', sorted(coders))
+def test_values_round_trip(name):
+    coder = make_coder(name)
+    for value in VALUES:
+        data = coder.encode(value)
+        assert isinstance(data, bytes)
+        assert coder.decode(data) == value
+
+
+@pytest.mark.parametrize('name', sorted(coders))
+def test_raw_results_are_kept_as_is(name):
+    coder = make_coder(name)
+    raw = TonlibRawResult(b'{"@type":"blocks.header","global_id":-239}')
+    data = coder.encode(raw)
+    assert data == RAW_TAG + raw
+    decoded = coder.decode(data)
+    assert isinstance(decoded, TonlibRawResult) and decoded == raw
+
+
+def test_large_values_are_compressed():
+    coder = make_coder('zstd_msgpack')
+    value = [{'account': '0:' + '11' * 32, 'lt': str(i)} for i in range(1000)]
+    data = coder.encode(value)
+    assert data[:1] == ZstdMsgpackCoder.COMPRESSED_TAG
+    assert len(data) < len(get_coder('msgpack').encode(value))
+    assert coder.decode(data) == value
+    assert coder.encode(VALUES[0])[:1] != ZstdMsgpackCoder.COMPRESSED_TAG
+
+
+def test_unknown_coder():
+    with pytest.raises(ValueError):
+        get_coder('marshal')
+    with pytest.raises(TypeError):
+        Coder()
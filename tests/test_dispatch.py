@@ -0,0 +1,141 @@
+import time
+import pickle
+import asyncio
+
+import pytest
+
+from config import settings
+from pyTON.utils import TonLibWrongResult, ExpiringFutures
+from pyTON.balancer import ClientStats, CircuitBreaker
+
+from fakes import FakeMultiClient
+
+
+async def answer(result, delay=0.0):
+    await asyncio.sleep(delay)
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def first_result(*answers):
+    async def scenario():
+        client = FakeMultiClient(None)
+        tasks = [asyncio.ensure_future(answer(*a)) for a in answers]
+        return await client._first_result(tasks)
+
+    return asyncio.run(scenario())
+
+
+def test_liteserver_error_does_not_win():
+    error = {'@type': 'error', 'code': 500, 'message': 'LITE_SERVER_NETWORK'}
+    ok = {'@type': 'ok'}
+    assert first_result((error,), (ok, 0.01)) == ok
+    assert first_result((asyncio.TimeoutError(),), (ok, 0.01)) == ok
+
+
+def test_request_error_is_final():
+    error = {'@type': 'error', 'code': 400, 'message': 'INVALID_ACCOUNT_ADDRESS'}
+    assert first_result((error,), ({'@type': 'ok'}, 0.5)) == error
+
+
+def test_last_failure_is_returned():
+    error = {'@type': 'error', 'code': 500, 'message': 'LITE_SERVER_NETWORK'}
+    assert first_result((asyncio.TimeoutError(),), (error, 0.01)) == error
+    with pytest.raises(TonLibWrongResult):
+        first_result((error,), (TonLibWrongResult('failed', error), 0.01))
+
+
+class Liteserver:
+    def __init__(self, number, delay):
+        self.number = number
+        self.delay = delay
+        self.stats = ClientStats()
+        for _ in range(10):
+            self.stats.task_started()
+            self.stats.task_finished(0.001)
+
+
+def hedging_client():
+    client = FakeMultiClient(None)
+
+    async def dispatch(method, liteserver, *args, **kwargs):
+        await asyncio.sleep(liteserver.delay)
+        return {'@type': 'ok', 'number': liteserver.number}
+
+    client._dispatch_request_to_liteserver = dispatch
+    client.choose_client = lambda clients: clients[0]
+    return client
+
+
+def test_hedged_request():
+    async def scenario():
+        slow, fast = Liteserver(0, 1.0), Liteserver(1, 0.0)
+        client = hedging_client()
+        client.hedging_budgets['getMasterchainInfo'].tokens = 1
+
+        result = await client._dispatch_hedged_request('getMasterchainInfo', slow, [slow, fast])
+        assert result['number'] == 1
+
+        # budget is spent, slow liteserver is waited for
+        slow.delay = 0.2
+        result = await client._dispatch_hedged_request('getMasterchainInfo', slow, [slow, fast])
+        assert result['number'] == 0
+        assert client.take_hedging_stats() == {'getMasterchainInfo': {'requests': 2, 'hedged': 1, 'hedge_won': 1}}
+        assert client.take_hedging_stats() == {}
+
+    asyncio.run(scenario())
+
+
+class Connection:
+    """
+    Connection to liteserver client which answers tasks with answer or, if it's None,
+    reports tonlib timeout at the deadline of the task like a client of hanging liteserver does.
+    """
+    def __init__(self, multiclient, answer):
+        self.multiclient = multiclient
+        self.answer = answer
+        self.deadlines = []
+
+    async def send(self, msg_type, task_id, payload):
+        deadline, method, args, kwargs = pickle.loads(payload)
+        self.deadlines.append(deadline)
+        future = self.multiclient.futures.get(task_id)
+        if self.answer is not None:
+            future.set_result(self.answer)
+            return
+
+        def timeout():
+            if not future.done():
+                future.set_exception(asyncio.TimeoutError())
+        asyncio.get_running_loop().call_later(deadline - time.time(), timeout)
+
+
+def liteserver_client(multiclient, number, answer):
+    client = Liteserver(number, 0)
+    client.breaker = CircuitBreaker(**settings.pyton.circuit_breaker)
+    client.connection = Connection(multiclient, answer)
+    client.info = {'number': number}
+    return client
+
+
+def test_retry_after_liteserver_timeout(monkeypatch):
+    monkeypatch.setitem(settings['pyton'], 'request_timeout', 1)
+    monkeypatch.setitem(settings['pyton']['retry'], 'min_time_left', 0.1)
+
+    async def scenario():
+        multiclient = FakeMultiClient(None)
+        multiclient.futures = ExpiringFutures(asyncio.get_running_loop())
+        multiclient.choose_client = lambda clients: clients[0]
+        hanging = liteserver_client(multiclient, 0, None)
+        working = liteserver_client(multiclient, 1, b'{"@type":"blocks.masterchainInfo"}')
+
+        start = time.time()
+        result = await multiclient._dispatch_with_retry('getMasterchainInfo', [hanging, working], raw=True)
+
+        assert result == b'{"@type":"blocks.masterchainInfo"}'
+        # the first attempt got half of the request timeout, the retry the rest of it
+        assert hanging.connection.deadlines[0] - start == pytest.approx(0.5, abs=0.05)
+        assert working.connection.deadlines[0] - start == pytest.approx(1, abs=0.05)
+
+    asyncio.run(scenario())
@@ -0,0 +1,51 @@
+import time
+import asyncio
+
+import pytest
+
+from pyTON.utils import ExpiringFutures
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+
+def test_expire_in_deadline_order(clock):
+    loop = asyncio.new_event_loop()
+    try:
+        futures = ExpiringFutures(loop)
+        slow_id, slow = futures.create(10)
+        fast_id, fast = futures.create(1)
+        assert slow_id != fast_id and len(futures) == 2
+        assert futures.get(fast_id) is fast
+
+        assert futures.expire() == []
+        clock[0] += 1
+        assert futures.expire() == [fast]
+        assert futures.get(fast_id) is None and len(futures) == 1
+
+        clock[0] += 9
+        assert futures.expire() == [slow]
+        assert len(futures) == 0
+    finally:
+        loop.close()
+
+
+def test_finished_requests_dont_expire(clock):
+    loop = asyncio.new_event_loop()
+    try:
+        futures = ExpiringFutures(loop)
+        popped_id, popped = futures.create(1)
+        done_id, done = futures.create(1)
+        assert futures.pop(popped_id) is popped
+        assert futures.pop(popped_id) is None
+        done.set_result(b'{}')
+
+        clock[0] += 1
+        assert futures.expire() == []
+        assert len(futures) == 0
+    finally:
+        loop.close()
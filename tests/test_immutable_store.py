@@ -0,0 +1,109 @@
+import time
+import asyncio
+import sqlite3
+import threading
+
+import pyTON.cache
+from pyTON.cache import ImmutableStore, LocalCache, get_immutable, set_immutable, immutable_key
+
+
+class LocalOnlyCache:
+    """
+    TonlibResultCache without redis.
+    """
+    def __init__(self):
+        self.local = LocalCache(2 ** 20)
+        self.local_hits = 0
+
+    def get_local(self, name, key):
+        value = self.local.get(key)
+        self.local_hits += value is not None
+        return value
+
+    def set_local(self, name, key, value, expire):
+        self.local.set(key, value, expire)
+
+    async def get(self, name, key, expire):
+        return self.get_local(name, key)
+
+    async def set(self, name, key, value, expire, hard_expire=None):
+        self.local.set(key, value, expire)
+
+
+def test_store_round_trip(tmp_path):
+    store = ImmutableStore(str(tmp_path / 'store.sqlite'), 2 ** 30, 0.005)
+
+    async def scenario():
+        await store.set('key', b'value')
+        return await store.get('key'), await store.get('missing')
+
+    assert asyncio.run(scenario()) == (b'value', None)
+
+
+def test_queries_are_made_concurrently(tmp_path, monkeypatch):
+    store = ImmutableStore(str(tmp_path / 'store.sqlite'), 2 ** 30, 0.005, threads=2)
+    asyncio.run(store.set('key', b'value'))
+    connections = {}
+    read = store.read
+
+    def slow_read(key):
+        time.sleep(0.05)
+        connections[threading.get_ident()] = store.connect()
+        return read(key)
+    monkeypatch.setattr(store, 'read', slow_read)
+
+    async def scenario():
+        return await asyncio.gather(*[store.get('key') for _ in range(4)])
+
+    assert asyncio.run(scenario()) == [b'value'] * 4
+    # every thread uses its own connection
+    assert len(connections) == 2 and len(set(map(id, connections.values()))) == 2
+
+
+def test_locked_store_is_skipped(tmp_path):
+    path = str(tmp_path / 'store.sqlite')
+    store = ImmutableStore(path, 2 ** 30, 0.005)
+    asyncio.run(store.set('key', b'value'))
+
+    # another process holds write lock of the file
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute('BEGIN EXCLUSIVE')
+    try:
+        async def scenario():
+            await store.set('other', b'value')
+            # readers aren't blocked by writer in WAL mode
+            return await store.get('key')
+
+        assert asyncio.run(scenario()) == b'value'
+    finally:
+        other.execute('ROLLBACK')
+        other.close()
+    assert asyncio.run(store.get('other')) is None
+
+
+def test_local_cache_is_checked_before_store(tmp_path, monkeypatch):
+    store = ImmutableStore(str(tmp_path / 'store.sqlite'), 2 ** 30, 0.005)
+    reads = []
+    read = store.read
+    monkeypatch.setattr(store, 'read', lambda key: reads.append(key) or read(key))
+    cache = LocalOnlyCache()
+    monkeypatch.setattr(pyTON.cache, 'store', store)
+    monkeypatch.setattr(pyTON.cache, 'cache', cache)
+    key = immutable_key('block', -1, 1)
+
+    async def scenario():
+        await set_immutable('lookupBlock', key, {'seqno': 1})
+        return [await get_immutable('lookupBlock', key) for _ in range(3)]
+
+    assert asyncio.run(scenario()) == [{'seqno': 1}] * 3
+    assert reads == []
+    assert cache.local_hits == 3
+
+    # value found only in the store is kept in local cache
+    cache.local = LocalCache(2 ** 20)
+
+    async def scenario():
+        return [await get_immutable('lookupBlock', key) for _ in range(3)]
+
+    assert asyncio.run(scenario()) == [{'seqno': 1}] * 3
+    assert reads == [key]
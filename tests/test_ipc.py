@@ -0,0 +1,69 @@
+import socket
+import asyncio
+
+from pyTON.ipc import FramedConnection, FRAME_HEADER, STREAM_LIMIT
+
+
+async def connected_pair():
+    a, b = socket.socketpair()
+    return await FramedConnection.open_socket(a), await FramedConnection.open_socket(b)
+
+
+def test_frames_round_trip():
+    payloads = [b'', b'{"@type":"ok"}', bytes(range(256)) * 1000, b'x' * (STREAM_LIMIT + 1)]
+
+    async def scenario():
+        sender, receiver = await connected_pair()
+        received = []
+
+        async def receive():
+            for _ in payloads:
+                received.append(await receiver.receive())
+
+        receiving = asyncio.ensure_future(receive())
+        for i, payload in enumerate(payloads):
+            await sender.send(i + 1, 1000 + i, payload)
+        await receiving
+        sender.close()
+        receiver.close()
+        return received
+
+    received = asyncio.run(scenario())
+    assert received == [(i + 1, 1000 + i, payload) for i, payload in enumerate(payloads)]
+
+
+def test_frame_is_read_from_partial_writes():
+    async def scenario():
+        a, b = socket.socketpair()
+        receiver = await FramedConnection.open_socket(b)
+        frame = FRAME_HEADER.pack(5, 2, 2 ** 40) + b'hello' + FRAME_HEADER.pack(0, 3, 7)
+        receiving = asyncio.ensure_future(receiver.receive())
+        # frame arrives split inside the header and the payload
+        bounds = [0, 3, FRAME_HEADER.size + 2, len(frame)]
+        for start, end in zip(bounds, bounds[1:]):
+            assert not receiving.done()
+            a.send(frame[start:end])
+            await asyncio.sleep(0.01)
+        first = await receiving
+        second = await receiver.receive()
+        a.close()
+        receiver.close()
+        return first, second
+
+    assert asyncio.run(scenario()) == ((2, 2 ** 40, b'hello'), (3, 7, b''))
+
+
+def test_concurrent_sends_are_not_interleaved():
+    payloads = [bytes([i]) * (i * 10000) for i in range(1, 30)]
+
+    async def scenario():
+        sender, receiver = await connected_pair()
+        sending = asyncio.gather(*[sender.send(1, i, payload) for i, payload in enumerate(payloads)])
+        received = [await receiver.receive() for _ in payloads]
+        await sending
+        sender.close()
+        receiver.close()
+        return received
+
+    received = asyncio.run(scenario())
+    assert sorted((msg_id, payload) for _, msg_id, payload in received) == list(enumerate(payloads))
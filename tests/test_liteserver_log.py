@@ -0,0 +1,31 @@
+from pyTON.multiclient import log_liteserver_task
+from pyTON.client import TonlibClientResult
+from pyTON.utils import response_type
+
+
+def task_result(result=None, exception=None):
+    return TonlibClientResult(1, 'raw_get_account_state', elapsed_time=0.1, params=[('addr',), {}],
+                              result=result, exception=exception, liteserver_info={'number': 0})
+
+
+def test_response_type():
+    assert response_type(b'{"@type":"raw.fullAccountState","balance":"1"}') == 'raw.fullAccountState'
+    assert response_type(b'{"@type":"error","code":500}') == 'error'
+    assert response_type(b'[]') == 'unknown'
+    assert response_type(b'{"@type":"') == 'unknown'
+
+
+def test_successful_raw_result_is_not_parsed():
+    # parsing this response would fail
+    record = log_liteserver_task(task_result(b'{"@type":"raw.fullAccountState","balance":'))
+    assert record['result_type'] == 'raw.fullAccountState'
+    assert record['details'] == {}
+
+
+def test_errors_are_logged_with_details():
+    record = log_liteserver_task(task_result(b'{"@type":"error","code":500,"message":"LITE_SERVER_NETWORK"}'))
+    assert record['result_type'] == 'error'
+    assert record['details']['result'] == {'@type': 'error', 'code': 500, 'message': 'LITE_SERVER_NETWORK'}
+
+    record = log_liteserver_task(task_result(exception=TimeoutError()))
+    assert record['result_type'] == 'error' and record['details']['result'] is None
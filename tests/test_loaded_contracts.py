@@ -0,0 +1,112 @@
+import asyncio
+
+from pyTON.client import TonlibClient, LoadedContracts
+
+
+class FakeTonlib:
+    """
+    Tonlib with a single account which last transaction lt is taken from lts on every raw.getAccountState.
+    """
+    def __init__(self, lts):
+        self.lts = list(lts)
+        self.loaded = []
+        self.forgotten = []
+        self.states = 0
+
+    async def execute(self, request):
+        if request['@type'] == 'raw.getAccountState':
+            self.states += 1
+            lt = self.lts.pop(0) if len(self.lts) > 1 else self.lts[0]
+            return {'@type': 'raw.fullAccountState', 'last_transaction_id': {'lt': str(lt), 'hash': ''}}
+        if request['@type'] == 'smc.load':
+            self.loaded.append(len(self.loaded) + 1)
+            return {'@type': 'smc.info', 'id': self.loaded[-1]}
+        if request['@type'] == 'smc.forget':
+            self.forgotten.append(request['id'])
+            return {'@type': 'ok'}
+        if request['@type'] == 'smc.runGetMethod':
+            return {'@type': 'smc.runResult', 'gas_used': 0, 'stack': [], 'exit_code': 0, 'contract': request['id']}
+        return {'@type': 'error', 'code': 400, 'message': request['@type']}
+
+
+def make_client(tonlib):
+    client = TonlibClient({'liteservers': [{}]}, keystore='./ton_keystore/')
+    client.tonlib_wrapper = tonlib
+    client.loaded_contracts = LoadedContracts(2)
+    client.loaded_contracts_num = 0
+    return client
+
+
+def test_contract_is_reused_for_same_last_transaction():
+    tonlib = FakeTonlib([10])
+    client = make_client(tonlib)
+
+    async def scenario():
+        first = await client.raw_run_method('A', 'seqno', [], last_transaction_lt=10)
+        second = await client.raw_run_methods('A', [('seqno', []), ('get_public_key', [])], last_transaction_lt=10)
+        third = await client.raw_run_method('A', 'seqno', [], last_transaction_lt=10)
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+
+    # contract is kept once it's requested again at the same last transaction
+    assert tonlib.loaded == [1, 2]
+    assert tonlib.forgotten == [1]
+    assert first['contract'] == 1 and [r['contract'] for r in second] == [2, 2] and third['contract'] == 2
+    assert tonlib.states == 2
+
+
+def test_changing_contract_is_loaded_without_checks():
+    tonlib = FakeTonlib([10])
+    client = make_client(tonlib)
+
+    async def scenario():
+        for lt in range(10, 15):
+            await client.raw_run_method('A', 'seqno', [], last_transaction_lt=lt)
+
+    asyncio.run(scenario())
+
+    assert tonlib.loaded == [1, 2, 3, 4, 5]
+    assert tonlib.forgotten == [1, 2, 3, 4, 5]
+    assert tonlib.states == 0
+
+
+def test_contract_of_other_state_is_not_kept():
+    # requested lt comes from stale state: account already has newer transaction
+    tonlib = FakeTonlib([11])
+    client = make_client(tonlib)
+
+    async def scenario():
+        for _ in range(3):
+            await client.raw_run_method('A', 'seqno', [], last_transaction_lt=10)
+
+    asyncio.run(scenario())
+
+    assert tonlib.loaded == [1, 2, 3]
+    assert tonlib.forgotten == [1, 2, 3]
+    assert client.loaded_contracts.get('A', 10) is None
+
+
+def test_contract_loaded_while_state_changes_is_not_kept():
+    tonlib = FakeTonlib([10, 11])
+    client = make_client(tonlib)
+
+    async def scenario():
+        for _ in range(2):
+            await client.raw_run_method('A', 'seqno', [], last_transaction_lt=10)
+
+    asyncio.run(scenario())
+
+    assert tonlib.forgotten == [1, 2]
+    assert client.loaded_contracts.get('A', 10) is None
+
+
+def test_evicted_contracts_are_forgotten():
+    contracts = LoadedContracts(1)
+    assert contracts.add('A', 10, 1) == []
+    contracts.acquire(1)
+    # contract in use is forgotten only when released
+    assert contracts.add('B', 20, 2) == []
+    assert contracts.get('A', 10) is None
+    assert contracts.release(1)
+    assert contracts.add('B', 21, 3) == [2]
@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+from config import settings
+from pyTON.utils import TonLibWrongResult
+
+from fakes import FakeMultiClient
+
+ACCOUNT = {'raw_form': '0:' + '11' * 32}
+SHARDS = {'@type': 'blocks.shards', 'shards': [{'@type': 'ton.blockIdExt', 'workchain': 0, 'shard': str(s), 'seqno': 1}
+                                               for s in range(6)]}
+
+
+def test_searches_are_bounded_and_lookup_errors_raised():
+    running = []
+    concurrency = []
+
+    async def handler(method, *args, **kwargs):
+        if method == 'getShards':
+            return SHARDS
+        assert method == 'lookupBlock'
+        running.append(args)
+        concurrency.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(args)
+        return {'@type': 'error', 'code': 500, 'message': 'LITE_SERVER_NOTREADY'}
+
+    client = FakeMultiClient(handler)
+    with pytest.raises(TonLibWrongResult):
+        asyncio.run(client.locate_tx(ACCOUNT, 1000, 3, lambda tx: True))
+
+    assert len(concurrency) == len(SHARDS['shards']) * 3
+    assert max(concurrency) == settings.pyton.locate_tx_concurrency
+    # nearer blocks are searched first
+    lts = [args[3] for method, args, _ in client.requests if method == 'lookupBlock']
+    assert lts == sorted(lts)
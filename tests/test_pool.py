@@ -0,0 +1,55 @@
+import time
+import asyncio
+import multiprocessing
+
+from pyTON.pool import LiteserverPoolSupervisor, dump_payload, load_payload, dump_exception, load_exception
+from pyTON.utils import TonlibRawResult, TonLibWrongResult, is_retryable_exception
+
+
+def test_payload_round_trip():
+    request = ['dispatch_request', ('raw_send_message', b'\x00boc'), {'archival': True}]
+    assert load_payload(dump_payload(request)) == ['dispatch_request', ['raw_send_message', b'\x00boc'], {'archival': True}]
+
+
+def test_exception_round_trip():
+    timeout = load_exception(dump_exception(asyncio.TimeoutError()))
+    assert isinstance(timeout, asyncio.TimeoutError)
+
+    error = TonlibRawResult(b'{"@type":"error","code":500,"message":"LITE_SERVER_NETWORK"}')
+    wrong_result = load_exception(dump_exception(TonLibWrongResult("Can't get shards", error)))
+    assert isinstance(wrong_result, TonLibWrongResult)
+    assert wrong_result.description == "Can't get shards" and wrong_result.result['code'] == 500
+    # worker retries it the same way the pool would
+    assert is_retryable_exception(wrong_result)
+
+    other = load_exception(dump_exception(KeyError('seqno')))
+    assert type(other) is Exception and str(other) == str(KeyError('seqno'))
+
+
+class DyingPool(multiprocessing.Process):
+    starts = multiprocessing.Value('i', 0)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+
+    def run(self):
+        with self.starts.get_lock():
+            self.starts.value += 1
+
+
+class DyingPoolSupervisor(LiteserverPoolSupervisor):
+    pool_class = DyingPool
+
+
+def test_supervisor_restarts_pool():
+    supervisor = DyingPoolSupervisor({'liteservers': []}, keystore=None, socket_path=None, restart_delay=0.01)
+    supervisor.start()
+    try:
+        deadline = time.time() + 10
+        while DyingPool.starts.value < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        assert DyingPool.starts.value >= 3
+    finally:
+        supervisor.terminate()
+        supervisor.join(10)
+    assert supervisor.exitcode == 0
@@ -0,0 +1,55 @@
+import pytest
+
+from limits.aio.storage import MemoryStorage
+
+# test client of fastapi needs requests or httpx depending on the version
+TestClient = pytest.importorskip('fastapi.testclient').TestClient
+
+from fastapi import FastAPI
+
+import pyTON.logging
+from pyTON.logging import LoggerAndRateLimitMiddleware
+from config import settings
+
+
+@pytest.fixture
+def limited_app(monkeypatch):
+    """
+    App limited to 10 hits of every method per minute, limits are kept in memory.
+    """
+    monkeypatch.setitem(settings['ratelimit'], 'enabled', True)
+    monkeypatch.setattr(pyTON.logging, 'RedisStorage', lambda uri: MemoryStorage())
+    monkeypatch.setattr(pyTON.logging, 'api_key_from_request', lambda request: '127.0.0.1')
+    monkeypatch.setattr(pyTON.logging, 'per_method_limits', lambda method, key: '10/minute')
+    monkeypatch.setattr(pyTON.logging, 'total_limits', lambda key: 'unlimited')
+
+    app = FastAPI()
+
+    @app.post('/runGetMethodBatch')
+    async def run_get_method_batch():
+        return {'ok': True}
+
+    @app.post('/getAddressInformationBatch')
+    async def get_address_information_batch():
+        return {'ok': True}
+
+    app.add_middleware(LoggerAndRateLimitMiddleware, endpoints=['runGetMethodBatch', 'getAddressInformationBatch'],
+                       batch_endpoints={'runGetMethodBatch': 'calls', 'getAddressInformationBatch': 'addresses'})
+    return TestClient(app)
+
+
+WALLET = 'EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N'
+
+
+def test_batch_is_charged_per_call(limited_app):
+    call = {'address': WALLET, 'method': 'seqno', 'stack': []}
+
+    assert limited_app.post('/runGetMethodBatch', json={'calls': [call] * 10}).status_code == 200
+    assert limited_app.post('/runGetMethodBatch', json={'calls': [call]}).status_code == 429
+
+
+def test_batch_is_charged_per_address(limited_app):
+    assert limited_app.post('/getAddressInformationBatch', json={'addresses': [WALLET] * 10}).status_code == 200
+    assert limited_app.post('/getAddressInformationBatch', json={'addresses': [WALLET]}).status_code == 429
+    # methods are limited separately
+    assert limited_app.post('/runGetMethodBatch', json={'calls': []}).status_code == 200
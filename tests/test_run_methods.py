@@ -0,0 +1,46 @@
+import asyncio
+
+from fakes import FakeMultiClient
+
+
+def account_state(lt):
+    return {'@type': 'raw.fullAccountState', 'balance': '1', 'last_transaction_id': {'lt': str(lt), 'hash': 'aGFzaA=='}}
+
+
+def handler(method, *args, **kwargs):
+    if method == 'raw_get_account_state':
+        return account_state({'A': 10, 'B': 20}[args[0]])
+    if method == 'raw_run_methods':
+        address, calls, last_transaction_lt = args
+        return [{'@type': 'smc.runResult', 'exit_code': 0, 'stack': [[address, method_name, last_transaction_lt]]}
+                for method_name, _ in calls]
+    return {'@type': 'error', 'code': 400, 'message': f'unexpected {method}'}
+
+
+def test_raw_run_methods_groups_calls_by_address():
+    async def scenario():
+        client = FakeMultiClient(handler)
+        calls = [('A', 'seqno', []), ('B', 'get_balance', []), ('A', 'get_public_key', [])]
+        results = await client.raw_run_methods(calls)
+        return client, results
+
+    client, results = asyncio.run(scenario())
+
+    assert [r['stack'] for r in results] == [[['A', 'seqno', 10]], [['B', 'get_balance', 20]], [['A', 'get_public_key', 10]]]
+    batches = sorted((args[0], args[1]) for method, args, _ in client.requests if method == 'raw_run_methods')
+    assert batches == [('A', [('seqno', []), ('get_public_key', [])]), ('B', [('get_balance', [])])]
+
+
+def test_raw_run_methods_fails_only_failed_group():
+    def failing(method, *args, **kwargs):
+        if method == 'raw_run_methods' and args[0] == 'B':
+            raise RuntimeError('liteserver is down')
+        return handler(method, *args, **kwargs)
+
+    async def scenario():
+        return await FakeMultiClient(failing).raw_run_methods([('A', 'seqno', []), ('B', 'seqno', [])])
+
+    results = asyncio.run(scenario())
+
+    assert results[0]['@type'] == 'smc.runResult'
+    assert results[1] == {'@type': 'error', 'code': 500, 'message': 'liteserver is down'}
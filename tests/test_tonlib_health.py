@@ -0,0 +1,31 @@
+from pyTON.tonlibjson import TonLib
+from pyTON.utils import ExpiringFutures
+
+
+class ResultsOnlyTonLib(TonLib):
+    """
+    TonLib without tonlib library loaded, only results handling is used.
+    """
+    def __del__(self):
+        pass
+
+
+def make_tonlib():
+    tonlib = ResultsOnlyTonLib.__new__(ResultsOnlyTonLib)
+    tonlib.futures = ExpiringFutures(None)
+    tonlib.shutdown_state = False
+    tonlib.request_num = 3
+    tonlib.error_num = 0
+    return tonlib
+
+
+def test_only_liteserver_errors_are_counted():
+    tonlib = make_tonlib()
+    tonlib.set_results([
+        b'{"@type":"error","code":400,"message":"INVALID_ACCOUNT_ADDRESS","@extra":1}',
+        b'{"@type":"error","code":500,"message":"LITE_SERVER_NETWORK","@extra":2}',
+        b'{"@type":"ok","@extra":3}',
+    ])
+
+    assert tonlib.take_stats() == (3, 1)
+    assert tonlib.take_stats() == (0, 0)
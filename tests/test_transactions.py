@@ -0,0 +1,77 @@
+import asyncio
+import base64
+
+import pyTON.cache
+from pyTON.cache import ImmutableStore
+from pyTON.utils import b64str_to_hex
+
+from fakes import FakeMultiClient
+
+PAGE_SIZE = 3
+
+
+def tx_hash(lt):
+    return base64.b64encode(lt.to_bytes(32, 'big')).decode()
+
+
+def transaction(lt):
+    return {'@type': 'raw.transaction', 'utime': lt, 'data': '', 'fee': '0', 'storage_fee': '0', 'other_fee': '0',
+            'transaction_id': {'@type': 'internal.transactionId', 'lt': str(lt), 'hash': tx_hash(lt)},
+            'in_msg': {}, 'out_msgs': []}
+
+
+def handler(method, *args, **kwargs):
+    # account has transactions with lt 1..100, every page has PAGE_SIZE of them
+    address, lt, hash = args
+    lt = int(lt)
+    assert hash == b64str_to_hex(tx_hash(lt))
+    previous = max(lt - PAGE_SIZE, 0)
+    return {'@type': 'raw.transactions', 'transactions': [transaction(t) for t in range(lt, previous, -1)],
+            'previous_transaction_id': {'@type': 'internal.transactionId', 'lt': str(previous), 'hash': tx_hash(previous)}}
+
+
+def lts(page):
+    return [int(t['transaction_id']['lt']) for t in page['transactions']]
+
+
+def test_page_starting_inside_fetched_page_is_served_from_index(tmp_path, monkeypatch):
+    store = ImmutableStore(str(tmp_path / 'store.sqlite'), 2 ** 30, 0.005)
+    writes = []
+    write = store.write
+    monkeypatch.setattr(store, 'write', lambda key, value: writes.append(key) or write(key, value))
+    monkeypatch.setattr(pyTON.cache, 'store', store)
+    client = FakeMultiClient(handler)
+
+    async def page(lt):
+        return await client.get_transactions_page('A', lt, b64str_to_hex(tx_hash(lt)), False)
+
+    assert lts(asyncio.run(page(100))) == [100, 99, 98]
+    assert len(client.requests) == 1
+    # page and index of its transactions except the first one
+    assert len(writes) == PAGE_SIZE
+
+    assert lts(asyncio.run(page(99))) == [99, 98]
+    assert lts(asyncio.run(page(98))) == [98]
+    assert len(client.requests) == 1
+
+    # page served from cache is not indexed again
+    assert lts(asyncio.run(page(100))) == [100, 99, 98]
+    assert len(client.requests) == 1
+    assert len(writes) == PAGE_SIZE
+
+
+def test_get_transactions_walks_pages(tmp_path, monkeypatch):
+    monkeypatch.setattr(pyTON.cache, 'store', ImmutableStore(str(tmp_path / 'store.sqlite'), 2 ** 30, 0.005))
+    client = FakeMultiClient(handler)
+
+    async def scenario():
+        first = await client.get_transactions('A', 100, tx_hash(100), limit=7)
+        second = await client.get_transactions('A', 99, tx_hash(99), to_transaction_lt=90, limit=20)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+
+    assert [int(t['transaction_id']['lt']) for t in first] == list(range(100, 93, -1))
+    assert [int(t['transaction_id']['lt']) for t in second] == list(range(99, 90, -1))
+    # second request starts inside the first page and is served from fetched pages until lt 94
+    assert [args[1] for _, args, _ in client.requests] == [100, 97, 94, 91]